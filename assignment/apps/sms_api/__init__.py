@@ -0,0 +1 @@
+default_app_config = 'apps.sms_api.apps.SmsApiConfig'
@@ -2,4 +2,8 @@ from django.apps import AppConfig
 
 
 class SmsApiConfig(AppConfig):
-    name = 'sms_api'
+    name = 'apps.sms_api'
+    label = 'sms_api'
+
+    def ready(self):
+        from . import signals
@@ -1,19 +1,47 @@
 from rest_framework.authentication import BasicAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 
+from utils.db.routers import PRIMARY_DB, reads_from_replica
+
 from .models import Account
+from .utils import AccountCache, account_cache
 
 class AccountBasicAuthentication(BasicAuthentication):
     """Since the DRF BasicAuthentication class only validates entries in user model, we have to override the authenticate_credentials method which will use our apps model to authenticate API requests."""
 
     def _get_account(self, userid, password):
+        """
+        Only verified credentials are cached, hence a wrong password always
+        falls through to the DB and can not push valid entries out of the
+        cache. An account read before a change to it was invalidated is
+        not cached. The worker listens for invalidations from its start,
+        see warmup.listen.
+        """
+        key = AccountCache.generate_key([userid, password])
+        account = account_cache.get(key)
+        if account is not None:
+            return account
+
+        generation = account_cache.generation
+        account = self._verified_account(Account.objects, userid, password)
+        if account is None and reads_from_replica(Account):
+            # The account or its auth_id may be too recent for the replica
+            account = self._verified_account(
+                Account.objects.using(PRIMARY_DB), userid, password
+            )
+        if account is not None:
+            account_cache.set_if_current(key, account, generation)
+        return account
+
+    @staticmethod
+    def _verified_account(queryset, userid, password):
         try:
-            account = Account.objects.get(username=userid)
+            account = queryset.get(username=userid)
         except Account.DoesNotExist:
             return None
-        else:
-            if account.check_auth_id(password):
-                return account
+        if account.check_auth_id(password):
+            return account
+        return None
 
     def authenticate_credentials(self, userid, password, request=None):
         account = self._get_account(userid, password)
@@ -0,0 +1,864 @@
+import base64
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from contextlib import contextmanager
+from unittest import mock
+
+import redis
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework import HTTP_HEADER_ENCODING
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient as DRFClient
+
+from utils.api_client import RequestType
+from utils.caches import RATE_LIMITERS, RedisConnection, TEST_REDIS_URL
+from utils.db.pool import ConnectionPool
+from utils.fastjson import EncodedBody, FastJSONParser, FastJSONRenderer, orjson
+
+from .carriers import StubCarrier
+from .client import SMSAPIClient
+from .constants import MAX_OUTBOUND_SMS_PER_NUMBER, OUTBOUND_SMS_LIMIT_WINDOW
+from .constants import SMSParams, STOP_MESSAGE
+from .dispatch import Dispatcher
+from .models import Account, PhoneNumber
+from .serializers import SMSDataParser, SMSDataSerializer
+from .tests_config import test_accounts, test_phone_numbers
+from .utils import OutboundSMSCounter, StopRequestStore
+from .views import BaseView
+
+"""
+Benchmarks for the sms_api endpoints, run with
+`./manage.py benchmark_sms`. Requests go through the whole Django/DRF
+stack in process, against a throwaway test DB and the test redis db, the
+same way the integration tests run. Results are written as JSON, so that
+runs of two commits can be compared.
+"""
+
+
+class Scenario(object):
+
+    INBOUND = 'inbound'
+    INBOUND_STOP = 'inbound_stop'
+    OUTBOUND = 'outbound'
+    OUTBOUND_STOPPED = 'outbound_stopped'
+    OVER_LIMIT = 'over_limit'
+    NOT_FOUND = 'not_found'
+    INVALID = 'invalid'
+
+    ALL = [
+        INBOUND, INBOUND_STOP, OUTBOUND, OUTBOUND_STOPPED, OVER_LIMIT,
+        NOT_FOUND, INVALID
+    ]
+
+DEFAULT_MIX = OrderedDict([
+    (Scenario.INBOUND, 35),
+    (Scenario.INBOUND_STOP, 5),
+    (Scenario.OUTBOUND, 35),
+    (Scenario.OUTBOUND_STOPPED, 5),
+    (Scenario.OVER_LIMIT, 10),
+    (Scenario.NOT_FOUND, 5),
+    (Scenario.INVALID, 5),
+])
+
+
+def parse_mix(value):
+    """
+    params:
+        mix like `inbound=40,outbound=60`, type string
+    return:
+        weight per scenario, type OrderedDict
+    """
+    mix = OrderedDict()
+    for part in value.split(','):
+        name, weight = part.split('=')
+        if name not in Scenario.ALL:
+            raise ValueError('unknown scenario %s' % name)
+        mix[name] = int(weight)
+    return mix
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(latencies, extra=None):
+    """
+    params:
+        latencies in seconds, type list(float)
+        extra per request counters, type dict(list(int))
+    return:
+        type dict
+    """
+    total = sum(latencies)
+    summary = OrderedDict([
+        ('count', len(latencies)),
+        ('throughput_rps', round(len(latencies) / total, 2) if total else None),
+        ('mean_ms', round(1000 * total / len(latencies), 3) if latencies else None),
+    ])
+    for pct in (50, 95, 99):
+        value = percentile(latencies, pct)
+        summary['p%d_ms' % pct] = round(1000 * value, 3) if value is not None else None
+    for name, values in (extra or {}).items():
+        summary['%s_per_request' % name] = \
+            round(sum(values) / float(len(values)), 3) if values else None
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class RedisCommandCounter(object):
+    """
+    Counts the redis commands and round trips of the process. A pipeline is
+    one round trip carrying all its commands.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+
+    @contextmanager
+    def counting(self):
+        execute_command = redis.client.Redis.execute_command
+        pipeline_execute = redis.client.Pipeline.execute
+        counter = self
+
+        def counted_execute_command(client, *args, **kwargs):
+            counter.commands += 1
+            counter.round_trips += 1
+            return execute_command(client, *args, **kwargs)
+
+        def counted_pipeline_execute(pipeline, *args, **kwargs):
+            counter.commands += len(pipeline.command_stack)
+            counter.round_trips += 1
+            return pipeline_execute(pipeline, *args, **kwargs)
+
+        with mock.patch.object(redis.client.Redis, 'execute_command', counted_execute_command), \
+                mock.patch.object(redis.client.Pipeline, 'execute', counted_pipeline_execute):
+            yield self
+
+    def reset(self):
+        counts = (self.commands, self.round_trips)
+        self.commands = 0
+        self.round_trips = 0
+        return counts
+
+
+class InProcessSMSAPIClient(SMSAPIClient):
+    """SMSAPIClient sending its requests through the DRF test client
+    instead of the network."""
+
+    def __init__(self):
+        super().__init__(base_url='')
+        self._client = DRFClient()
+        self._methods = {
+            RequestType.GET: self._client.get,
+            RequestType.POST: self._client.post,
+            RequestType.PUT: self._client.put,
+            RequestType.DELETE: self._client.delete,
+        }
+
+    def _send_request(self, url, request_type, auth=None, data=None):
+        kwargs = {}
+        if auth:
+            credentials = ('%s:%s' % auth).encode(HTTP_HEADER_ENCODING)
+            kwargs['HTTP_AUTHORIZATION'] = 'Basic %s' % base64.b64encode(
+                credentials
+            ).decode(HTTP_HEADER_ENCODING)
+        return self._methods[request_type](url, data, **kwargs)
+
+
+class EndpointBenchmark(object):
+    """
+    Fires a weighted mix of scenarios at the inbound and outbound endpoints,
+    one request at a time, and reports latency percentiles, throughput, DB
+    queries and redis commands per scenario and per endpoint.
+    """
+
+    def __init__(self, requests=1000, mix=None, numbers=200, warmup=50,
+                 seed=1):
+        self.requests = requests
+        self.mix = mix or DEFAULT_MIX
+        self.numbers = numbers
+        self.warmup = warmup
+        self.random = random.Random(seed)
+        self.client = InProcessSMSAPIClient()
+        self.cache = RedisConnection.get_connection(TEST_REDIS_URL)
+
+        self.account = test_accounts[0]
+        self.auth = (self.account['username'], str(self.account['auth_id']))
+        self.sent = defaultdict(int)
+
+    def setup(self):
+        """Loads the test fixtures plus `numbers` extra numbers to spread the
+        outbound traffic over, so that it stays below the limit."""
+        self.cache.flushdb()
+        Account.objects.bulk_create([Account(**data) for data in test_accounts])
+        PhoneNumber.objects.bulk_create(
+            [PhoneNumber(**data) for data in test_phone_numbers]
+        )
+        self.outbound_numbers = ['8%09d' % i for i in range(self.numbers)]
+        PhoneNumber.objects.bulk_create([
+            PhoneNumber(account_id=self.account['id'], number=number)
+            for number in self.outbound_numbers
+        ])
+
+        own = [p['number'] for p in test_phone_numbers
+               if p['account_id'] == self.account['id']]
+        self.inbound_number = own[0]
+        self.stopped_from = own[1]
+        self.over_limit_from = own[2]
+        self.stopped_to = '7000000001'
+
+        self._send(Scenario.INBOUND_STOP, {
+            SMSParams.FROM: self.stopped_to,
+            SMSParams.TO: self.stopped_from,
+            SMSParams.TEXT: STOP_MESSAGE,
+        })
+        key = OutboundSMSCounter.generate_key([self.over_limit_from])
+        store = OutboundSMSCounter(self.cache)
+        for i in range(MAX_OUTBOUND_SMS_PER_NUMBER):
+            store.hit(key)
+
+    def _next_outbound_number(self):
+        """Round robin over the extra numbers, resetting a counter outside
+        the timed section before it reaches the limit."""
+        number = self.outbound_numbers[self.sent['outbound'] % self.numbers]
+        self.sent['outbound'] += 1
+        self.sent[number] += 1
+        if self.sent[number] >= MAX_OUTBOUND_SMS_PER_NUMBER:
+            self.cache.delete(OutboundSMSCounter.generate_key([number]))
+            self.sent[number] = 0
+        return number
+
+    def payload(self, scenario):
+        """
+        return:
+            endpoint, request data, type tuple
+        """
+        other = '9%09d' % self.random.randint(0, 10 ** 9 - 1)
+        if scenario == Scenario.INBOUND:
+            return 'inbound', {SMSParams.FROM: other, SMSParams.TO: self.inbound_number, SMSParams.TEXT: 'hola'}
+        elif scenario == Scenario.INBOUND_STOP:
+            return 'inbound', {SMSParams.FROM: other, SMSParams.TO: self.inbound_number, SMSParams.TEXT: STOP_MESSAGE}
+        elif scenario == Scenario.OUTBOUND:
+            return 'outbound', {SMSParams.FROM: self._next_outbound_number(), SMSParams.TO: other, SMSParams.TEXT: 'hola'}
+        elif scenario == Scenario.OUTBOUND_STOPPED:
+            return 'outbound', {SMSParams.FROM: self.stopped_from, SMSParams.TO: self.stopped_to, SMSParams.TEXT: 'hola'}
+        elif scenario == Scenario.OVER_LIMIT:
+            return 'outbound', {SMSParams.FROM: self.over_limit_from, SMSParams.TO: other, SMSParams.TEXT: 'hola'}
+        elif scenario == Scenario.NOT_FOUND:
+            return 'outbound', {SMSParams.FROM: '6000000000', SMSParams.TO: other, SMSParams.TEXT: 'hola'}
+        else:
+            return 'inbound', {SMSParams.FROM: other, SMSParams.TEXT: 'hola'}
+
+    def _send(self, scenario, data=None):
+        endpoint, generated = self.payload(scenario)
+        data = dict(data or generated)
+        data['integration_test'] = True
+        if endpoint == 'inbound':
+            return endpoint, self.client.send_inbound_request(self.auth, data)
+        return endpoint, self.client.send_outbound_request(self.auth, data)
+
+    def run(self):
+        self.setup()
+        scenarios = list(self.mix.keys())
+        weights = list(self.mix.values())
+        for i in range(self.warmup):
+            self._send(self.random.choices(scenarios, weights)[0])
+
+        latencies = defaultdict(list)
+        counters = defaultdict(lambda: defaultdict(list))
+        statuses = defaultdict(lambda: defaultdict(int))
+        redis_counter = RedisCommandCounter()
+
+        with redis_counter.counting(), CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            for i in range(self.requests):
+                scenario = self.random.choices(scenarios, weights)[0]
+                redis_counter.reset()
+                query_count = len(queries)
+
+                start = time.perf_counter()
+                endpoint, response = self._send(scenario)
+                elapsed = time.perf_counter() - start
+
+                commands, round_trips = redis_counter.reset()
+                for group in (scenario, endpoint):
+                    latencies[group].append(elapsed)
+                    statuses[group][str(response.status_code)] += 1
+                    counters[group]['db_queries'].append(len(queries) - query_count)
+                    counters[group]['redis_commands'].append(commands)
+                    counters[group]['redis_round_trips'].append(round_trips)
+            wall = time.perf_counter() - started
+
+        result = OrderedDict([
+            ('requests', self.requests),
+            ('wall_seconds', round(wall, 3)),
+            ('throughput_rps', round(self.requests / wall, 2)),
+            ('endpoints', OrderedDict()),
+            ('scenarios', OrderedDict()),
+        ])
+        for group in sorted(latencies):
+            summary = summarize(latencies[group], counters[group])
+            summary['statuses'] = dict(statuses[group])
+            section = 'endpoints' if group in ('inbound', 'outbound') else 'scenarios'
+            result[section][group] = summary
+        return result
+
+
+class ParsingBenchmark(object):
+    """
+    Micro benchmark of the CPU spent turning request data into SMSData,
+    the former deepcopy + _format_data + SMSDataSerializer path against
+    SMSDataParser, for a valid and an invalid payload.
+    """
+
+    payloads = OrderedDict([
+        ('valid', {SMSParams.FROM: '1111111', SMSParams.TO: '343434343', SMSParams.TEXT: 'hola'}),
+        ('invalid', {SMSParams.FROM: '1111111', SMSParams.TEXT: 'hola'}),
+    ])
+
+    def __init__(self, number=2000):
+        self.number = number
+        self.view = BaseView()
+
+    def serializer_path(self, data):
+        data = self.view._format_data(deepcopy(data))
+        serializer = SMSDataSerializer(data=data)
+        if serializer.is_valid():
+            return serializer.save()
+        return self.view._process_validation_errors(serializer.errors)
+
+    def parser_path(self, data):
+        sms, errors = SMSDataParser.parse(data)
+        if sms:
+            return sms
+        return self.view._process_validation_errors(errors)
+
+    def _usec_per_call(self, func, data):
+        seconds = min(timeit.repeat(lambda: func(data), number=self.number, repeat=3))
+        return round(1e6 * seconds / self.number, 3)
+
+    def run(self):
+        result = OrderedDict()
+        for name, data in self.payloads.items():
+            serializer = self._usec_per_call(self.serializer_path, data)
+            parser = self._usec_per_call(self.parser_path, data)
+            result[name] = OrderedDict([
+                ('serializer_usec', serializer),
+                ('parser_usec', parser),
+                ('saved_usec', round(serializer - parser, 3)),
+                ('speedup', round(serializer / parser, 2)),
+            ])
+        return result
+
+
+class CodecBenchmark(object):
+    """
+    Micro benchmark of the CPU spent on JSON, DRF's parser and renderer
+    against the FastJSON ones, and rendering an EncodedBody, for a single
+    sms request and response and a batch of them.
+    """
+
+    sms = {SMSParams.FROM: '4924195509198', SMSParams.TO: '343434343', SMSParams.TEXT: 'hola'}
+    body = {'error': '', 'message': 'outbound sms ok'}
+
+    def __init__(self, number=2000, batch_size=100):
+        self.number = number
+        self.payloads = OrderedDict([
+            ('single', (self.sms, self.body)),
+            ('batch', (
+                [self.sms] * batch_size,
+                dict(self.body, results=[dict(self.body, status=202)] * batch_size)
+            )),
+        ])
+
+    def _usec_per_call(self, func):
+        seconds = min(timeit.repeat(func, number=self.number, repeat=3))
+        return round(1e6 * seconds / self.number, 3)
+
+    def run(self):
+        result = OrderedDict([('orjson', orjson is not None)])
+        for name, (request, response) in self.payloads.items():
+            encoded = JSONRenderer().render(request)
+            parse = OrderedDict([
+                ('drf_usec', self._usec_per_call(
+                    lambda: JSONParser().parse(io.BytesIO(encoded))
+                )),
+                ('fast_usec', self._usec_per_call(
+                    lambda: FastJSONParser().parse(io.BytesIO(encoded))
+                )),
+            ])
+            render = OrderedDict([
+                ('drf_usec', self._usec_per_call(lambda: JSONRenderer().render(response))),
+                ('fast_usec', self._usec_per_call(lambda: FastJSONRenderer().render(response))),
+            ])
+            result[name] = OrderedDict([('parse', parse), ('render', render)])
+        body = EncodedBody(self.body)
+        result['single']['render']['encoded_usec'] = self._usec_per_call(
+            lambda: FastJSONRenderer().render(body)
+        )
+        return result
+
+
+class MemoryBenchmark(object):
+    """
+    Redis memory taken per tracked sender by every rate limit algorithm,
+    after `hits` messages from each of `senders` numbers, projected to
+    millions of senders. It needs a real redis server, fakeredis does not
+    account memory.
+    """
+
+    def __init__(self, senders=10000, hits=10, connection=None):
+        self.senders = senders
+        self.hits = hits
+        self.connection = connection or RedisConnection.get_connection(TEST_REDIS_URL)
+
+    def _used_memory(self):
+        return self.connection.info('memory')['used_memory']
+
+    def _measure(self, limiter_class):
+        limiter = limiter_class(self.connection)
+        keys = [
+            'membench_%s_8%09d' % (limiter_class.algorithm, i)
+            for i in range(self.senders)
+        ]
+        before = self._used_memory()
+        for start in range(0, len(keys), 1000):
+            limiter.hit_many([
+                (key, {}) for key in keys[start:start + 1000]
+                for _ in range(self.hits)
+            ])
+        used = self._used_memory() - before
+        sample = keys[:100]
+        key_bytes = sum(self.connection.memory_usage(key) or 0 for key in sample)
+        for start in range(0, len(keys), 1000):
+            self.connection.delete(*keys[start:start + 1000])
+
+        per_sender = used / float(self.senders)
+        return OrderedDict([
+            ('bytes_per_sender', round(per_sender, 1)),
+            ('key_bytes_per_sender', round(key_bytes / float(len(sample)), 1)),
+            ('mb_per_million_senders', round(per_sender * 10 ** 6 / 2 ** 20, 1)),
+        ])
+
+    def run(self):
+        result = OrderedDict([
+            ('senders', self.senders),
+            ('hits_per_sender', self.hits),
+            ('algorithms', OrderedDict()),
+        ])
+        for algorithm, limiter_class in sorted(RATE_LIMITERS.items()):
+            limiter_class = type(limiter_class.__name__, (limiter_class,), {
+                'limit': MAX_OUTBOUND_SMS_PER_NUMBER,
+                'ttl': OUTBOUND_SMS_LIMIT_WINDOW,
+            })
+            result['algorithms'][algorithm] = self._measure(limiter_class)
+        return result
+
+
+class StopStoreBenchmark(object):
+    """
+    Memory and throughput of the compact StopRequestStore layout against
+    the former one string key per pair, for `pairs` opt-outs spread over
+    `recipients` numbers, projected to `projected_pairs`. Needs a real
+    redis server, like MemoryBenchmark.
+    """
+
+    batch = 1000
+
+    def __init__(self, pairs=100000, recipients=1000, projected_pairs=10 ** 7,
+                 connection=None):
+        self.pairs = pairs
+        self.recipients = recipients
+        self.projected_pairs = projected_pairs
+        self.connection = connection or RedisConnection.get_connection(TEST_REDIS_URL)
+        self.store = StopRequestStore(self.connection)
+        self.key_params = [
+            ['9%09d' % i, '8%09d' % (i % recipients)] for i in range(pairs)
+        ]
+
+    def _batches(self):
+        for start in range(0, self.pairs, self.batch):
+            yield self.key_params[start:start + self.batch]
+
+    def _legacy_add(self, batch):
+        p = self.connection.pipeline(transaction=False)
+        for keyParams in batch:
+            p.set(
+                StopRequestStore.generate_legacy_key(keyParams), 1,
+                nx=True, ex=StopRequestStore.ttl
+            )
+        p.execute()
+
+    def _legacy_check(self, batch):
+        p = self.connection.pipeline(transaction=False)
+        for keyParams in batch:
+            p.exists(StopRequestStore.generate_legacy_key(keyParams))
+        p.execute()
+
+    def _compact_add(self, batch):
+        self.store.add_many([StopRequestStore.generate_key(k) for k in batch])
+
+    def _compact_check(self, batch):
+        script = self.connection.register_script(StopRequestStore._is_stopped)
+        p = self.connection.pipeline(transaction=False)
+        for keyParams in batch:
+            key, field = StopRequestStore.generate_key(keyParams)
+            script(keys=[key], args=[field], client=p)
+        p.execute()
+
+    def _measure(self, add, check):
+        self.connection.flushdb()
+        before = self.connection.info('memory')['used_memory']
+        started = time.perf_counter()
+        for batch in self._batches():
+            add(batch)
+        add_seconds = time.perf_counter() - started
+        used = self.connection.info('memory')['used_memory'] - before
+
+        started = time.perf_counter()
+        for batch in self._batches():
+            check(batch)
+        check_seconds = time.perf_counter() - started
+        self.connection.flushdb()
+
+        per_pair = used / float(self.pairs)
+        return OrderedDict([
+            ('bytes_per_pair', round(per_pair, 1)),
+            ('projected_mb', round(per_pair * self.projected_pairs / 2 ** 20, 1)),
+            ('adds_per_second', round(self.pairs / add_seconds, 1)),
+            ('checks_per_second', round(self.pairs / check_seconds, 1)),
+        ])
+
+    def run(self):
+        return OrderedDict([
+            ('pairs', self.pairs),
+            ('recipients', self.recipients),
+            ('projected_pairs', self.projected_pairs),
+            ('legacy', self._measure(self._legacy_add, self._legacy_check)),
+            ('compact', self._measure(self._compact_add, self._compact_check)),
+        ])
+
+
+class LoadBenchmark(object):
+    """
+    Fires concurrent inbound and outbound requests at a running server over
+    HTTP, to compare serving modes at equal core count, e.g. `uwsgi
+    uwsgi.ini` against `uwsgi uwsgi_async.ini` with the same processes.
+
+    The account and number have to exist in the DB of that server, they
+    default to the first account of the initial_data fixture. Outbound
+    requests past the daily limit get a 403, which still runs the whole
+    outbound chain.
+    """
+
+    def __init__(self, url, requests=1000, concurrency=100, username='plivo1',
+                 password='20S0KPNOIM', number='4924195509198', seed=1):
+        self.client = SMSAPIClient(base_url=url)
+        self.requests = requests
+        self.concurrency = concurrency
+        self.auth = (username, password)
+        self.number = number
+        self.random = random.Random(seed)
+
+    def _request(self, i):
+        other = '9%09d' % self.random.randint(0, 10 ** 9 - 1)
+        start = time.perf_counter()
+        try:
+            if i % 2:
+                endpoint = 'inbound'
+                response = self.client.send_inbound_request(self.auth, {
+                    SMSParams.FROM: other, SMSParams.TO: self.number, SMSParams.TEXT: 'hola'
+                })
+            else:
+                endpoint = 'outbound'
+                response = self.client.send_outbound_request(self.auth, {
+                    SMSParams.FROM: self.number, SMSParams.TO: other, SMSParams.TEXT: 'hola'
+                })
+            status = str(response.status_code)
+        except Exception as e:
+            status = type(e).__name__
+        return endpoint, time.perf_counter() - start, status
+
+    def run(self):
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            started = time.perf_counter()
+            responses = list(pool.map(self._request, range(self.requests)))
+            wall = time.perf_counter() - started
+
+        latencies = defaultdict(list)
+        statuses = defaultdict(lambda: defaultdict(int))
+        for endpoint, elapsed, status in responses:
+            latencies[endpoint].append(elapsed)
+            statuses[endpoint][status] += 1
+
+        result = OrderedDict([
+            ('url', self.client.base_url),
+            ('requests', self.requests),
+            ('concurrency', self.concurrency),
+            ('wall_seconds', round(wall, 3)),
+            ('throughput_rps', round(self.requests / wall, 2)),
+            ('endpoints', OrderedDict()),
+        ])
+        for endpoint in sorted(latencies):
+            # Requests overlap, so only the wall clock tells the throughput
+            summary = summarize(latencies[endpoint])
+            del summary['throughput_rps']
+            summary['statuses'] = dict(statuses[endpoint])
+            result['endpoints'][endpoint] = summary
+        return result
+
+
+class DBPoolBenchmark(object):
+    """
+    Runs `requests` queries from `concurrency` threads against the DB of
+    the settings, once opening a connection for every request as Django
+    does without a pool, and once taking it from a ConnectionPool of
+    pool_size connections. The pooled run also reports how long requests
+    waited for a connection.
+    """
+
+    def __init__(self, requests=1000, concurrency=8, pool_size=None):
+        self.requests = requests
+        self.concurrency = concurrency
+        self.params = connection.get_connection_params()
+        self.pool = ConnectionPool(self._connect, name='benchmark', max_size=pool_size)
+        self.waits = []
+
+    def _connect(self):
+        return connection.Database.connect(**self.params)
+
+    @staticmethod
+    def _query(conn):
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchall()
+        cursor.close()
+
+    def _per_request(self, i):
+        start = time.perf_counter()
+        conn = self._connect()
+        self._query(conn)
+        conn.close()
+        return time.perf_counter() - start
+
+    def _pooled(self, i):
+        start = time.perf_counter()
+        conn = self.pool.get()
+        self.waits.append(time.perf_counter() - start)
+        self._query(conn)
+        self.pool.put(conn)
+        return time.perf_counter() - start
+
+    def _measure(self, request):
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            return summarize(list(pool.map(request, range(self.requests))))
+
+    def run(self):
+        per_request = self._measure(self._per_request)
+        pooled = self._measure(self._pooled)
+        waits = summarize(self.waits)
+        pooled['wait_p50_ms'] = waits['p50_ms']
+        pooled['wait_p99_ms'] = waits['p99_ms']
+        pooled['pool'] = self.pool.stats()
+        self.pool.close_idle()
+        return OrderedDict([
+            ('concurrency', self.concurrency),
+            ('per_request', per_request),
+            ('pooled', pooled),
+        ])
+
+
+class DispatchBenchmark(object):
+    """
+    Throughput of a single dispatch worker, draining `messages` queued sms
+    through a StubCarrier taking `latency` seconds per batch of up to
+    carrier_batch_size sms, for every concurrency. Runs against the test
+    redis db.
+    """
+
+    def __init__(self, messages=10000, latency=0.01, carrier_batch_size=10,
+                 concurrencies=(1, 4, 16), batch_size=None, connection=None):
+        self.messages = messages
+        self.latency = latency
+        self.carrier_batch_size = carrier_batch_size
+        self.concurrencies = concurrencies
+        self.batch_size = batch_size
+        self.connection = connection or RedisConnection.get_connection(TEST_REDIS_URL)
+
+    def _fill(self, queue):
+        queue.connection.delete(queue.stream_key, queue.dead_key)
+        queue.ensure_group()
+        for start in range(0, self.messages, 1000):
+            queue.add_many([
+                {'from': '4924195509198', 'to': '9%09d' % i, 'text': 'hola', 'account': 1}
+                for i in range(start, min(start + 1000, self.messages))
+            ])
+
+    def _measure(self, concurrency):
+        carrier = StubCarrier('stub', latency=self.latency)
+        carrier.max_batch_size = self.carrier_batch_size
+        dispatcher = Dispatcher(
+            self.connection, carriers={'stub': carrier}, concurrency=concurrency,
+            batch_size=self.batch_size, consumer='benchmark'
+        )
+        self._fill(dispatcher.queue)
+        started = time.perf_counter()
+        rounds = 0
+        while len(carrier.sent) < self.messages:
+            dispatcher.run_once()
+            rounds += 1
+        wall = time.perf_counter() - started
+        dispatcher.close()
+        return OrderedDict([
+            ('wall_seconds', round(wall, 3)),
+            ('throughput_mps', round(self.messages / wall, 2)),
+            ('rounds', rounds),
+        ])
+
+    def run(self):
+        result = OrderedDict([
+            ('messages', self.messages),
+            ('carrier_latency_ms', 1000 * self.latency),
+            ('carrier_batch_size', self.carrier_batch_size),
+        ])
+        for concurrency in self.concurrencies:
+            result['concurrency_%d' % concurrency] = self._measure(concurrency)
+        return result
+
+
+class StackBenchmark(object):
+    """
+    Per request cost of the full stack of settings, its middleware and the
+    admin URLconf, against the API only stack of api_settings. Requests
+    are refused by authentication, before the view does anything, so only
+    the stack around it is measured, with neither DB nor redis involved.
+    """
+
+    profiles = OrderedDict([
+        ('full', {}),
+        ('api', {
+            'MIDDLEWARE': settings.API_MIDDLEWARE,
+            'ROOT_URLCONF': settings.API_ROOT_URLCONF,
+        }),
+    ])
+
+    def __init__(self, requests=1000, warmup=50):
+        self.requests = requests
+        self.warmup = warmup
+
+    def _measure(self, overrides):
+        with override_settings(**overrides):
+            client = DRFClient()
+            url = reverse('inbound_sms')
+            data = {SMSParams.FROM: '343434343', SMSParams.TO: '4924195509198', SMSParams.TEXT: 'hola'}
+            for i in range(self.warmup):
+                client.post(url, data)
+            latencies = []
+            for i in range(self.requests):
+                start = time.perf_counter()
+                response = client.post(url, data)
+                latencies.append(time.perf_counter() - start)
+            assert response.status_code == 401
+        return summarize(latencies)
+
+    def run(self):
+        result = OrderedDict(
+            (name, self._measure(overrides)) for name, overrides in self.profiles.items()
+        )
+        result['saved_p50_ms'] = round(result['full']['p50_ms'] - result['api']['p50_ms'], 3)
+        return result
+
+
+class StartupBenchmark(object):
+    """
+    Times the first requests of fresh processes, cold as a worker without
+    warm up serves them and warm after apps.sms_api.warmup ran, every run
+    being a startup_probe process of its own. Like the load suite it needs
+    the account and number in the configured DB, and a redis server.
+    """
+
+    modes = ('cold', 'warm')
+
+    def __init__(self, runs=5, requests=5, username='plivo1',
+                 password='20S0KPNOIM', number='4924195509198'):
+        self.runs = runs
+        self.requests = requests
+        self.credentials = [
+            '--username', username, '--password', password, '--number', number
+        ]
+
+    def _probe(self, warm):
+        command = [
+            sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'),
+            'startup_probe', '--settings', os.environ['DJANGO_SETTINGS_MODULE'],
+            '--url', reverse('inbound_sms'), '--requests', str(self.requests),
+        ] + self.credentials
+        if warm:
+            command.append('--warm')
+        return json.loads(subprocess.check_output(command).decode())
+
+    def _summarize(self, probes):
+        summary = OrderedDict()
+        for i in range(self.requests):
+            latency = percentile([probe['latencies'][i] for probe in probes], 50)
+            summary['request_%d_p50_ms' % (i + 1)] = round(1000 * latency, 3)
+        if probes[0]['warmup']:
+            summary['warmup_p50_ms'] = OrderedDict(
+                (step, round(1000 * percentile(
+                    [probe['warmup'][step] or 0 for probe in probes], 50
+                ), 3))
+                for step in probes[0]['warmup']
+            )
+        return summary
+
+    def run(self):
+        result = OrderedDict([('runs', self.runs), ('requests', self.requests)])
+        for mode in self.modes:
+            probes = [self._probe(mode == 'warm') for i in range(self.runs)]
+            result[mode] = self._summarize(probes)
+        return result
+
+
+def report(results, options):
+    """
+    params:
+        results per suite, type dict
+        options the benchmark ran with, type dict
+    return:
+        type string, JSON
+    """
+    return json.dumps(OrderedDict([
+        ('commit', git_commit()),
+        ('timestamp', int(time.time())),
+        ('db_vendor', connection.vendor),
+        ('options', options),
+        ('results', results),
+    ]), indent=2)
@@ -0,0 +1,83 @@
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+from .constants import OUTBOUND_CARRIERS, OUTBOUND_CARRIER_ROUTES
+
+
+class CarrierAdapter(object):
+    """
+    Hands outbound sms over to a carrier. The dispatch_sms workers call
+    send_batch with the messages routed to the carrier, concurrently from
+    several threads, with at most max_batch_size messages.
+    """
+
+    max_batch_size = 100
+
+    def __init__(self, name):
+        self.name = name
+
+    def send_batch(self, messages):
+        """
+        params:
+            messages, type list(dict) with from, to and text
+        return:
+            whether every message was accepted by the carrier, the refused
+            ones get retried, type list(bool)
+        raises:
+            any exception, to retry the whole batch
+        """
+        raise NotImplementedError
+
+
+class StubCarrier(CarrierAdapter):
+    """
+    Accepts everything after `latency` seconds and keeps what it got, for
+    tests and benchmarks. `fail` tells the messages to refuse.
+    """
+
+    latency = 0
+
+    def __init__(self, name, latency=None, fail=None):
+        super().__init__(name)
+        self.latency = latency if latency is not None else self.latency
+        self.fail = fail or (lambda message: False)
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_batch(self, messages):
+        if self.latency:
+            time.sleep(self.latency)
+        results = [not self.fail(message) for message in messages]
+        with self._lock:
+            self.sent.extend(m for m, ok in zip(messages, results) if ok)
+        return results
+
+
+def load_carriers():
+    """
+    return:
+        an adapter per name of OUTBOUND_CARRIERS, type dict
+    """
+    return {
+        name: import_string(path)(name) for name, path in OUTBOUND_CARRIERS
+    }
+
+
+def carrier_for(number, routes=OUTBOUND_CARRIER_ROUTES):
+    """
+    params:
+        number the sms goes to, type string
+        routes, number prefix to carrier name, the longest prefix wins,
+        the empty one matches every number, type dict
+    return:
+        name of the carrier, type string
+    """
+    if not routes:
+        return OUTBOUND_CARRIERS[0][0]
+    for length in range(len(number), -1, -1):
+        carrier = routes.get(number[:length])
+        if carrier is not None:
+            return carrier
+    return OUTBOUND_CARRIERS[0][0]
@@ -1,3 +1,6 @@
+import ipaddress
+import os
+
 from rest_framework.fields import Field
 
 FIELD_REQUIRED_MESSAGE = Field.default_error_messages['required']
@@ -5,6 +8,120 @@ SERIALIZER_FIELD_PREFIX = "sms_"
 STOP_MESSAGE = 'STOP'
 
 MAX_OUTBOUND_SMS_PER_NUMBER = 50
+OUTBOUND_SMS_LIMIT_WINDOW = 24*60*60
+
+"""One of utils.caches.RATE_LIMITERS, each of them keeps its counters under
+keys of its own. The fixed window is the one counters were always kept
+with, the others start every sender from zero when opted in."""
+OUTBOUND_SMS_LIMIT_ALGORITHM = os.environ.get('OUTBOUND_SMS_LIMIT_ALGORITHM', 'fixed_window')
+
+"""A saved or deleted OutboundLimit drops the overrides of its account from
+the outbound_limit_cache of every worker through OUTBOUND_LIMIT_CHANNEL
+once its transaction commits, the ttl bounds how late it can be when
+those messages do not arrive."""
+OUTBOUND_LIMIT_CHANNEL = 'outboundlimits'
+OUTBOUND_LIMIT_CACHE_TTL = 5*60
+
+"""A saved or deleted account is dropped from the account_cache of every
+worker through ACCOUNT_CHANNEL once its transaction commits, the ttl
+bounds how late it can be when those messages do not arrive."""
+ACCOUNT_CHANNEL = 'accounts'
+ACCOUNT_CACHE_MAX_SIZE = 10000
+ACCOUNT_CACHE_TTL = 5*60
+
+PHONE_NUMBER_INDEX_TTL = 60*60
+
+"""STOP requests recorded before the compact layout, as one string key per
+pair, are still honoured while this is on. They expire within
+StopRequestStore.ttl of the deploy, it can be turned off after that. They
+predate sharding, so they are never read from a sharded redis."""
+STOP_REQUEST_READ_LEGACY_KEYS = os.environ.get('STOP_REQUEST_READ_LEGACY_KEYS', '1') == '1'
+
+"""A STOP reaches the near cache of every worker through STOP_REQUEST_CHANNEL,
+the ttl bounds how late it can be when those messages do not arrive."""
+STOP_REQUEST_CHANNEL = 'stoprequests'
+STOP_NEAR_CACHE_TTL = 2
+STOP_NEAR_CACHE_MAX_SIZE = 100000
+
+MAX_BATCH_SIZE = 1000
+
+"""While redis is unavailable, outbound sms are limited by every worker on
+its own, to its share of the limit, one of DEGRADED_WORKERS. STOP requests
+can not be checked then, DEGRADED_STOP_POLICY decides whether the sms go
+out anyway or get a 503 until redis is back. Sent anyway, they wait in
+the worker, up to DEGRADED_DISPATCH_BUFFER of them, to be queued for
+dispatch."""
+DEGRADED_WORKERS = int(os.environ.get('DEGRADED_WORKERS', 4))
+DEGRADED_STOP_POLICY = os.environ.get('DEGRADED_STOP_POLICY', 'fail_closed')
+DEGRADED_DISPATCH_BUFFER = int(os.environ.get('DEGRADED_DISPATCH_BUFFER', 10000))
+
+"""Every uwsgi worker runs apps.sms_api.warmup after it is forked unless
+WORKER_WARMUP is 0, opening this many redis connections per node. It only
+listens for the invalidations of its caches then."""
+WORKER_WARMUP = os.environ.get('WORKER_WARMUP', '1') == '1'
+WARMUP_REDIS_CONNECTIONS = int(os.environ.get('WARMUP_REDIS_CONNECTIONS', 4))
+
+"""Accepted outbound sms are queued on a redis stream and sent by the
+dispatch_sms workers, DISPATCH_BATCH_SIZE at a time, to up to
+DISPATCH_CONCURRENCY carriers at once per worker. A message refused by its
+carrier is retried DISPATCH_RETRY_DELAY seconds later, the delay doubling
+on every attempt, before it goes to the dead letter stream after
+DISPATCH_MAX_ATTEMPTS attempts. The stream keeps about
+DISPATCH_STREAM_MAX_LENGTH messages waiting and the dead letter stream
+DISPATCH_DEAD_MAX_LENGTH, the oldest are dropped past that."""
+DISPATCH_BATCH_SIZE = int(os.environ.get('DISPATCH_BATCH_SIZE', 100))
+DISPATCH_CONCURRENCY = int(os.environ.get('DISPATCH_CONCURRENCY', 4))
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get('DISPATCH_MAX_ATTEMPTS', 5))
+DISPATCH_RETRY_DELAY = float(os.environ.get('DISPATCH_RETRY_DELAY', 5))
+DISPATCH_STREAM_MAX_LENGTH = int(os.environ.get('DISPATCH_STREAM_MAX_LENGTH', 1000000))
+DISPATCH_DEAD_MAX_LENGTH = int(os.environ.get('DISPATCH_DEAD_MAX_LENGTH', 100000))
+
+"""Carriers as name=adapter class, the first one gets the numbers no route
+of OUTBOUND_CARRIER_ROUTES, number prefix=carrier name, matches."""
+OUTBOUND_CARRIERS = [
+    tuple(carrier.split('=', 1)) for carrier in os.environ.get(
+        'OUTBOUND_CARRIERS', 'stub=apps.sms_api.carriers.StubCarrier'
+    ).split(',')
+]
+OUTBOUND_CARRIER_ROUTES = dict(
+    route.split('=', 1) for route in
+    filter(None, os.environ.get('OUTBOUND_CARRIER_ROUTES', '').split(','))
+)
+
+"""Accepted sms are kept in memory by every worker and written to the
+message table in batches of MESSAGE_FLUSH_SIZE, at least every
+MESSAGE_FLUSH_INTERVAL seconds. Up to MESSAGE_BUFFER_MAX_SIZE wait while
+the DB can not be written to. Monthly partitions of the table are created
+MESSAGE_PARTITIONS_AHEAD months in advance, on Postgres from
+MESSAGE_PARTITIONS_PG_VERSION, the first with default partitions."""
+MESSAGE_FLUSH_SIZE = int(os.environ.get('MESSAGE_FLUSH_SIZE', 500))
+MESSAGE_FLUSH_INTERVAL = float(os.environ.get('MESSAGE_FLUSH_INTERVAL', 1))
+MESSAGE_BUFFER_MAX_SIZE = int(os.environ.get('MESSAGE_BUFFER_MAX_SIZE', 100000))
+MESSAGE_PARTITIONS_AHEAD = 2
+MESSAGE_PARTITIONS_PG_VERSION = 110000
+
+"""An outbound sms sent again with the Idempotency-Key header of an earlier
+one gets the response of the earlier one, for IDEMPOTENCY_KEY_TTL. With
+IDEMPOTENCY_CONTENT_WINDOW set, sms without the header are deduplicated
+on their from, to and text for that many seconds. A duplicate of a
+request still in flight, for up to IDEMPOTENCY_PENDING_TTL, gets a 409."""
+IDEMPOTENCY_KEY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+IDEMPOTENCY_KEY_TTL = 24*60*60
+IDEMPOTENCY_CONTENT_WINDOW = int(os.environ.get('IDEMPOTENCY_CONTENT_WINDOW', 0))
+IDEMPOTENCY_PENDING_TTL = 30
+
+"""/metrics answers only requests from these networks, comma separated,
+the loopback ones by default. Its port should not be reachable from
+outside either, a proxy in front must not forward it."""
+METRICS_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(network) for network in filter(None, os.environ.get(
+        'METRICS_ALLOWED_NETWORKS', '127.0.0.0/8,::1/128'
+    ).split(','))
+]
+
+"""import_sms_data writes this many rows per transaction."""
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 10000))
 
 
 class SMSType(object):
@@ -12,19 +129,32 @@ class SMSType(object):
     INBOUND = "inbound"
     OUTBOUND = "outbound"
 
+class DegradedStopPolicy(object):
+
+    FAIL_OPEN = "fail_open"
+    FAIL_CLOSED = "fail_closed"
+
 class ErrorMessage(object):
 
     DATA_INVALID = "data must be a dictionary"
+    BATCH_INVALID = "data must be a list"
+    BATCH_TOO_LARGE = "batch can not have more than %s messages"
     PARAM_NOT_FOUND = "%s parameter not found"
     PARAM_MISSING = "%s is missing"
     PARAM_INVALID = "%s is invalid"
     UNKNOWN_FAILURE = "unknown failure"
+    UNAVAILABLE = "temporarily unavailable, retry later"
     LIMIT_REACHED = "limit reached for from %s"
     SMS_BLOCKED = "sms from %s to %s blocked by STOP request"
+    IDEMPOTENCY_KEY_INVALID = "Idempotency-Key is invalid"
+    IDEMPOTENCY_KEY_IN_FLIGHT = "a request with this Idempotency-Key is in progress"
+    IDEMPOTENCY_KEY_REUSED = "Idempotency-Key was used for a different sms"
 
 class SuccessMessage(object):
 
     SMS_REQUEST_OK = "%s sms ok"
+    SMS_BATCH_OK = "%s sms batch ok"
+    QUOTA_OK = "%s quota ok"
 
 
 class SMSParams(object):
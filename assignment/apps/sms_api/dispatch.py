@@ -0,0 +1,135 @@
+import logging
+import os
+import socket
+import time
+
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.caches import REDIS_SOCKET_TIMEOUT
+from utils.metrics import CARRIER_LATENCY, DISPATCHED, timed
+
+from .carriers import carrier_for, load_carriers
+from .constants import DISPATCH_BATCH_SIZE, DISPATCH_CONCURRENCY
+from .utils import OutboundSMSQueue
+
+logger = logging.getLogger(__name__)
+
+
+class DispatchOutcome(object):
+
+    SENT = 'sent'
+    RETRY = 'retry'
+    DEAD = 'dead'
+
+
+class Dispatcher(object):
+    """
+    One consumer of the OutboundSMSQueue. Every round takes up to
+    batch_size messages, the retries that are due first, groups them per
+    carrier and sends every group, split in up to `concurrency` parts, on
+    `concurrency` threads. Sent messages are deleted from the queue, the
+    others are left pending for OutboundSMSQueue to hand out again after
+    their backoff.
+
+    params:
+        connection, type StrictRedis
+        carriers, adapter per name, type dict(CarrierAdapter)
+    """
+
+    # Milliseconds an idle round waits for messages, a blocked read has to
+    # answer within the socket timeout of the connection
+    block = int(REDIS_SOCKET_TIMEOUT * 1000 / 2)
+
+    def __init__(self, connection=None, carriers=None, concurrency=None,
+                 batch_size=None, consumer=None):
+        self.queue = OutboundSMSQueue(connection)
+        self.carriers = carriers if carriers is not None else load_carriers()
+        self.concurrency = concurrency or DISPATCH_CONCURRENCY
+        self.batch_size = batch_size or DISPATCH_BATCH_SIZE
+        self.consumer = consumer or '%s-%s' % (socket.gethostname(), os.getpid())
+        self.executor = ThreadPoolExecutor(self.concurrency)
+        self.queue.ensure_group()
+
+    def _take(self, block):
+        entries = self.queue.claim_due(self.consumer, self.batch_size)
+        dead = [e for e in entries if e.deliveries > self.queue.max_attempts]
+        if dead:
+            self.queue.dead_letter(dead)
+            for entry in dead:
+                DISPATCHED.labels(
+                    carrier=carrier_for(entry.fields['to']), outcome=DispatchOutcome.DEAD
+                ).inc()
+            logger.warning('%d outbound sms moved to the dead letter stream', len(dead))
+        entries = [e for e in entries if e.deliveries <= self.queue.max_attempts]
+        if len(entries) < self.batch_size:
+            entries += self.queue.read(
+                self.consumer, self.batch_size - len(entries),
+                block=None if entries else block
+            )
+        return entries
+
+    def _chunks(self, carrier, batch):
+        """Splits the batch of a carrier for it to use all the threads,
+        within the batch size the carrier takes."""
+        size = -(-len(batch) // self.concurrency)
+        adapter = self.carriers.get(carrier)
+        if adapter is not None:
+            size = min(size, adapter.max_batch_size)
+        return [batch[i:i + size] for i in range(0, len(batch), size)]
+
+    def _send(self, carrier, entries):
+        """
+        return:
+            the entries the carrier took, type list(StreamEntry)
+        """
+        try:
+            with timed(CARRIER_LATENCY, carrier=carrier):
+                results = self.carriers[carrier].send_batch(
+                    [entry.fields for entry in entries]
+                )
+        except Exception:
+            logger.exception('Carrier %s failed a batch of %d sms', carrier, len(entries))
+            results = [False] * len(entries)
+
+        sent = [entry for entry, ok in zip(entries, results) if ok]
+        DISPATCHED.labels(carrier=carrier, outcome=DispatchOutcome.SENT).inc(len(sent))
+        DISPATCHED.labels(carrier=carrier, outcome=DispatchOutcome.RETRY).inc(
+            len(entries) - len(sent)
+        )
+        return sent
+
+    def run_once(self, block=None):
+        """
+        params:
+            block for that many milliseconds when nothing is queued, type int
+        return:
+            count of messages per outcome of this round, type dict
+        """
+        entries = self._take(block)
+        by_carrier = defaultdict(list)
+        for entry in entries:
+            by_carrier[carrier_for(entry.fields['to'])].append(entry)
+
+        futures = [
+            self.executor.submit(self._send, carrier, chunk)
+            for carrier, batch in by_carrier.items()
+            for chunk in self._chunks(carrier, batch)
+        ]
+        sent = [entry for future in futures for entry in future.result()]
+        self.queue.done([entry.id for entry in sent])
+        return OrderedDict([
+            (DispatchOutcome.SENT, len(sent)),
+            (DispatchOutcome.RETRY, len(entries) - len(sent)),
+        ])
+
+    def run(self, should_stop=lambda: False):
+        while not should_stop():
+            try:
+                self.run_once(block=self.block)
+            except Exception:
+                logger.exception('Dispatch round failed')
+                time.sleep(1)
+
+    def close(self):
+        self.executor.shutdown()
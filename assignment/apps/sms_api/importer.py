@@ -0,0 +1,342 @@
+import csv
+import io
+import json
+import logging
+import time
+
+from collections import OrderedDict
+
+from django.db import connections, transaction
+from redis import RedisError
+
+from utils.db.routers import PRIMARY_DB, pin_to_primary
+
+from .constants import IMPORT_BATCH_SIZE
+from .models import Account, PhoneNumber
+from .utils import AccountCache, PhoneNumberIndex, account_cache, api_connection
+
+logger = logging.getLogger(__name__)
+
+
+class ImportFormat(object):
+
+    CSV = 'csv'
+    NDJSON = 'ndjson'
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def read_rows(stream, fmt):
+    """
+    Rows of a CSV file with a header line, or of a file of one JSON object
+    per line, read one at a time.
+
+    params:
+        stream, text file, type file
+        fmt, one of ImportFormat
+    return:
+        (line, row) pairs, type generator(tuple(int, dict))
+    """
+    if fmt == ImportFormat.CSV:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line, text in enumerate(stream, 1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError:
+                row = None
+            yield line, row if isinstance(row, dict) else None
+
+
+class Importer(object):
+    """
+    Writes rows read from a file to the table of `model`, batch_size rows
+    at a time, each batch in a transaction of its own. On Postgres a batch
+    is copied into a temporary table and merged from there in one
+    statement, elsewhere it costs a query for the existing rows and a
+    bulk_create. Only the current batch is held in memory, whatever the
+    size of the file. Rows that are not valid are skipped and counted.
+
+    Bulk writes send no signals, the caches the signals keep in step are
+    invalidated by `invalidate` once the import is done, in every worker,
+    for the accounts in self.accounts.
+
+    params:
+        connection, redis connection, api_connection() when not given,
+        type StrictRedis
+    """
+
+    model = None
+    fields = ()
+    staging = None
+    staging_columns = None
+
+    def __init__(self, batch_size=None, connection=None):
+        self.batch_size = batch_size or IMPORT_BATCH_SIZE
+        self.connection = connection or api_connection()
+        self.accounts = set()
+        self.stats = OrderedDict([
+            ('rows', 0), ('written', 0), ('skipped', 0), ('invalid', 0),
+            ('seconds', 0.0), ('rows_per_second', 0),
+        ])
+
+    def clean(self, row):
+        """
+        params:
+            row, type dict
+        return:
+            values of fields, type tuple
+        raises:
+            InvalidRow
+        """
+        raise NotImplementedError
+
+    def _copy(self, rows, cursor):
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        cursor.execute(
+            'CREATE TEMPORARY TABLE %s (%s) ON COMMIT DROP' % (self.staging, self.staging_columns)
+        )
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (self.staging, ', '.join(self.fields)),
+            data
+        )
+
+    def _merge(self, cursor):
+        """
+        return:
+            count of rows written, type int
+        """
+        raise NotImplementedError
+
+    def _write(self, rows):
+        """
+        return:
+            count of rows written, type int
+        """
+        raise NotImplementedError
+
+    def write_batch(self, rows):
+        connection = connections[PRIMARY_DB]
+        with transaction.atomic(using=PRIMARY_DB):
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    self._copy(rows, cursor)
+                    return self._merge(cursor)
+            return self._write(rows)
+
+    def finish(self):
+        pass
+
+    def _flush(self, batch, started):
+        written = self.write_batch(batch)
+        self.stats['written'] += written
+        self.stats['skipped'] += len(batch) - written
+        self.stats['seconds'] = round(time.monotonic() - started, 3)
+        self.stats['rows_per_second'] = int(
+            self.stats['rows'] / max(self.stats['seconds'], 0.001)
+        )
+
+    def run(self, rows, progress=None):
+        """
+        params:
+            rows, (line, row) pairs, as read_rows gives them, type iterable
+            progress, called with the stats after every batch, type function
+        return:
+            counts of rows, of the import, type dict
+        """
+        started = time.monotonic()
+        batch = []
+        for line, row in rows:
+            self.stats['rows'] += 1
+            try:
+                if row is None:
+                    raise InvalidRow('not a JSON object')
+                batch.append(self.clean(row))
+            except InvalidRow as e:
+                self.stats['invalid'] += 1
+                logger.warning('Line %d skipped, %s', line, e)
+                continue
+            if len(batch) >= self.batch_size:
+                self._flush(batch, started)
+                batch = []
+                if progress:
+                    progress(self.stats)
+        if batch:
+            self._flush(batch, started)
+            if progress:
+                progress(self.stats)
+        self.finish()
+        self.stats['seconds'] = round(time.monotonic() - started, 3)
+        self.invalidate()
+        pin_to_primary()
+        return self.stats
+
+    def invalidate(self):
+        raise NotImplementedError
+
+
+def _integer(row, field):
+    try:
+        return int(row.get(field))
+    except (TypeError, ValueError):
+        raise InvalidRow('%s is invalid' % field)
+
+
+def _string(row, field, model):
+    value = row.get(field)
+    max_length = model._meta.get_field(field).max_length
+    if not isinstance(value, str) or not value or len(value) > max_length:
+        raise InvalidRow('%s is invalid' % field)
+    return value
+
+
+class AccountImporter(Importer):
+    """
+    Rows of id, auth_id and username, an account that exists already gets
+    the auth_id and username of its row.
+    """
+
+    model = Account
+    fields = ('id', 'auth_id', 'username')
+    staging = 'import_account'
+    staging_columns = 'id integer, auth_id varchar(40), username varchar(30)'
+    max_invalidated_accounts = 1000
+
+    def clean(self, row):
+        return (
+            _integer(row, 'id'),
+            _string(row, 'auth_id', Account),
+            _string(row, 'username', Account),
+        )
+
+    def _merge(self, cursor):
+        # The last row of an id wins, as it does in _write
+        cursor.execute(
+            """
+            INSERT INTO account (id, auth_id, username)
+            SELECT DISTINCT ON (id) id, auth_id, username FROM import_account
+            ORDER BY id, ctid DESC
+            ON CONFLICT (id) DO UPDATE
+            SET auth_id = EXCLUDED.auth_id, username = EXCLUDED.username
+            WHERE (account.auth_id, account.username)
+                IS DISTINCT FROM (EXCLUDED.auth_id, EXCLUDED.username)
+            RETURNING id, xmax <> 0
+            """
+        )
+        # xmax is only set on the rows that were updated
+        self.accounts.update(pk for pk, updated in cursor.fetchall() if updated)
+        return cursor.rowcount
+
+    def _write(self, rows):
+        rows = OrderedDict((row[0], row) for row in rows)
+        existing = {
+            row[0]: row for row in
+            Account.objects.using(PRIMARY_DB).filter(id__in=list(rows))
+            .values_list(*self.fields)
+        }
+        Account.objects.using(PRIMARY_DB).bulk_create([
+            Account(**dict(zip(self.fields, row)))
+            for pk, row in rows.items() if pk not in existing
+        ])
+        changed = [row for pk, row in rows.items() if pk in existing and existing[pk] != row]
+        for pk, auth_id, username in changed:
+            Account.objects.using(PRIMARY_DB).filter(id=pk).update(
+                auth_id=auth_id, username=username
+            )
+        self.accounts.update(row[0] for row in changed)
+        return len(rows) - len(existing) + len(changed)
+
+    def finish(self):
+        """Ids were given, the sequence has to move past them."""
+        connection = connections[PRIMARY_DB]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT setval(pg_get_serial_sequence('account', 'id'), "
+                    "COALESCE((SELECT MAX(id) FROM account), 0) + 1, false)"
+                )
+
+    def invalidate(self):
+        """The accounts updated are dropped from the account_cache of
+        every worker, their old auth_id must stop authenticating. New ones
+        can not be cached yet. Past max_invalidated_accounts, the
+        workers drop their whole account_cache instead, which costs them
+        less than looking for every account."""
+        accounts = sorted(self.accounts)
+        if len(accounts) > self.max_invalidated_accounts:
+            accounts = [AccountCache.ALL]
+        try:
+            account_cache.publish(self.connection, accounts)
+        except RedisError:
+            logger.exception('Could not invalidate the cache of %d accounts', len(self.accounts))
+
+
+class PhoneNumberImporter(Importer):
+    """
+    Rows of number and account_id, a number the account has already, or
+    of an account that does not exist, is skipped.
+    """
+
+    model = PhoneNumber
+    fields = ('number', 'account_id')
+    staging = 'import_phone_number'
+    staging_columns = 'number varchar(40), account_id integer'
+
+    def clean(self, row):
+        return (_string(row, 'number', PhoneNumber), _integer(row, 'account_id'))
+
+    def _merge(self, cursor):
+        cursor.execute(
+            """
+            INSERT INTO phone_number (number, account_id)
+            SELECT DISTINCT number, account_id FROM import_phone_number
+            WHERE account_id IN (SELECT id FROM account)
+            ON CONFLICT (account_id, number) DO NOTHING
+            RETURNING account_id
+            """
+        )
+        self.accounts.update(account_id for account_id, in cursor.fetchall())
+        return cursor.rowcount
+
+    def _write(self, rows):
+        rows = set(rows)
+        account_ids = {account_id for number, account_id in rows}
+        known = set(
+            Account.objects.using(PRIMARY_DB).filter(id__in=account_ids)
+            .values_list('id', flat=True)
+        )
+        existing = set(
+            PhoneNumber.objects.using(PRIMARY_DB)
+            .filter(account_id__in=known, number__in={number for number, _ in rows})
+            .values_list(*self.fields)
+        )
+        new = [row for row in rows if row[1] in known and row not in existing]
+        PhoneNumber.objects.using(PRIMARY_DB).bulk_create([
+            PhoneNumber(number=number, account_id=account_id) for number, account_id in new
+        ])
+        self.accounts.update(account_id for number, account_id in new)
+        return len(new)
+
+    def invalidate(self):
+        """The indexes of the accounts that got numbers are dropped, to be
+        loaded again with them on their next use."""
+        try:
+            PhoneNumberIndex(self.connection).invalidate(self.accounts)
+        except RedisError:
+            logger.exception(
+                'Could not invalidate the phone number index of %d accounts', len(self.accounts)
+            )
+
+
+IMPORTERS = OrderedDict([
+    ('accounts', AccountImporter),
+    ('numbers', PhoneNumberImporter),
+])
@@ -0,0 +1,165 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from utils.caches import RedisConnection, TEST_REDIS_URL
+
+from ...benchmarks import DBPoolBenchmark, DispatchBenchmark, EndpointBenchmark
+from ...benchmarks import LoadBenchmark, StackBenchmark
+from ...benchmarks import CodecBenchmark, MemoryBenchmark
+from ...benchmarks import ParsingBenchmark, StartupBenchmark, StopStoreBenchmark
+from ...benchmarks import parse_mix, report
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Benchmarks the sms endpoints against a throwaway test DB and the '
+        'test redis db, and prints the results as JSON.'
+    )
+
+    suites = [
+        'endpoints', 'parsing', 'codec', 'stack', 'load', 'memory', 'stop',
+        'startup', 'db', 'dispatch'
+    ]
+
+    """The load suite needs a running server, memory and stop a real redis
+    server, startup both the DB and redis of the settings and db the DB of
+    the settings, so they only run on demand. So does dispatch, which takes
+    a while."""
+    default_suites = ['endpoints', 'parsing', 'codec', 'stack']
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--suite', action='append', choices=self.suites,
+            help='Suites to run, can be repeated, endpoints and parsing by default'
+        )
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--warmup', type=int, default=50)
+        parser.add_argument(
+            '--mix', type=parse_mix, default=None,
+            help='Scenario weights, like inbound=40,outbound=50,invalid=10'
+        )
+        parser.add_argument(
+            '--numbers', type=int, default=200,
+            help='Extra numbers the outbound traffic is spread over'
+        )
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument(
+            '--fake-redis', action='store_true',
+            help='Use an in-process fakeredis instead of a redis server'
+        )
+        parser.add_argument('--output', help='File to write the JSON to')
+        parser.add_argument(
+            '--url', default='http://localhost:8000',
+            help='Server the load suite sends its requests to'
+        )
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument(
+            '--senders', type=int, default=10000,
+            help='Numbers the memory suite tracks per rate limit algorithm'
+        )
+        parser.add_argument(
+            '--pairs', type=int, default=100000,
+            help='STOP requests the stop suite stores, projected to 10M'
+        )
+        parser.add_argument(
+            '--runs', type=int, default=5,
+            help='Processes the startup suite starts per mode'
+        )
+        parser.add_argument(
+            '--messages', type=int, default=10000,
+            help='Sms the dispatch suite queues per concurrency'
+        )
+        parser.add_argument(
+            '--db-concurrency', type=int, default=8,
+            help='Threads of the db suite, each opens a connection without the pool'
+        )
+
+    def _use_fake_redis(self):
+        try:
+            import fakeredis
+        except ImportError:
+            raise CommandError('--fake-redis needs the fakeredis package')
+        RedisConnection.register(TEST_REDIS_URL, fakeredis.FakeStrictRedis())
+
+    def _run_endpoints(self, options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            return EndpointBenchmark(
+                requests=options['requests'],
+                mix=options['mix'],
+                numbers=options['numbers'],
+                warmup=options['warmup'],
+                seed=options['seed'],
+            ).run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def _run_stack(self, options):
+        setup_test_environment()
+        try:
+            return StackBenchmark(
+                requests=options['requests'], warmup=options['warmup']
+            ).run()
+        finally:
+            teardown_test_environment()
+
+    def handle(self, *args, **options):
+        if options['fake_redis']:
+            self._use_fake_redis()
+
+        # 4xx scenarios would otherwise log a warning per request
+        logging.getLogger('django.request').setLevel(logging.ERROR)
+
+        suites = options['suite'] or self.default_suites
+        if {'memory', 'stop', 'startup'}.intersection(suites) and options['fake_redis']:
+            raise CommandError('The memory, stop and startup suites need a real redis server')
+
+        results = {}
+        if 'endpoints' in suites:
+            results['endpoints'] = self._run_endpoints(options)
+        if 'parsing' in suites:
+            results['parsing'] = ParsingBenchmark().run()
+        if 'load' in suites:
+            results['load'] = LoadBenchmark(
+                options['url'],
+                requests=options['requests'],
+                concurrency=options['concurrency'],
+                seed=options['seed'],
+            ).run()
+        if 'memory' in suites:
+            results['memory'] = MemoryBenchmark(senders=options['senders']).run()
+        if 'stop' in suites:
+            results['stop'] = StopStoreBenchmark(pairs=options['pairs']).run()
+        if 'startup' in suites:
+            results['startup'] = StartupBenchmark(runs=options['runs']).run()
+        if 'codec' in suites:
+            results['codec'] = CodecBenchmark().run()
+        if 'stack' in suites:
+            results['stack'] = self._run_stack(options)
+        if 'dispatch' in suites:
+            results['dispatch'] = DispatchBenchmark(messages=options['messages']).run()
+        if 'db' in suites:
+            results['db'] = DBPoolBenchmark(
+                requests=options['requests'],
+                concurrency=options['db_concurrency'],
+            ).run()
+
+        output = report(results, {
+            name: options[name]
+            for name in (
+                'suite', 'requests', 'warmup', 'mix', 'numbers', 'seed',
+                'fake_redis', 'url', 'concurrency', 'senders', 'pairs', 'runs',
+                'db_concurrency', 'messages'
+            )
+        })
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,62 @@
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand
+
+from utils.caches import PROD_REDIS_URL, RedisConnection
+
+from ...constants import DISPATCH_BATCH_SIZE, DISPATCH_CONCURRENCY
+from ...dispatch import Dispatcher
+
+
+def _dispatch(url, concurrency, batch_size, stop):
+    dispatcher = Dispatcher(
+        RedisConnection.get_connection(url),
+        concurrency=concurrency,
+        batch_size=batch_size,
+    )
+    try:
+        dispatcher.run(stop.is_set)
+    finally:
+        dispatcher.close()
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Sends the queued outbound sms to their carriers from a pool of '
+        'worker processes, each of them a consumer of the queue, until '
+        'stopped with SIGTERM or SIGINT.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument(
+            '--concurrency', type=int, default=DISPATCH_CONCURRENCY,
+            help='Carrier batches every process sends at once'
+        )
+        parser.add_argument('--batch-size', type=int, default=DISPATCH_BATCH_SIZE)
+        parser.add_argument('--redis-url', default=PROD_REDIS_URL)
+
+    def handle(self, *args, **options):
+        # Workers inherit the app as set up by this process
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: stop.set())
+
+        worker_args = (
+            options['redis_url'], options['concurrency'], options['batch_size'], stop
+        )
+        if options['processes'] == 1:
+            _dispatch(*worker_args)
+            return
+
+        workers = [
+            context.Process(target=_dispatch, args=worker_args)
+            for i in range(options['processes'])
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
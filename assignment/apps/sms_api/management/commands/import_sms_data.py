@@ -0,0 +1,62 @@
+import io
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.caches import PROD_REDIS_URL, RedisConnection
+
+from ...constants import IMPORT_BATCH_SIZE
+from ...importer import IMPORTERS, ImportFormat, read_rows
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Imports accounts, or phone numbers of existing accounts, from a CSV '
+        'file with a header line or a file of one JSON object per line, in '
+        'batches, reporting progress after every batch. Accounts are '
+        'updated by id, numbers an account has already are skipped. Use - '
+        'as the file to read stdin.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=list(IMPORTERS))
+        parser.add_argument('file')
+        parser.add_argument(
+            '--format', choices=[ImportFormat.CSV, ImportFormat.NDJSON],
+            help='Taken from the extension of the file when not given'
+        )
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+        parser.add_argument('--redis-url', default=PROD_REDIS_URL)
+
+    def _format(self, options):
+        if options['format']:
+            return options['format']
+        for fmt in (ImportFormat.CSV, ImportFormat.NDJSON):
+            if options['file'].endswith('.' + fmt):
+                return fmt
+        raise CommandError('--format is needed for %s' % options['file'])
+
+    def _progress(self, stats):
+        self.stdout.write(
+            '%(rows)d rows read, %(written)d written, %(skipped)d skipped, '
+            '%(invalid)d invalid, %(rows_per_second)d rows/s' % stats
+        )
+
+    def handle(self, *args, **options):
+        fmt = self._format(options)
+        importer = IMPORTERS[options['kind']](
+            batch_size=options['batch_size'],
+            connection=RedisConnection.get_connection(options['redis_url']),
+        )
+        if options['file'] == '-':
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+        else:
+            try:
+                stream = open(options['file'], encoding='utf-8', newline='')
+            except OSError as e:
+                raise CommandError(e)
+        with stream:
+            stats = importer.run(read_rows(stream, fmt), progress=self._progress)
+        self.stdout.write(json.dumps(stats))
@@ -0,0 +1,28 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.caches import PROD_REDIS_URL, RedisConnection
+
+from ...utils import OutboundSMSCounter
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Folds the outbound counters kept under their name from before the '
+        'pluggable limits into the fixed window counters, so that no sender '
+        'starts over from zero. Run on deploy, see OutboundSMSCounter.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=PROD_REDIS_URL)
+        parser.add_argument('--batch', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        store = OutboundSMSCounter(RedisConnection.get_connection(options['url']))
+        try:
+            migrated = store.migrate_legacy_keys(batch=options['batch'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(json.dumps({'migrated': migrated}))
@@ -0,0 +1,49 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.caches import RedisConnection
+from utils.sharding import Rebalancer, ShardedRedis
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Moves the keys of the --from redis nodes to where the --to nodes '
+        'expect them. Run it with --keep-source before the workers switch to '
+        'the new nodes, and without it after, see utils.sharding.Rebalancer.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from', dest='source', required=True,
+            help='Comma separated urls of the nodes the keys are on'
+        )
+        parser.add_argument(
+            '--to', dest='target', required=True,
+            help='Comma separated urls of the nodes the keys go to'
+        )
+        parser.add_argument('--keep-source', action='store_true')
+        parser.add_argument('--match', help='Only move keys matching this pattern')
+        parser.add_argument('--batch', type=int, default=1000)
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the keys that would move'
+        )
+
+    def _sharded(self, urls):
+        urls = [url for url in urls.split(',') if url]
+        if not urls:
+            raise CommandError('No redis url given')
+        return ShardedRedis([(url, RedisConnection.get_connection(url)) for url in urls])
+
+    def handle(self, *args, **options):
+        stats = Rebalancer(
+            self._sharded(options['source']),
+            self._sharded(options['target']),
+            keep_source=options['keep_source'],
+            match=options['match'],
+            dry_run=options['dry_run'],
+            batch=options['batch'],
+        ).run()
+        self.stdout.write(json.dumps(stats))
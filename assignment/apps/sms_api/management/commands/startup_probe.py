@@ -0,0 +1,57 @@
+import base64
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import setup_test_environment
+from rest_framework import status
+
+from utils.caches import TEST_REDIS_URL
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Times the first requests of a fresh process, optionally warmed up '
+        'like a uwsgi worker, and prints them as JSON. Run by the startup '
+        'suite of benchmark_sms, every run needs a process of its own.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--warm', action='store_true')
+        parser.add_argument('--requests', type=int, default=5)
+        parser.add_argument('--url', required=True, help='Path of the inbound endpoint')
+        parser.add_argument('--username', required=True)
+        parser.add_argument('--password', required=True)
+        parser.add_argument('--number', required=True)
+
+    def handle(self, *args, **options):
+        # Importing anything of the app here would warm the cold runs up
+        try:
+            setup_test_environment()
+        except RuntimeError:
+            # Already set up, when run by the test runner
+            pass
+        warmup = None
+        if options['warm']:
+            from ...warmup import warm_up
+            warmup = warm_up(TEST_REDIS_URL)
+
+        credentials = '%s:%s' % (options['username'], options['password'])
+        client = Client(
+            HTTP_AUTHORIZATION='Basic %s' % base64.b64encode(credentials.encode()).decode()
+        )
+        latencies = []
+        for i in range(options['requests']):
+            data = json.dumps({
+                'from': '9%09d' % i, 'to': options['number'], 'text': 'hola',
+                'integration_test': True,
+            })
+            start = time.perf_counter()
+            response = client.post(options['url'], data, content_type='application/json')
+            latencies.append(time.perf_counter() - start)
+            if not status.is_success(response.status_code):
+                raise RuntimeError('%s answered %s' % (options['url'], response.status_code))
+
+        self.stdout.write(json.dumps({'warmup': warmup, 'latencies': latencies}))
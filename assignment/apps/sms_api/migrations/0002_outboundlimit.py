@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundLimit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(blank=True, default=None, max_length=40, null=True)),
+                ('limit', models.PositiveIntegerField()),
+                ('window', models.PositiveIntegerField(help_text='seconds')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sms_api.Account')),
+            ],
+            options={
+                'db_table': 'outbound_limit',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='outboundlimit',
+            unique_together=set([('account', 'number')]),
+        ),
+    ]
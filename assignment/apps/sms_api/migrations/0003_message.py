@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from apps.sms_api.constants import MESSAGE_PARTITIONS_PG_VERSION
+
+
+"""
+On Postgres, 11 or later, the message table is partitioned by range of
+created_at, which Django can not create. Its primary key has to include
+the partition key. Monthly partitions are created by
+Message.ensure_partitions as rows come in, the default partition takes
+rows of months that have none. Older servers get a plain table.
+"""
+PARTITIONED_TABLE = [
+    """
+    CREATE TABLE message (
+        id bigserial NOT NULL,
+        sms_type varchar(8) NOT NULL,
+        account_id integer NOT NULL,
+        sms_from varchar(40) NOT NULL,
+        sms_to varchar(40) NOT NULL,
+        text varchar(120) NOT NULL,
+        created_at timestamp with time zone NOT NULL,
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+    """,
+    'CREATE INDEX message_account_id_created_at ON message (account_id, created_at)',
+    'CREATE TABLE message_default PARTITION OF message DEFAULT',
+]
+
+
+def create_message(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql' and \
+            connection.pg_version >= MESSAGE_PARTITIONS_PG_VERSION:
+        for sql in PARTITIONED_TABLE:
+            schema_editor.execute(sql)
+    else:
+        schema_editor.create_model(apps.get_model('sms_api', 'Message'))
+
+
+def drop_message(apps, schema_editor):
+    schema_editor.delete_model(apps.get_model('sms_api', 'Message'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms_api', '0002_outboundlimit'),
+    ]
+
+    state_operations = [
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('sms_type', models.CharField(max_length=8)),
+                ('sms_from', models.CharField(max_length=40)),
+                ('sms_to', models.CharField(max_length=40)),
+                ('text', models.CharField(max_length=120)),
+                ('created_at', models.DateTimeField()),
+                ('account', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='sms_api.Account')),
+            ],
+            options={
+                'db_table': 'message',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('account', 'created_at')]),
+        ),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(state_operations=state_operations),
+        migrations.RunPython(create_message, drop_message),
+    ]
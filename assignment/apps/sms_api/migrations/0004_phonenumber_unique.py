@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+logger = logging.getLogger(__name__)
+
+
+def remove_duplicate_numbers(apps, schema_editor):
+    """
+    The constraint can not be added while an account has a number more
+    than once, only the first row of every such pair is kept. No table
+    references phone numbers, and both rows meant the same.
+    """
+    PhoneNumber = apps.get_model('sms_api', 'PhoneNumber')
+    numbers = PhoneNumber.objects.using(schema_editor.connection.alias)
+    duplicates = numbers.values('account_id', 'number') \
+        .annotate(first=Min('id'), rows=Count('id')).filter(rows__gt=1)
+    removed = 0
+    for pair in duplicates.iterator():
+        removed += numbers.filter(account_id=pair['account_id'], number=pair['number']) \
+            .exclude(id=pair['first']).delete()[0]
+    if removed:
+        logger.warning('Removed %d duplicate phone numbers', removed)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms_api', '0003_message'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_numbers, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='phonenumber',
+            unique_together=set([('account', 'number')]),
+        ),
+    ]
@@ -1,4 +1,17 @@
-from django.db import models
+import csv
+import io
+
+from django.db import connections, models
+from django.utils import timezone
+from redis import RedisError
+
+from utils.db.routers import PRIMARY_DB, reads_from_replica
+from utils.writebehind import WriteBehindBuffer
+
+from .constants import MESSAGE_BUFFER_MAX_SIZE, MESSAGE_FLUSH_INTERVAL
+from .constants import MESSAGE_FLUSH_SIZE, MESSAGE_PARTITIONS_AHEAD
+from .constants import MESSAGE_PARTITIONS_PG_VERSION
+from .utils import PhoneNumberIndex, outbound_limit_cache
 
 # Create your models here.
 
@@ -30,7 +43,246 @@ class PhoneNumber(models.Model):
 
     class Meta:
         db_table = 'phone_number'
+        unique_together = ('account', 'number')
+
+    @classmethod
+    def number_exists(cls, account_id, number, connection=None, db_fallback=True):
+        """
+        Ownership is answered from the per account PhoneNumberIndex in redis,
+        unknown numbers included. The DB is only queried to load the index of
+        an account, or when redis is unavailable. Loads read the primary, as
+        the index keeps them for an hour, a number missing from a lagging
+        replica would be missing that long. For the same reason a load is
+        dropped when the numbers of the account changed while it read them.
+
+        params:
+            account_id, type int
+            number, type string
+            redis connection, type StrictRedis
+            db_fallback, False to raise the RedisError instead, type bool
+        return:
+            type bool
+        """
+        index = PhoneNumberIndex(connection)
+        try:
+            exists = index.contains(account_id, number)
+            if exists is None:
+                numbers = cls._account_numbers(account_id)
+                index.load(account_id, numbers, index.version)
+                exists = number in numbers
+            return exists
+        except RedisError:
+            if not db_fallback:
+                raise
+            return bool(cls._owned_in_db(account_id, [number]))
+
+    @classmethod
+    def numbers_owned(cls, account_id, numbers, connection=None):
+        """
+        Bulk variant of number_exists, costing one redis round trip or at
+        most one DB query.
+
+        params:
+            account_id, type int
+            numbers, type list(string)
+            redis connection, type StrictRedis
+        return:
+            the owned subset of numbers, type set
+        """
+        numbers = list(set(numbers))
+        index = PhoneNumberIndex(connection)
+        try:
+            owned = index.contains_many(account_id, numbers)
+            if owned is None:
+                account_numbers = cls._account_numbers(account_id)
+                index.load(account_id, account_numbers, index.version)
+                owned = account_numbers.intersection(numbers)
+            return owned
+        except RedisError:
+            return cls._owned_in_db(account_id, numbers)
+
+    @classmethod
+    def _account_numbers(cls, account_id):
+        return set(
+            cls.objects.using(PRIMARY_DB).filter(account_id=account_id)
+            .values_list('number', flat=True)
+        )
+
+    @classmethod
+    def _owned_in_db(cls, account_id, numbers):
+        """Numbers not found on a replica are looked up again on the
+        primary, they may have been added too recently to be there."""
+        owned = set(
+            cls.objects.filter(account_id=account_id, number__in=numbers)
+            .values_list('number', flat=True)
+        )
+        missing = set(numbers) - owned
+        if missing and reads_from_replica(cls):
+            owned.update(
+                cls.objects.using(PRIMARY_DB)
+                .filter(account_id=account_id, number__in=missing)
+                .values_list('number', flat=True)
+            )
+        return owned
+
+
+class OutboundLimit(models.Model):
+    """
+    Overrides MAX_OUTBOUND_SMS_PER_NUMBER and its window for the numbers of
+    an account, or for a single number of it. A number specific row wins
+    over the account wide one, which has no number.
+    """
+
+    account = models.ForeignKey(Account)
+    number = models.CharField(default=None, max_length=40, null=True, blank=True)
+    limit = models.PositiveIntegerField()
+    window = models.PositiveIntegerField(help_text='seconds')
+
+    class Meta:
+        db_table = 'outbound_limit'
+        unique_together = ('account', 'number')
+
+    @classmethod
+    def limit_for(cls, account_id, number):
+        """
+        The overrides of an account are read in one query and kept in the
+        outbound_limit_cache of the worker, unless they were invalidated
+        while they were read.
+
+        params:
+            account_id, type int
+            number, type string
+        return:
+            (limit, window), (None, None) when the defaults apply
+        """
+        key = outbound_limit_cache.generate_key([account_id])
+        limits = outbound_limit_cache.get(key)
+        if limits is None:
+            generation = outbound_limit_cache.generation
+            limits = {
+                row_number: (limit, window)
+                for row_number, limit, window in
+                cls.objects.filter(account_id=account_id)
+                .values_list('number', 'limit', 'window')
+            }
+            outbound_limit_cache.set_if_current(key, limits, generation)
+        return limits.get(number) or limits.get(None) or (None, None)
+
+
+class Message(models.Model):
+    """
+    Every accepted sms, written behind the requests by message_log. On
+    Postgres, 11 or later, the table is partitioned by month of created_at,
+    see migration 0003, rows of months without a partition of their own go
+    to message_default. Rows are written with COPY on Postgres, whatever
+    its version, and bulk_create elsewhere.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    sms_type = models.CharField(max_length=8)
+    account = models.ForeignKey(Account, db_constraint=False)
+    sms_from = models.CharField(max_length=40)
+    sms_to = models.CharField(max_length=40)
+    text = models.CharField(max_length=120)
+    created_at = models.DateTimeField()
+
+    columns = ('sms_type', 'account_id', 'sms_from', 'sms_to', 'text', 'created_at')
+
+    # Months this process has made sure have a partition
+    _partitions = set()
+
+    class Meta:
+        db_table = 'message'
+        index_together = [('account', 'created_at')]
+
+    @classmethod
+    def row(cls, sms_type, account_id, sms):
+        """
+        params:
+            sms_type, type string
+            account_id, type int
+            sms, type SMSData
+        return:
+            values of columns, type tuple
+        """
+        return (
+            sms_type, account_id, sms.sms_from, sms.sms_to, sms.sms_text,
+            timezone.now()
+        )
+
+    @staticmethod
+    def _next_month(month):
+        year, month = month
+        return (year + 1, 1) if month == 12 else (year, month + 1)
+
+    @staticmethod
+    def is_partitioned(connection):
+        return connection.vendor == 'postgresql' and \
+            connection.pg_version >= MESSAGE_PARTITIONS_PG_VERSION
+
+    @classmethod
+    def ensure_partitions(cls, months, connection):
+        """
+        Creates the partitions of the given months and of the
+        MESSAGE_PARTITIONS_AHEAD months following the latest of them.
+
+        params:
+            months, type set(tuple(year, month))
+            connection, type DatabaseWrapper
+        """
+        if not cls.is_partitioned(connection):
+            cls._partitions.update(months)
+            return
+        months = set(months)
+        ahead = max(months)
+        for i in range(MESSAGE_PARTITIONS_AHEAD):
+            ahead = cls._next_month(ahead)
+            months.add(ahead)
+        with connection.cursor() as cursor:
+            for year, month in sorted(months - cls._partitions):
+                following = cls._next_month((year, month))
+                cursor.execute(
+                    'CREATE TABLE IF NOT EXISTS message_%04d%02d PARTITION OF message '
+                    'FOR VALUES FROM (%%s) TO (%%s)' % (year, month),
+                    ['%04d-%02d-01' % (year, month), '%04d-%02d-01' % following]
+                )
+        cls._partitions.update(months)
+
+    @classmethod
+    def _copy(cls, rows, connection):
+        data = io.StringIO()
+        csv.writer(data).writerows(rows)
+        data.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                'COPY message (%s) FROM STDIN WITH (FORMAT csv)' % ', '.join(cls.columns),
+                data
+            )
 
     @classmethod
-    def number_exists(cls, account_id, number):
-        return cls.objects.filter(account_id=account_id, number=number).exists() 
+    def bulk_insert(cls, rows):
+        """
+        params:
+            values of columns, type list(tuple)
+        """
+        connection = connections[PRIMARY_DB]
+        try:
+            months = {(row[-1].year, row[-1].month) for row in rows}
+            if not months.issubset(cls._partitions):
+                cls.ensure_partitions(months, connection)
+            if connection.vendor == 'postgresql':
+                cls._copy(rows, connection)
+            else:
+                cls.objects.using(PRIMARY_DB).bulk_create(
+                    [cls(**dict(zip(cls.columns, row))) for row in rows]
+                )
+        finally:
+            # Back to the pool, the writer thread only needs it now and then
+            if not connection.in_atomic_block:
+                connection.close()
+
+
+message_log = WriteBehindBuffer(
+    Message.bulk_insert, 'message', max_size=MESSAGE_FLUSH_SIZE,
+    interval=MESSAGE_FLUSH_INTERVAL, max_pending=MESSAGE_BUFFER_MAX_SIZE
+)
@@ -1,4 +1,8 @@
-from rest_framework import serializers
+from collections import OrderedDict
+
+from rest_framework import fields, serializers
+
+from .constants import FIELD_REQUIRED_MESSAGE, SERIALIZER_FIELD_PREFIX
 
 
 class SMSData(object):
@@ -16,3 +20,65 @@ class SMSDataSerializer(serializers.Serializer):
 
     def create(self, validated_data):
         return SMSData(**validated_data)
+
+
+class SMSDataParser(object):
+    """
+    A lean stand in for SMSDataSerializer on the single message path. It
+    reads the unprefixed fields straight from the request data, in one pass
+    and without copying it, and applies the rules of the serializer fields:
+    only strings and numbers are accepted, whitespace is trimmed, blank or
+    null values are invalid and lengths are bounded.
+
+    The rules are compiled once from SMSDataSerializer, and errors come out
+    in its field order, so _process_validation_errors reports exactly the
+    error the serializer would have led to.
+    """
+
+    INVALID = ['invalid']
+    _missing = object()
+    _prohibit_null_characters = \
+        getattr(fields, 'ProhibitNullCharactersValidator', None) is not None
+
+    _rules = [
+        (
+            name,
+            name[len(SERIALIZER_FIELD_PREFIX):],
+            field.min_length or 0,
+            field.max_length or float('inf'),
+            field.trim_whitespace,
+        )
+        for name, field in SMSDataSerializer().fields.items()
+    ]
+
+    @classmethod
+    def parse(cls, data):
+        """
+        params:
+            unprefixed request data, type dict
+        return:
+            SMSData or None, errors keyed by prefixed field name, type tuple
+        """
+        values = {}
+        errors = OrderedDict()
+        for name, key, min_length, max_length, trim in cls._rules:
+            value = data.get(key, cls._missing)
+            if value is cls._missing:
+                errors[name] = [FIELD_REQUIRED_MESSAGE]
+                continue
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                errors[name] = cls.INVALID
+                continue
+
+            value = str(value)
+            if trim:
+                value = value.strip()
+            if not min_length <= len(value) <= max_length or not value or \
+                    (cls._prohibit_null_characters and '\x00' in value):
+                errors[name] = cls.INVALID
+                continue
+            values[name] = value
+
+        if errors:
+            return None, errors
+        return SMSData(**values), errors
@@ -0,0 +1,93 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from redis import RedisError
+
+from utils.db.routers import PRIMARY_DB
+
+from .models import Account, OutboundLimit, PhoneNumber
+from .utils import PhoneNumberIndex, account_cache, api_connection
+from .utils import outbound_limit_cache
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_account_cache(sender, instance, using, **kwargs):
+    """Once the change is committed, a request reading the account before
+    that could cache it again otherwise, and in every worker."""
+    account_id = instance.pk
+
+    def invalidate():
+        account_cache.invalidate_account(instance)
+        try:
+            account_cache.publish(api_connection(), [account_id])
+        except RedisError:
+            logger.exception('Could not publish the invalidation of account %s', account_id)
+
+    transaction.on_commit(invalidate, using=using)
+
+
+@receiver(post_save, sender=OutboundLimit)
+@receiver(post_delete, sender=OutboundLimit)
+def invalidate_outbound_limit_cache(sender, instance, using, **kwargs):
+    """Once the change is committed, and in every worker, as for accounts."""
+    account_id = instance.account_id
+
+    def invalidate():
+        try:
+            outbound_limit_cache.publish(api_connection(), [account_id])
+        except RedisError:
+            logger.exception(
+                'Could not publish the invalidation of the limits of account %s', account_id
+            )
+
+    transaction.on_commit(invalidate, using=using)
+
+
+@receiver(pre_save, sender=PhoneNumber)
+def remember_previous_phone_number(sender, instance, **kwargs):
+    """An update can move a number to another account or rename it, so we
+    keep the stored row around to fix the index of the old owner."""
+    instance._index_previous = None
+    if instance.pk:
+        instance._index_previous = (
+            PhoneNumber.objects.using(PRIMARY_DB).filter(pk=instance.pk)
+            .values_list('account_id', 'number')
+            .first()
+        )
+
+
+@receiver(post_save, sender=PhoneNumber)
+def add_to_phone_number_index(sender, instance, using, **kwargs):
+    """The index is updated once the number is committed, a rolled back
+    save must not leave it there."""
+    previous = getattr(instance, '_index_previous', None)
+    current = (instance.account_id, instance.number)
+
+    def update():
+        try:
+            index = PhoneNumberIndex(api_connection())
+            if previous and previous != current:
+                index.remove(*previous)
+            index.add(*current)
+        except RedisError:
+            logger.exception('Could not update the phone number index')
+
+    transaction.on_commit(update, using=using)
+
+
+@receiver(post_delete, sender=PhoneNumber)
+def remove_from_phone_number_index(sender, instance, using, **kwargs):
+    current = (instance.account_id, instance.number)
+
+    def update():
+        try:
+            PhoneNumberIndex(api_connection()).remove(*current)
+        except RedisError:
+            logger.exception('Could not update the phone number index')
+
+    transaction.on_commit(update, using=using)
@@ -1,18 +1,78 @@
 import base64
+import datetime
+import hashlib
+import io
+import ipaddress
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.signals import request_started
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.conf import settings
+from django.db import connections, transaction
+from django.test import TestCase, override_settings
+from prometheus_client import REGISTRY
+from redis import ConnectionError, ResponseError
 
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase
 from rest_framework import HTTP_HEADER_ENCODING, status
 
+from utils import metrics
 from utils.api_client import RequestType
-from utils.caches import RedisConnection, TEST_REDIS_URL
+from utils.caches import FixedWindowRateLimiter, RATE_LIMITERS, RateLimitStatus
+from utils.caches import BASE_REDIS_URL, CircuitBreaker, CircuitOpenError
+from utils.caches import LocalRateLimiter, MeteredConnectionPool, RedisConnection
+from utils.caches import TEST_REDIS_URL
+from utils.db import routers
+from utils.db.pool import ConnectionPool, PoolTimeout
+from utils.db.routers import PRIMARY_DB, ReplicaRouter
+from utils.fastjson import EncodedBody, FastJSONParser, FastJSONRenderer
+from utils.sharding import CrossShardError, HashRing, Rebalancer, ShardedRedis
+from utils.writebehind import WriteBehindBuffer
 
-from .constants import MAX_OUTBOUND_SMS_PER_NUMBER
-from .models import Account, PhoneNumber
+from .authentication import AccountBasicAuthentication
+from .carriers import StubCarrier, carrier_for
+from .constants import DEGRADED_WORKERS, DegradedStopPolicy
+from .constants import MAX_OUTBOUND_SMS_PER_NUMBER, STOP_NEAR_CACHE_TTL
+from .dispatch import Dispatcher
+from .models import Account, Message, OutboundLimit, PhoneNumber, message_log
+from .serializers import SMSDataParser, SMSDataSerializer
 from .tests_config import Legend, unit_test_config
 from .tests_config import test_accounts, test_phone_numbers
+from .utils import IdempotencyStore, OutboundSMSCounter, PhoneNumberIndex, QuotaUsage
+from .utils import StopRequestStore
+from .utils import AccountCache, OutboundLimitCache, OutboundSMSQueue, StopRequestNearCache
+from .utils import account_cache
+from .utils import api_connection
+from .utils import dispatch_buffer
+from .utils import local_outbound_limiter, outbound_limit_cache
+from .views import BaseView, CONSTANT_BODIES
+from .warmup import prime_caches, warm_up
+
+
+def run_commit_hooks():
+    """A TestCase never commits, the on_commit callbacks registered so far
+    are run as if it did."""
+    connection = connections[PRIMARY_DB]
+    hooks, connection.run_on_commit = connection.run_on_commit, []
+    for sids, hook in hooks:
+        hook()
+
+
+def wait_until(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
 
 
 class UnitTestCase(TestCase):
@@ -48,6 +108,680 @@ class UnitTestCase(TestCase):
                     callback(res, exp)
                 print(method[Legend.MN], ' is OK')
 
+class FastJSONTestCase(TestCase):
+
+    def test_fast_json(self):
+        bodies = [
+            {"error": "", "message": "inbound sms ok"},
+            {"error": "", "message": "ok", "results": [{"status": 202, "text": "h\u00f3la \u20ac"}]},
+            [1, 2.5, None, True, "\n"],
+        ]
+        for body in bodies:
+            encoded = FastJSONRenderer().render(body)
+            assert encoded == JSONRenderer().render(body)
+            parsed = FastJSONParser().parse(io.BytesIO(encoded))
+            assert parsed == JSONParser().parse(io.BytesIO(encoded)) == body
+
+        # Datetimes and keys that are not strings come out as DRF writes them
+        body = {
+            1: datetime.datetime(2024, 1, 2, 3, 4, 5, 123456, tzinfo=datetime.timezone.utc),
+            2.5: datetime.datetime(2024, 1, 2, 3, 4, 5),
+            None: datetime.date(2024, 1, 2),
+            "time": datetime.time(1, 2, 3, 456789),
+        }
+        encoded = FastJSONRenderer().render(body)
+        assert encoded == JSONRenderer().render(body)
+        assert b'"2024-01-02T03:04:05.123456Z"' in encoded
+
+        body = EncodedBody(error="", message="inbound sms ok")
+        body.encoded = b'cached'
+        assert FastJSONRenderer().render(body) == b'cached'
+        assert all(
+            body.encoded == JSONRenderer().render(dict(body)) for body in CONSTANT_BODIES.values()
+        )
+
+        # Constant responses are rendered from CONSTANT_BODIES
+        response = BaseView()._unavailable_response()
+        assert response.data is CONSTANT_BODIES[("temporarily unavailable, retry later", "")]
+        assert BaseView()._error_response("limit reached for from 1234567").data == \
+            {"error": "limit reached for from 1234567", "message": ""}
+
+        print('test_fast_json is OK')
+
+
+class SMSDataParserTestCase(TestCase):
+
+    payloads = [
+        {},
+        {'from': '1234567'},
+        {'to': '1234567', 'text': 'hola'},
+        {'from': '12', 'to': '1234567', 'text': 'hola'},
+        {'from': '1234567', 'to': '12', 'text': ''},
+        {'from': 1234567, 'to': 7654321.0, 'text': 'hola'},
+        {'from': True, 'to': None, 'text': ['hola']},
+        {'from': '  1234567  ', 'to': '1234567', 'text': '   '},
+        {'from': '1' * 17, 'to': '1234567', 'text': 'h' * 121},
+        {'from': '1234567', 'to': '7654321', 'text': ' STOP\r\n', 'integration_test': True},
+    ]
+
+    def test_same_result_as_serializer(self):
+        view = BaseView()
+        for payload in self.payloads:
+            serializer = SMSDataSerializer(data=view._format_data(payload))
+            sms, errors = SMSDataParser.parse(payload)
+
+            if serializer.is_valid():
+                expected = serializer.save()
+                assert not errors
+                assert vars(sms) == vars(expected)
+            else:
+                assert sms is None
+                expected = view._process_validation_errors(serializer.errors)
+                actual = view._process_validation_errors(errors)
+                assert actual.data == expected.data
+                assert list(errors) == list(serializer.errors)
+
+        print('test_same_result_as_serializer is OK')
+
+class CachesTestCase(TestCase):
+
+    def setUp(self):
+        # The scripts run on one node, see ShardingTestCase for several
+        self.url = TEST_REDIS_URL.split(',')[0]
+        self.connection = RedisConnection.get_connection(self.url)
+
+    def _limiter(self, limiter_class):
+        limiter_class = type('Test' + limiter_class.__name__, (limiter_class,), {
+            'limit': MAX_OUTBOUND_SMS_PER_NUMBER, 'ttl': 24*60*60
+        })
+        return limiter_class(self.connection)
+
+    def test_rate_limiter(self):
+        for algorithm, limiter_class in RATE_LIMITERS.items():
+            store = self._limiter(limiter_class)
+            key = 'ratelimit_%s' % algorithm
+
+            for i in range(MAX_OUTBOUND_SMS_PER_NUMBER):
+                rate_limit = store.hit(key)
+                assert rate_limit.allowed, algorithm
+                assert rate_limit.remaining == MAX_OUTBOUND_SMS_PER_NUMBER - i - 1, algorithm
+                assert 0 < rate_limit.reset <= store.ttl, algorithm
+
+            rate_limit = store.hit(key)
+            assert not rate_limit.allowed, algorithm
+            assert rate_limit.remaining == 0, algorithm
+
+            # Limits can be overridden per hit
+            key = 'ratelimit_override_%s' % algorithm
+            assert store.hit(key, limit=2, window=60).allowed, algorithm
+            assert store.hit(key, limit=2, window=60).allowed, algorithm
+            assert not store.hit(key, limit=2, window=60).allowed, algorithm
+            assert 0 < self.connection.pttl(key) <= 2*60*1000, algorithm
+
+        store = self._limiter(FixedWindowRateLimiter)
+        assert int(store.get('ratelimit_fixed_window')) == MAX_OUTBOUND_SMS_PER_NUMBER
+
+        print('test_rate_limiter is OK')
+
+    def test_rate_limiter_guards(self):
+        for algorithm, limiter_class in RATE_LIMITERS.items():
+            self.connection.flushdb()
+            store = self._limiter(limiter_class)
+            key = 'ratelimit_%s' % algorithm
+            index = PhoneNumberIndex(self.connection)
+            member_of = (PhoneNumberIndex.generate_key([1]), '1111111')
+            blocked_by = ['blocker']
+
+            rate_limit = store.hit(key, member_of=member_of)
+            assert rate_limit.status == RateLimitStatus.MEMBERSHIP_UNKNOWN
+
+            index.load(1, ['2222222'])
+            rate_limit = store.hit(key, member_of=member_of)
+            assert rate_limit.status == RateLimitStatus.NOT_MEMBER
+
+            index.add(1, '1111111')
+            self.connection.set('blocker', 1)
+            rate_limit = store.hit(key, member_of=member_of, blocked_by=blocked_by)
+            assert rate_limit.status == RateLimitStatus.BLOCKED
+            assert not self.connection.exists(key)
+
+            self.connection.delete('blocker')
+            rate_limit = store.hit(key, member_of=member_of, blocked_by=blocked_by)
+            assert rate_limit.allowed
+            assert self.connection.exists(key)
+            if algorithm == 'fixed_window':
+                assert int(store.get(key)) == 1
+
+        print('test_rate_limiter_guards is OK')
+
+    def test_quota_usage(self):
+        quota = QuotaUsage(self.connection)
+        for account_id, (algorithm, limiter_class) in enumerate(RATE_LIMITERS.items()):
+            store = self._limiter(limiter_class)
+            key = 'ratelimit_%s' % algorithm
+            usage = QuotaUsage.usage(account_id, '1111111')
+
+            # Only recorded hits leave their quota
+            self.connection.set('blocker', 1)
+            store.hit(key, blocked_by=['blocker'], usage=usage)
+            assert quota.read(account_id) == {}, algorithm
+            self.connection.delete('blocker')
+
+            store.hit(key, usage=usage)
+            rate_limit = store.hit(key, blocked_by=['blocker'], usage=usage)
+            limit, remaining, reset = quota.read(account_id)['1111111']
+            assert (limit, remaining) == (MAX_OUTBOUND_SMS_PER_NUMBER, rate_limit.remaining), algorithm
+            assert abs(reset - rate_limit.reset) <= 1, algorithm
+            assert 0 < self.connection.ttl(usage[0]) <= store.ttl, algorithm
+
+            rate_limit = store.hit(key + '_2', limit=5, window=60)
+            quota.record(account_id, [('2222222', 5, rate_limit)])
+            assert quota.read(account_id)['2222222'][:2] == (5, 4), algorithm
+            assert len(quota.read(account_id)) == 2
+            assert quota.read(account_id, now=int(time.time()) + store.ttl + 1) == {}
+
+        print('test_quota_usage is OK')
+
+    def test_stop_request_store(self):
+        store = StopRequestStore(self.connection)
+
+        # Pairs joining to the same digits do not share a key any more
+        assert StopRequestStore.generate_legacy_key(['12', '345']) == \
+            StopRequestStore.generate_legacy_key(['123', '45'])
+        assert StopRequestStore.generate_key(['12', '345']) != \
+            StopRequestStore.generate_key(['123', '45'])
+        assert StopRequestStore.pack_number('0012') != StopRequestStore.pack_number('012')
+        assert StopRequestStore.pack_number('123') == b'\x12\x3f'
+
+        key, field = StopRequestStore.generate_key(['1111111', '2222222'])
+        assert store.add((key, field)) == 1
+        assert store.add((key, field)) == 0
+        assert store.is_stopped(['1111111', '2222222'])
+        assert not store.is_stopped(['2222222', '1111111'])
+        assert 0 < self.connection.ttl(key) <= StopRequestStore.ttl
+
+        # An expired pair is not honoured and gets dropped when read
+        self.connection.hset(key, field, 1)
+        assert not store.is_stopped(['1111111', '2222222'])
+        assert not self.connection.hexists(key, field)
+
+        self.connection.set(StopRequestStore.generate_legacy_key(['1111111', '2222222']), 1)
+        assert store.is_stopped(['1111111', '2222222'])
+
+        print('test_stop_request_store is OK')
+
+    def test_stop_request_near_cache(self):
+        pair = ['1111111', '2222222']
+        key = StopRequestStore.generate_key(pair)
+        worker1, worker2 = StopRequestNearCache(), StopRequestNearCache()
+        store1 = StopRequestStore(self.connection, worker1)
+        store2 = StopRequestStore(self.connection, worker2)
+
+        assert not store1.is_stopped(pair)
+        assert not store2.is_stopped(pair)
+        assert worker1.get(key) is False
+
+        # A STOP recorded by one worker reaches the other well within the ttl
+        store2.add(key)
+        assert store2.is_stopped(pair)
+        wait_until(lambda: worker1.get(key) is None, STOP_NEAR_CACHE_TTL)
+        assert store1.is_stopped(pair)
+
+        # Without invalidation messages, the ttl bounds the delay
+        worker3 = StopRequestNearCache(ttl=0.2)
+        worker3.listen = lambda connection: None
+        store3 = StopRequestStore(self.connection, worker3)
+        pair = ['3333333', '2222222']
+        assert not store3.is_stopped(pair)
+        store2.add(StopRequestStore.generate_key(pair))
+        assert not store3.is_stopped(pair)
+        wait_until(lambda: store3.is_stopped(pair), 0.5)
+
+        # A read overtaken by an invalidation is not cached
+        generation = worker3.generation
+        worker3.invalidate(key)
+        worker3.set_if_current(key, False, generation)
+        assert worker3.get(key) is None
+
+        print('test_stop_request_near_cache is OK')
+
+    def test_account_cache_invalidation(self):
+        worker1, worker2 = AccountCache(), AccountCache()
+        worker1.listen(self.connection)
+        worker2.listen(self.connection)
+        account = Account(id=1, username='user1', auth_id='1')
+        for worker in (worker1, worker2):
+            worker.set(AccountCache.generate_key(['user1', '1']), account)
+
+        # Every pair of the account is dropped in every worker
+        worker1.publish(self.connection, [account.pk])
+        assert worker1.get(('user1', '1')) is None
+        wait_until(lambda: worker2.get(('user1', '1')) is None, 1)
+
+        # An account read before the invalidation is not cached
+        generation = worker2.generation
+        worker1.publish(self.connection, [account.pk])
+        wait_until(lambda: worker2.generation != generation, 1)
+        worker2.set_if_current(('user1', '1'), account, generation)
+        assert worker2.get(('user1', '1')) is None
+
+        # Or every account at once
+        worker2.set(('user1', '1'), account)
+        worker1.publish(self.connection, [AccountCache.ALL])
+        wait_until(lambda: worker2.get(('user1', '1')) is None, 1)
+
+        print('test_account_cache_invalidation is OK')
+
+    def test_invalidation_channel_lost(self):
+        cache = StopRequestNearCache()
+        delays = []
+
+        class Stop(BaseException):
+            pass
+
+        def sleep(delay):
+            delays.append(delay)
+            if len(delays) == 7:
+                raise Stop()
+
+        # Subscribed on the third attempt, lost again once subscribed
+        subscribed = mock.Mock()
+        subscribed.get_message.side_effect = [{'type': 'subscribe'}, ConnectionError()]
+        attempts = iter([ConnectionError(), ConnectionError(), subscribed])
+
+        def pubsub():
+            attempt = next(attempts, ConnectionError())
+            if isinstance(attempt, Exception):
+                raise attempt
+            return attempt
+
+        connection = mock.Mock(pubsub=pubsub)
+        with mock.patch('utils.caches.time.sleep', side_effect=sleep), \
+                mock.patch('utils.caches.logger') as logger:
+            with self.assertRaises(Stop):
+                cache._listen(connection, threading.Event())
+
+        # A traceback when the channel is lost, warnings while it stays down
+        assert delays == [1, 2, 1, 2, 4, 8, 16]
+        assert logger.exception.call_count == 2
+        assert logger.warning.call_count == 6
+
+        print('test_invalidation_channel_lost is OK')
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker('test', failures_to_open=2, reset_timeout=0.05)
+        calls = []
+
+        def down():
+            calls.append(1)
+            raise ConnectionError()
+
+        def error_reply():
+            raise ResponseError()
+
+        def opened():
+            return REGISTRY.get_sample_value(
+                'sms_api_redis_circuit_transitions_total', {'node': 'test', 'state': 'open'}
+            ) or 0
+
+        transitions = opened()
+        for i in range(2):
+            with self.assertRaises(ConnectionError):
+                breaker.call(down)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert opened() == transitions + 1
+
+        # Open, calls fail without reaching redis
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(down)
+        assert len(calls) == 2
+
+        # Half open, a single probe goes through and reopens it on failure
+        time.sleep(0.05)
+        with self.assertRaises(ConnectionError):
+            breaker.call(down)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert opened() == transitions + 2
+
+        # A probe failing for another reason lets the next call probe
+        time.sleep(0.05)
+        with self.assertRaises(TypeError):
+            breaker.call(lambda: None + 1)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with self.assertRaises(ConnectionError):
+            breaker.call(down)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # An error reply proves redis is up
+        time.sleep(0.05)
+        with self.assertRaises(ResponseError):
+            breaker.call(error_reply)
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.call(lambda: 1) == 1
+
+        print('test_circuit_breaker is OK')
+
+    def test_local_rate_limiter(self):
+        limiter = LocalRateLimiter()
+        assert limiter.hit('a', 2, 0.05)
+        assert limiter.hit('a', 2, 0.05)
+        assert not limiter.hit('a', 2, 0.05)
+        assert limiter.hit('b', 2, 0.05)
+        time.sleep(0.05)
+        assert limiter.hit('a', 2, 0.05)
+
+        print('test_local_rate_limiter is OK')
+
+    def test_registered_script(self):
+        connection = RedisConnection.get_connection(self.url)
+        counter = FixedWindowRateLimiter(connection)
+        register = mock.patch.object(
+            connection, 'register_script', wraps=connection.register_script
+        )
+        with mock.patch.dict(FixedWindowRateLimiter._scripts, clear=True), register as register:
+            for i in range(3):
+                FixedWindowRateLimiter(connection).hit('registered', limit=5, window=10)
+            FixedWindowRateLimiter(connection).hit_many([('registered', {'limit': 5, 'window': 10})])
+        assert register.call_count == 1
+        assert counter.registered_script(counter._hit_script) is \
+            FixedWindowRateLimiter(connection).registered_script(counter._hit_script)
+
+        print('test_registered_script is OK')
+
+    def test_connection_registry(self):
+        assert RedisConnection.get_connection(self.url) is self.connection
+        self.connection.ping()
+
+        print('test_connection_registry is OK')
+
+    def test_pool_metrics(self):
+        class Connection(mock.MagicMock):
+            pid = os.getpid()
+
+            def can_read(self, *args, **kwargs):
+                return False
+
+        pool = MeteredConnectionPool(connection_class=Connection, max_connections=3)
+        pool.node = 'test'
+
+        def sample(name):
+            return REGISTRY.get_sample_value(name, {'node': 'test'})
+
+        first = pool.get_connection()
+        second = pool.get_connection()
+        assert sample('sms_api_redis_pool_in_use') == 2
+        assert sample('sms_api_redis_pool_available') == 1
+        pool.release(first)
+        pool.release(second)
+        assert sample('sms_api_redis_pool_in_use') == 0
+        assert sample('sms_api_redis_pool_available') == 3
+
+        print('test_pool_metrics is OK')
+
+    def tearDown(self):
+        self.connection.flushall()
+
+class ShardingTestCase(TestCase):
+    """Nodes are TEST_REDIS_SHARD_URLS when set, like several local
+    redis-server processes, otherwise three dbs of the test server."""
+
+    def setUp(self):
+        urls = os.environ.get('TEST_REDIS_SHARD_URLS')
+        urls = urls.split(',') if urls else [BASE_REDIS_URL + '/%d' % db for db in (2, 3, 4)]
+        self.nodes = [(url, RedisConnection.get_connection(url)) for url in urls]
+        self.sharded = ShardedRedis(self.nodes)
+        self.sharded.flushdb()
+
+    def _require_isolated_nodes(self):
+        self.nodes[0][1].set('isolation', 1)
+        shared = any(node.exists('isolation') for url, node in self.nodes[1:])
+        self.nodes[0][1].delete('isolation')
+        if shared:
+            self.skipTest('the redis nodes share their keys')
+
+    def test_hash_ring(self):
+        names = ['a', 'b', 'c']
+        ring = HashRing(names)
+        keys = ['key%d' % i for i in range(3000)]
+        placed = {key: ring.get_node(key) for key in keys}
+        for name in names:
+            assert 700 < list(placed.values()).count(name) < 1300
+
+        # A new node only takes keys over, about its share of them
+        ring = HashRing(names + ['d'])
+        moved = [key for key in keys if ring.get_node(key) != placed[key]]
+        assert all(ring.get_node(key) == 'd' for key in moved)
+        assert 450 < len(moved) < 1050
+
+        # The keys of a from number share its node
+        number = '4924195509198'
+        assert ring.get_node(OutboundSMSCounter.generate_key([number])) == \
+            ring.get_node(StopRequestStore.generate_key(['1111111', number])[0])
+
+        print('test_hash_ring is OK')
+
+    def test_sharded_redis(self):
+        self._require_isolated_nodes()
+        keys = ['key%d' % i for i in range(50)]
+
+        p = self.sharded.pipeline(transaction=False)
+        for i, key in enumerate(keys):
+            p.set(key, i)
+        for key in keys:
+            p.get(key)
+        assert p.execute()[len(keys):] == [str(i).encode() for i in range(len(keys))]
+        assert sum(node.dbsize() for url, node in self.nodes) == len(keys)
+        assert self.sharded.exists(*keys) == len(keys)
+
+        with self.assertRaises(CrossShardError):
+            self.sharded.register_script("return 1")(keys=keys)
+
+        number = '4924195509198'
+        store = OutboundSMSCounter(self.sharded)
+        key = OutboundSMSCounter.generate_key([number])
+        stop_key = StopRequestStore.generate_key(['1111111', number])
+        StopRequestStore(self.sharded).add(stop_key)
+        rate_limit = store.hit(key, blocked_by=[stop_key])
+        assert rate_limit.status == RateLimitStatus.BLOCKED
+        rate_limits = store.hit_many([(key, {}), (OutboundSMSCounter.generate_key(['1111111']), {})])
+        assert all(rate_limit.allowed for rate_limit in rate_limits)
+
+        print('test_sharded_redis is OK')
+
+    def test_rebalance(self):
+        self._require_isolated_nodes()
+        source = ShardedRedis(self.nodes[:2])
+        keys = ['key%d' % i for i in range(100)]
+        for key in keys:
+            source.set(key, 1, ex=60)
+        source.hset('stop:{1}', mapping={'a': 10, 'b': 10})
+
+        target = ShardedRedis(self.nodes)
+        expected = [key for key in keys + ['stop:{1}'] if
+                    target.ring.get_node(key) != source.ring.get_node(key)]
+        target.hset('stop:{1}', mapping={'a': 20, 'c': 20})
+
+        stats = Rebalancer(source, target).run()
+        assert stats['scanned'] == len(keys) + 1
+        assert stats['moved'] + stats['merged'] == len(expected)
+        assert all(int(target.get(key)) == 1 for key in keys)
+        assert all(0 < target.ttl(key) <= 60 for key in keys)
+        assert Rebalancer(source, target).run()['moved'] == 0
+        if 'stop:{1}' in expected:
+            assert target.hgetall('stop:{1}') == {b'a': b'20', b'b': b'10', b'c': b'20'}
+
+        # A counter keeps what was added to the source between two runs
+        counter = [key for key in expected if key in keys][0]
+        source.set(counter, 5, ex=60)
+        Rebalancer(source, target, keep_source=True).run()
+        source.incr(counter, 3)
+        stats = Rebalancer(source, target).run()
+        assert stats['merged'] == 1
+        assert int(target.get(counter)) == 8
+        assert 0 < target.ttl(counter) <= 60
+
+        print('test_rebalance is OK')
+
+    def tearDown(self):
+        self.sharded.flushdb()
+
+class ConnectionPoolTestCase(TestCase):
+
+    def _connect(self):
+        self.opened += 1
+        return sqlite3.connect(':memory:', check_same_thread=False)
+
+    def setUp(self):
+        self.opened = 0
+        self.pool = ConnectionPool(self._connect, name='test', max_size=2, timeout=0.05)
+
+    def test_connection_pool(self):
+        conn = self.pool.get()
+        self.pool.put(conn)
+        assert self.pool.get() is conn
+        other = self.pool.get()
+        assert self.opened == 2
+        self.assertRaises(PoolTimeout, self.pool.get)
+        self.pool.put(other)
+        assert self.pool.stats() == {'max_size': 2, 'created': 2, 'idle': 1, 'in_use': 1}
+
+        # A broken connection is replaced once found by the health check
+        conn.close()
+        self.pool.put(conn)
+        self.pool.health_check_interval = 0
+        first, second = self.pool.get(), self.pool.get()
+        assert conn not in (first, second)
+        assert self.opened == 3
+        self.pool.put(first)
+        self.pool.put(second)
+
+        # Idle and old connections are closed
+        self.pool.max_idle = 0.01
+        time.sleep(0.02)
+        self.pool.put(self.pool.get())
+        assert self.opened == 4
+        assert self.pool.stats()['created'] == 1
+        self.pool.max_lifetime = 0.01
+        time.sleep(0.02)
+        self.pool.get()
+        assert self.opened == 5
+
+        print('test_connection_pool is OK')
+
+    def tearDown(self):
+        self.pool.close_idle()
+
+
+class WriteBehindBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.written = []
+        self.fail = False
+        self.buffer = WriteBehindBuffer(
+            self._write, 'test', max_size=3, interval=60, max_pending=5
+        )
+
+    def _write(self, rows):
+        if self.fail:
+            raise IOError('down')
+        self.written.append(rows)
+
+    def test_write_behind_buffer(self):
+        self.buffer.add_many([1, 2, 3, 4])
+        assert self.buffer.flush() == 4
+        assert self.written == [[1, 2, 3], [4]]
+
+        # Failed rows are kept, up to max_pending
+        self.fail = True
+        self.buffer.add_many([5, 6, 7, 8])
+        assert self.buffer.flush() == 0
+        self.buffer.add_many([9, 10])
+        assert len(self.buffer) == 5
+        self.fail = False
+        assert self.buffer.flush() == 5
+        assert self.written[2:] == [[5, 6, 7], [8, 9]]
+
+        # Started, max_size rows are written without waiting for interval
+        self.buffer.start()
+        self.buffer.add_many([11, 12, 13])
+        for i in range(100):
+            if len(self.written) == 5:
+                break
+            time.sleep(0.01)
+        assert self.written[4] == [11, 12, 13]
+        self.buffer.add(14)
+        self.buffer.stop()
+        assert self.written[5] == [14]
+
+        print('test_write_behind_buffer is OK')
+
+
+class ReplicaRouterTestCase(TestCase):
+
+    def setUp(self):
+        self.router = ReplicaRouter(replicas=['replica1', 'replica2'], models=['sms_api.Account'])
+        self.router.lag_check_interval = 0
+        self.router.mirrors_primary = lambda alias: False
+        routers.pin_to_primary(0)
+
+    def test_replica_router(self):
+        with mock.patch.object(self.router, 'lag', return_value=0):
+            assert self.router.db_for_read(Account) in ('replica1', 'replica2')
+            assert self.router.db_for_write(Account) == PRIMARY_DB
+            assert self.router.db_for_read(PhoneNumber) is None
+            assert self.router.allow_migrate('replica1', 'sms_api') is False
+
+        # Lagging or unreachable replicas leave the rotation
+        lags = {'replica1': 10, 'replica2': 0}
+        with mock.patch.object(self.router, 'lag', side_effect=lags.get):
+            assert self.router.db_for_read(Account) == 'replica2'
+        lags['replica2'] = None
+        with mock.patch.object(self.router, 'lag', side_effect=lags.get):
+            assert self.router.db_for_read(Account) == PRIMARY_DB
+
+        # A write keeps the reads of the process on the primary for a while
+        with mock.patch.object(self.router, 'lag', return_value=0):
+            with self.settings(REPLICA_MODELS=['sms_api.Account']):
+                Account.objects.create(username='replicated', auth_id='secret')
+            assert routers.is_pinned()
+            assert self.router.db_for_read(Account) is None
+
+        # Only the reads of the thread, a request, that wrote
+        pinned = []
+        thread = threading.Thread(target=lambda: pinned.append(routers.is_pinned()))
+        thread.start()
+        thread.join()
+        assert pinned == [False]
+        request_started.send(sender=self.__class__)
+        assert not routers.is_pinned()
+
+        print('test_replica_router is OK')
+
+    def test_primary_fallback(self):
+        """A row not replicated yet is read from the primary."""
+        Account.objects.create(**test_accounts[0])
+        authentication = AccountBasicAuthentication()
+        credentials = [test_accounts[0]['username'], test_accounts[0]['auth_id']]
+        queried = []
+
+        def verified_account(queryset, userid, password):
+            queried.append(queryset.db)
+            return None if queryset.db != PRIMARY_DB else Account.objects.get(username=userid)
+
+        with mock.patch('apps.sms_api.authentication.reads_from_replica', return_value=True), \
+                mock.patch.object(AccountBasicAuthentication, '_verified_account',
+                                  side_effect=verified_account):
+            account, _ = authentication.authenticate_credentials(*credentials)
+        assert account.username == credentials[0]
+        assert queried[-1] == PRIMARY_DB
+
+        print('test_primary_fallback is OK')
+
+    def tearDown(self):
+        routers.pin_to_primary(0)
+        account_cache.clear()
+
+
 class IntegrationTestCase(APITestCase):
 
     def setUp(self):
@@ -193,6 +927,11 @@ class IntegrationTestCase(APITestCase):
         assert response.status_code == status.HTTP_403_FORBIDDEN
         assert b'blocked by STOP request' in response.content
 
+        # Blocked messages must not use up the quota of the from number
+        key = OutboundSMSCounter.generate_key([d['from']])
+        store = OutboundSMSCounter(RedisConnection.get_connection(TEST_REDIS_URL))
+        assert store.get(key) is None
+
         print('test_stop_request is OK')
 
     def test_outbound_sms(self):
@@ -220,7 +959,646 @@ class IntegrationTestCase(APITestCase):
         
         print('test_outbound_sms_limit is OK')
 
+    def test_outbound_limit_override(self):
+
+        account = Account.objects.get(username=self.username1)
+        number = test_phone_numbers[0]["number"]
+        OutboundLimit.objects.create(account=account, limit=3, window=60)
+        OutboundLimit.objects.create(account=account, number=number, limit=2, window=60)
+        assert OutboundLimit.limit_for(account.id, number) == (2, 60)
+        assert OutboundLimit.limit_for(account.id, 'other') == (3, 60)
+
+        method = self.client.post
+        args = [reverse("outbound_sms"), {"from": number, "to": "343434343", "text": "hola"}]
+        for i in range(2):
+            response = self._send_request_with_auth_header(method, *args)
+            assert response.status_code == status.HTTP_202_ACCEPTED
+        response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+        assert b'limit reached for from' in response.content
+
+        # Dropping the override of the number falls back to the account one,
+        # in every worker, once committed
+        worker = OutboundLimitCache()
+        worker.listen(RedisConnection.get_connection(TEST_REDIS_URL))
+        worker.set(account.id, {number: (2, 60)})
+        with mock.patch('apps.sms_api.signals.api_connection',
+                        return_value=RedisConnection.get_connection(TEST_REDIS_URL)):
+            OutboundLimit.objects.filter(number=number).delete()
+            assert OutboundLimit.limit_for(account.id, number) == (2, 60)
+            run_commit_hooks()
+        assert OutboundLimit.limit_for(account.id, number) == (3, 60)
+        wait_until(lambda: worker.get(account.id) is None, 1)
+
+        print('test_outbound_limit_override is OK')
+
+    def test_account_cache(self):
+
+        method = self.client.post
+        args = [reverse("inbound_sms"), {"to": test_phone_numbers[0]["number"], "from": "343434343", "text": "hola"}]
+
+        response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        misses = account_cache.misses
+
+        # The worker listens from its start, not from its requests
+        with mock.patch.object(account_cache, 'listen') as listen:
+            response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert not listen.called
+        assert account_cache.misses == misses
+        assert account_cache.hits >= 1
+
+        account = Account.objects.get(username=self.username1)
+        account.auth_id = 'changed'
+        account.save()
+        # Invalidated once committed only
+        assert account_cache.get((self.username1, str(self.password1))) is not None
+        run_commit_hooks()
+        assert account_cache.get((self.username1, str(self.password1))) is None
+
+        response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+        print('test_account_cache is OK')
+
+    def test_worker_warm_up(self):
+
+        account = Account.objects.get(username=self.username1)
+        OutboundLimit.objects.create(account=account, limit=3, window=60)
+        # As a worker warmed up on the redis it serves from would be
+        account_cache.listen(api_connection())
+        timings = warm_up(TEST_REDIS_URL)
+        assert list(timings) == ['preload', 'connect_db', 'connect_redis', 'listen', 'prime_caches']
+        assert None not in timings.values()
+
+        r = RedisConnection.get_connection(TEST_REDIS_URL)
+        assert r.script_exists(hashlib.sha1(OutboundSMSCounter._hit_script.encode()).hexdigest()) == [True]
+        assert outbound_limit_cache.get(account.id) == {None: (3, 60)}
+
+        misses = account_cache.misses
+        method = self.client.post
+        args = [reverse("inbound_sms"), {"to": test_phone_numbers[0]["number"], "from": "343434343", "text": "hola"}]
+        response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert account_cache.misses == misses
+
+        # Accounts invalidated while they are read are not cached
+        account_cache.clear()
+        order_by = Account.objects.order_by
+
+        def invalidated_order_by(*args):
+            account_cache.invalidate(AccountCache.ALL)
+            return order_by(*args)
+
+        with mock.patch.object(Account.objects, 'order_by', side_effect=invalidated_order_by):
+            prime_caches()
+        assert account_cache.stats()['size'] == 0
+
+        print('test_worker_warm_up is OK')
+
+    def test_phone_number_index(self):
+
+        method = self.client.post
+        args = [reverse("outbound_sms"), {"from": "9999999", "to": "343434343", "text": "hola"}]
+
+        # The first request authenticates and loads the index of the account
+        response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        # Unknown and known numbers are now answered without the DB
+        with self.assertNumQueries(0):
+            response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        args[-1]['from'] = test_phone_numbers[1]["number"]
+        with self.assertNumQueries(0):
+            response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+
+        connection = RedisConnection.get_connection(TEST_REDIS_URL)
+        index = PhoneNumberIndex(connection)
+        index.add(1, '9999999')
+        assert PhoneNumber.number_exists(1, '9999999', connection)
+        index.remove(1, '9999999')
+        assert not PhoneNumber.number_exists(1, '9999999', connection)
+
+        # Adding to an index that is not loaded must not mark it as loaded
+        index.add(2, '9999999')
+        assert index.contains(2, '9999999') is None
+
+        # A load of numbers read before a change to them is dropped
+        version = index.version
+        index.add(2, '8888888')
+        assert not index.load(2, ['4444444'], version)
+        assert index.contains(2, '4444444') is None
+        assert index.load(2, ['4444444', '8888888'], index.version)
+        assert index.contains(2, '8888888')
+
+        # The signals update the index once the number is committed only
+        with mock.patch('apps.sms_api.signals.api_connection', return_value=connection):
+            try:
+                with transaction.atomic():
+                    PhoneNumber.objects.create(account_id=1, number='7777777')
+                    raise IOError('rolled back')
+            except IOError:
+                pass
+            run_commit_hooks()
+            assert not index.contains(1, '7777777')
+
+            PhoneNumber.objects.create(account_id=1, number='7777777')
+            assert not index.contains(1, '7777777')
+            run_commit_hooks()
+            assert index.contains(1, '7777777')
+
+        print('test_phone_number_index is OK')
+
+    def test_inbound_sms_batch(self):
+
+        method = self.client.post
+        url = reverse("inbound_sms_batch") + '?integration_test=1'
+        batch = [
+            {"to": test_phone_numbers[0]["number"], "from": test_phone_numbers[3]["number"], "text": "STOP"},
+            {"to": "9999999", "from": "343434343", "text": "hola"},
+            {"to": test_phone_numbers[1]["number"], "text": "hola"},
+            "hola",
+        ]
+
+        response = self._send_request_with_auth_header(method, url, batch, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        results = response.data['results']
+        assert [r['status'] for r in results] == [202, 404, 400, 400]
+        assert results[0]['message'] == 'inbound sms ok'
+        assert results[1]['error'] == 'to parameter not found'
+        assert results[2]['error'] == 'from is missing'
+        assert results[3]['error'] == 'data must be a dictionary'
+
+        response = self._send_request_with_auth_header(method, url, {}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+        args = [reverse("outbound_sms"), {"from": test_phone_numbers[0]["number"], "to": test_phone_numbers[3]["number"], "text": "hola"}]
+        response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+        print('test_inbound_sms_batch is OK')
+
+    def test_outbound_sms_batch(self):
+
+        method = self.client.post
+        url = reverse("outbound_sms_batch") + '?integration_test=1'
+        sms = {"from": test_phone_numbers[0]["number"], "to": "343434343", "text": "hola"}
+        batch = [dict(sms) for i in range(MAX_OUTBOUND_SMS_PER_NUMBER + 1)]
+        batch.append({"from": "9999999", "to": "343434343", "text": "hola"})
+
+        response = self._send_request_with_auth_header(method, url, batch, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        results = response.data['results']
+        assert all(r['status'] == 202 for r in results[:MAX_OUTBOUND_SMS_PER_NUMBER])
+        assert results[-2]['status'] == 403
+        assert 'limit reached for from' in results[-2]['error']
+        assert results[-1]['status'] == 404
+
+        print('test_outbound_sms_batch is OK')
+
+    def _redis_breakers(self):
+        connection = RedisConnection.get_connection(TEST_REDIS_URL)
+        nodes = connection.nodes.values() if isinstance(connection, ShardedRedis) \
+            else [connection]
+        return [node.breaker for node in nodes]
+
+    def test_degraded_mode(self):
+        for breaker in self._redis_breakers():
+            for i in range(breaker.failures_to_open):
+                breaker.failure()
+
+        number = test_phone_numbers[0]["number"]
+        method = self.client.post
+        inbound = [reverse("inbound_sms"), {"to": number, "from": "343434343", "text": "hola"}]
+        response = self._send_request_with_auth_header(method, *inbound)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+
+        inbound[-1]["text"] = "STOP"
+        response = self._send_request_with_auth_header(method, *inbound)
+        assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+        # Failing closed costs no DB query, the overrides being cached by the worker
+        outbound = [reverse("outbound_sms"), {"from": number, "to": "343434343", "text": "hola"}]
+        OutboundLimit.limit_for(Account.objects.get(username=self.username1).id, number)
+        with self.assertNumQueries(0):
+            response = self._send_request_with_auth_header(method, *outbound)
+        assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+        # Failing open, this worker allows its share of the limit
+        with mock.patch('apps.sms_api.views.DEGRADED_STOP_POLICY', DegradedStopPolicy.FAIL_OPEN):
+            for i in range(MAX_OUTBOUND_SMS_PER_NUMBER // DEGRADED_WORKERS):
+                response = self._send_request_with_auth_header(method, *outbound)
+                assert response.status_code == status.HTTP_202_ACCEPTED
+            response = self._send_request_with_auth_header(method, *outbound)
+            assert response.status_code == status.HTTP_403_FORBIDDEN
+            assert b'limit reached for from' in response.content
+        buffered = len(dispatch_buffer)
+        assert buffered == MAX_OUTBOUND_SMS_PER_NUMBER // DEGRADED_WORKERS
+
+        # The sms accepted meanwhile are queued along with the next one
+        for breaker in self._redis_breakers():
+            breaker.success()
+        outbound[-1]["to"] = "565656565"
+        response = self._send_request_with_auth_header(method, *outbound)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        queue = OutboundSMSQueue(RedisConnection.get_connection(TEST_REDIS_URL))
+        assert queue.stats()['length'] == buffered + 1
+        assert len(dispatch_buffer) == 0
+
+        print('test_degraded_mode is OK')
+
+    def test_degraded_batch(self):
+        for breaker in self._redis_breakers():
+            for i in range(breaker.failures_to_open):
+                breaker.failure()
+
+        number = test_phone_numbers[0]["number"]
+        method = self.client.post
+        url = reverse("inbound_sms_batch") + '?integration_test=1'
+        batch = [
+            {"to": number, "from": "343434343", "text": "hola"},
+            {"to": number, "from": "343434343", "text": "STOP"},
+            {"to": "9999999", "from": "343434343", "text": "hola"},
+        ]
+        response = self._send_request_with_auth_header(method, url, batch, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert [r['status'] for r in response.data['results']] == [202, 503, 404]
+
+        # Every message gets the answer it would get on its own
+        url = reverse("outbound_sms_batch") + '?integration_test=1'
+        share = MAX_OUTBOUND_SMS_PER_NUMBER // DEGRADED_WORKERS
+        batch = [{"from": number, "to": "343434343", "text": "hola"}] * (share + 1)
+        response = self._send_request_with_auth_header(method, url, batch, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert {r['status'] for r in response.data['results']} == {503}
+        assert len(dispatch_buffer) == 0
+
+        with mock.patch('apps.sms_api.views.DEGRADED_STOP_POLICY', DegradedStopPolicy.FAIL_OPEN):
+            response = self._send_request_with_auth_header(method, url, batch, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        results = response.data['results']
+        assert [r['status'] for r in results] == [202] * share + [403]
+        assert 'limit reached for from' in results[-1]['error']
+        assert len(dispatch_buffer) == share
+        assert message_log.flush() == share + 1
+
+        print('test_degraded_batch is OK')
+
+    def test_message_log(self):
+
+        method = self.client.post
+        number = test_phone_numbers[0]["number"]
+        inbound = [reverse("inbound_sms"), {"to": number, "from": "343434343", "text": "hola"}]
+        response = self._send_request_with_auth_header(method, *inbound)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        outbound = [reverse("outbound_sms"), {"from": number, "to": "343434343", "text": "hola"}]
+        response = self._send_request_with_auth_header(method, *outbound)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        url = reverse("outbound_sms_batch") + '?integration_test=1'
+        batch = [{"from": number, "to": "565656565", "text": "bye"}, {"from": "9999999", "to": "565656565", "text": "bye"}]
+        response = self._send_request_with_auth_header(method, url, batch, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+
+        # Nothing is written in the request
+        assert not Message.objects.exists()
+        assert message_log.flush() == 3
+        rows = list(Message.objects.order_by('id').values_list(
+            'sms_type', 'account_id', 'sms_from', 'sms_to', 'text'
+        ))
+        account_id = Account.objects.get(username=self.username1).id
+        assert rows == [
+            ('inbound', account_id, '343434343', number, 'hola'),
+            ('outbound', account_id, number, '343434343', 'hola'),
+            ('outbound', account_id, number, '565656565', 'bye'),
+        ]
+
+        # Postgres before 11 has a plain table, without partitions
+        connection = mock.MagicMock(vendor='postgresql', pg_version=100000)
+        with mock.patch.object(Message, '_partitions', set()):
+            Message.ensure_partitions({(2030, 1)}, connection)
+            assert not connection.cursor.called
+        connection.pg_version = 110000
+        with mock.patch.object(Message, '_partitions', set()):
+            Message.ensure_partitions({(2030, 1)}, connection)
+            assert connection.cursor.called
+
+        print('test_message_log is OK')
+
+    def test_api_stack(self):
+
+        args = [reverse("inbound_sms"), {"to": test_phone_numbers[0]["number"], "from": "343434343", "text": "hola"}]
+        response = self._send_request_with_auth_header(self.client.post, *args)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert response.has_header('X-Frame-Options')
+
+        with override_settings(
+            MIDDLEWARE=settings.API_MIDDLEWARE, ROOT_URLCONF=settings.API_ROOT_URLCONF
+        ):
+            # A client of its own, the middleware is loaded on first use
+            client = self.client_class()
+            assert reverse("inbound_sms") == args[0]
+            response = self._send_request_with_auth_header(client.post, *args)
+            assert response.status_code == status.HTTP_202_ACCEPTED
+            assert not response.has_header('X-Frame-Options')
+            response = client.get('/admin/')
+            assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        print('test_api_stack is OK')
+
+    def test_outbound_quota(self):
+
+        number = test_phone_numbers[0]["number"]
+        account_id = Account.objects.get(username=self.username1).id
+        OutboundLimit.objects.create(account_id=account_id, number=number, limit=10, window=60)
+        url = reverse("outbound_quota") + '?integration_test=1'
+        response = self._send_request_with_auth_header(self.client.get, url)
+        assert response.status_code == status.HTTP_200_OK
+        own = [p["number"] for p in test_phone_numbers if p["account_id"] == account_id]
+        assert sorted(response.data["quota"]) == sorted(own)
+        assert response.data["quota"][number] == {"limit": 10, "window": 60, "remaining": 10, "reset": 0}
+
+        args = [reverse("outbound_sms"), {"from": number, "to": "343434343", "text": "hola"}]
+        for i in range(2):
+            response = self._send_request_with_auth_header(self.client.post, *args)
+            assert response.status_code == status.HTTP_202_ACCEPTED
+        batch = [{"from": own[1], "to": "343434343", "text": "hola"}]
+        response = self._send_request_with_auth_header(
+            self.client.post, reverse("outbound_sms_batch") + '?integration_test=1', batch, format='json'
+        )
+        assert response.data["results"][0]["status"] == status.HTTP_202_ACCEPTED
+
+        response = self._send_request_with_auth_header(self.client.get, url)
+        quota = response.data["quota"]
+        assert quota[number]["remaining"] == 8
+        assert 0 < quota[number]["reset"] <= 60
+        assert quota[own[1]]["remaining"] == MAX_OUTBOUND_SMS_PER_NUMBER - 1
+        assert quota[own[2]] == {
+            "limit": MAX_OUTBOUND_SMS_PER_NUMBER, "window": OutboundSMSCounter.ttl,
+            "remaining": MAX_OUTBOUND_SMS_PER_NUMBER, "reset": 0
+        }
+
+        print('test_outbound_quota is OK')
+
+    def test_migrate_outbound_counters(self):
+
+        connection = RedisConnection.get_connection(TEST_REDIS_URL)
+        if isinstance(connection, ShardedRedis):
+            # Legacy counters predate sharding
+            return
+        assert OutboundSMSCounter.algorithm == 'fixed_window'
+        connection.set('outboundsmscounter_1111111', 7, ex=100)
+        connection.set('outboundsmscounter_2222222', 3, ex=100)
+        connection.set('outboundsmscounter_gcra_{1111111}', 5)
+        store = OutboundSMSCounter(connection)
+        store.hit(OutboundSMSCounter.generate_key(['2222222']), window=50)
+
+        out = io.StringIO()
+        call_command('migrate_outbound_counters', url=TEST_REDIS_URL, stdout=out)
+        assert json.loads(out.getvalue()) == {'migrated': 2}
+        assert not connection.exists('outboundsmscounter_1111111', 'outboundsmscounter_2222222')
+        assert connection.exists('outboundsmscounter_gcra_{1111111}')
+
+        # A counter hit since the deploy keeps its window
+        key = OutboundSMSCounter.generate_key(['1111111'])
+        assert int(connection.get(key)) == 7 and 0 < connection.ttl(key) <= 100
+        key = OutboundSMSCounter.generate_key(['2222222'])
+        assert int(connection.get(key)) == 4 and 0 < connection.ttl(key) <= 50
+        rate_limit = store.hit(key, limit=5)
+        assert rate_limit.allowed and rate_limit.remaining == 0
+
+        print('test_migrate_outbound_counters is OK')
+
+    def test_import_sms_data(self):
+
+        connection = RedisConnection.get_connection(TEST_REDIS_URL)
+        index = PhoneNumberIndex(connection)
+        index.load(1, ['1111111', '2222222', '3333333'])
+
+        def run(kind, fmt, content):
+            with tempfile.NamedTemporaryFile('w', suffix='.' + fmt) as f:
+                f.write(content)
+                f.flush()
+                out = io.StringIO()
+                call_command(
+                    'import_sms_data', kind, f.name, batch_size=2,
+                    redis_url=TEST_REDIS_URL, stdout=out
+                )
+            lines = out.getvalue().splitlines()
+            return lines[:-1], json.loads(lines[-1])
+
+        # Workers drop the accounts the import changes
+        worker = AccountCache()
+        worker.listen(connection)
+        for cache in (worker, account_cache):
+            cache.set(('user2', '2'), Account.objects.get(id=2))
+
+        accounts = 'id,auth_id,username\n2,2,user2b\n3,30,user3\nx,1,user4\n3,31,user3\n'
+        progress, stats = run('accounts', 'csv', accounts)
+        assert account_cache.get(('user2', '2')) is None
+        deadline = time.monotonic() + 1
+        while worker.get(('user2', '2')) is not None:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert len(progress) == 2
+        assert (stats['rows'], stats['written'], stats['invalid']) == (4, 3, 1)
+        assert Account.objects.get(id=2).username == 'user2b'
+        assert Account.objects.get(id=3).auth_id == '31'
+
+        numbers = '\n'.join([
+            '{"number": "1111111", "account_id": 1}',
+            '{"number": "6666666", "account_id": 1}',
+            '{"number": "6666666", "account_id": 3}',
+            '{"number": "7777777", "account_id": 99}',
+            'not json',
+            '{"number": "8888888", "account_id": 3}',
+            '{"number": "8888888", "account_id": 3}',
+        ])
+        progress, stats = run('numbers', 'ndjson', numbers)
+        assert len(progress) == 3
+        assert (stats['rows'], stats['written'], stats['skipped'], stats['invalid']) == (7, 3, 3, 1)
+        assert PhoneNumber.objects.filter(account_id=3).count() == 2
+
+        # The stale index of account 1 was dropped and loads with the new number
+        assert index.contains(1, '6666666') is None
+        assert PhoneNumber.number_exists(1, '6666666', connection)
+
+        # Importing the same file again changes nothing
+        progress, stats = run('numbers', 'ndjson', numbers)
+        assert stats['written'] == 0
+        assert PhoneNumber.objects.count() == len(test_phone_numbers) + 3
+
+        print('test_import_sms_data is OK')
+
+    def test_startup_probe(self):
+
+        args = [
+            '--url', reverse("inbound_sms"), '--requests', '2',
+            '--username', self.username1, '--password', self.password1,
+            '--number', test_phone_numbers[0]["number"],
+        ]
+        for warm in (False, True):
+            out = io.StringIO()
+            call_command('startup_probe', *args + ['--warm'] * warm, stdout=out)
+            result = json.loads(out.getvalue())
+            assert len(result['latencies']) == 2
+            assert (result['warmup'] is None) is not warm
+
+        print('test_startup_probe is OK')
+
+    def test_idempotency_key(self):
+
+        method = self.client.post
+        number = test_phone_numbers[0]["number"]
+        sms = {"from": number, "to": "343434343", "text": "hola"}
+        connection = RedisConnection.get_connection(TEST_REDIS_URL)
+        queue = OutboundSMSQueue(connection)
+
+        response = self._send_request_with_auth_header(
+            method, reverse("outbound_sms"), dict(sms), HTTP_IDEMPOTENCY_KEY='a1'
+        )
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert not response.has_header('Idempotent-Replayed')
+
+        # The retry is answered from the store, nothing is queued again
+        response = self._send_request_with_auth_header(
+            method, reverse("outbound_sms"), dict(sms), HTTP_IDEMPOTENCY_KEY='a1'
+        )
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert response['Idempotent-Replayed'] == 'true'
+        assert response.data['message'] == 'outbound sms ok'
+        assert queue.stats()['length'] == 1
+
+        response = self._send_request_with_auth_header(
+            method, reverse("outbound_sms"), dict(sms, text="bye"), HTTP_IDEMPOTENCY_KEY='a1'
+        )
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+        account_id = Account.objects.get(username=self.username1).id
+        IdempotencyStore(connection).claim(IdempotencyStore.generate_key([account_id, 'a2']))
+        response = self._send_request_with_auth_header(
+            method, reverse("outbound_sms"), dict(sms), HTTP_IDEMPOTENCY_KEY='a2'
+        )
+        assert response.status_code == status.HTTP_409_CONFLICT
+
+        response = self._send_request_with_auth_header(
+            method, reverse("outbound_sms"), dict(sms), HTTP_IDEMPOTENCY_KEY='a' * 256
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+        # A refused sms is not replayed, its retry runs again
+        with mock.patch.object(OutboundSMSCounter, 'limit', 1):
+            response = self._send_request_with_auth_header(
+                method, reverse("outbound_sms"), dict(sms), HTTP_IDEMPOTENCY_KEY='a3'
+            )
+            assert response.status_code == status.HTTP_403_FORBIDDEN
+        response = self._send_request_with_auth_header(
+            method, reverse("outbound_sms"), dict(sms), HTTP_IDEMPOTENCY_KEY='a3'
+        )
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert not response.has_header('Idempotent-Replayed')
+
+        # Without the header, sms are deduplicated on their content
+        with mock.patch('apps.sms_api.views.IDEMPOTENCY_CONTENT_WINDOW', 60):
+            for text, replayed in [("hey", False), ("hey", True), ("hi", False)]:
+                response = self._send_request_with_auth_header(
+                    method, reverse("outbound_sms"), dict(sms, text=text)
+                )
+                assert response.status_code == status.HTTP_202_ACCEPTED
+                assert response.has_header('Idempotent-Replayed') == replayed
+        assert queue.stats()['length'] == 4
+
+        print('test_idempotency_key is OK')
+
+    def test_outbound_dispatch(self):
+
+        method = self.client.post
+        number = test_phone_numbers[0]["number"]
+        args = [reverse("outbound_sms"), {"from": number, "to": "343434343", "text": "hola"}]
+        response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+
+        connection = RedisConnection.get_connection(TEST_REDIS_URL)
+        carrier = StubCarrier('stub')
+        dispatcher = Dispatcher(connection, carriers={'stub': carrier}, consumer='test')
+        assert dispatcher.run_once() == {'sent': 1, 'retry': 0}
+        assert carrier.sent == [
+            {'from': number, 'to': '343434343', 'text': 'hola', 'account': '1'}
+        ]
+        assert dispatcher.queue.stats() == {'length': 0, 'pending': 0, 'dead': 0}
+
+        # Refused sms stay pending, are retried after their backoff and
+        # dead lettered after max_attempts
+        carrier.fail = lambda message: True
+        dispatcher.queue.add({'from': number, 'to': '343434343', 'text': 'bye', 'account': 1})
+        assert dispatcher.run_once() == {'sent': 0, 'retry': 1}
+        assert dispatcher.run_once() == {'sent': 0, 'retry': 0}
+        assert dispatcher.queue.stats()['pending'] == 1
+        with mock.patch.object(OutboundSMSQueue, 'retry_delay', 0):
+            for attempt in range(dispatcher.queue.max_attempts - 1):
+                assert dispatcher.run_once() == {'sent': 0, 'retry': 1}
+            assert dispatcher.run_once() == {'sent': 0, 'retry': 0}
+        assert dispatcher.queue.stats() == {'length': 0, 'pending': 0, 'dead': 1}
+
+        # With no dispatcher reading, the stream is trimmed to about max_length
+        message = {'from': number, 'to': '343434343', 'text': 'later', 'account': 1}
+        with mock.patch.object(OutboundSMSQueue, 'max_length', 10):
+            dispatcher.queue.add_many([message] * 500)
+            dispatcher.queue.add(message)
+        assert 10 <= dispatcher.queue.stats()['length'] < 500
+        dispatcher.close()
+
+        assert carrier_for('4412345', {'': 'a', '44': 'b', '441': 'c'}) == 'c'
+        assert carrier_for('4512345', {'': 'a', '44': 'b', '441': 'c'}) == 'a'
+
+        print('test_outbound_dispatch is OK')
+
+    def test_metrics(self):
+
+        method = self.client.post
+        args = [reverse("outbound_sms"), {"from": test_phone_numbers[0]["number"], "to": "343434343", "text": "hola"}]
+        response = self._send_request_with_auth_header(method, *args)
+        assert response.status_code == status.HTTP_202_ACCEPTED
+
+        response = self.client.get(reverse("metrics"))
+        assert response.status_code == status.HTTP_200_OK
+        assert b'sms_api_messages_total{endpoint="outbound_sms",outcome="accepted"}' in response.content
+        assert b'sms_api_stage_seconds_count{endpoint="outbound_sms",stage="authentication"}' in response.content
+        assert b'sms_api_stage_seconds_count{endpoint="outbound_sms",stage="_check_fused_chain"}' in response.content
+        assert b'sms_api_redis_seconds_count{call="hit",store="OutboundSMSCounter"}' in response.content
+
+        # Only the allowed networks get them
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR='203.0.113.7')
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        allowed = [ipaddress.ip_network('203.0.113.0/24')]
+        with mock.patch('apps.sms_api.views.METRICS_ALLOWED_NETWORKS', allowed):
+            response = self.client.get(reverse("metrics"), REMOTE_ADDR='203.0.113.7')
+            assert response.status_code == status.HTTP_200_OK
+            response = self.client.get(reverse("metrics"))
+            assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        # The live gauges of a worker that exited are dropped, its counters stay
+        with tempfile.TemporaryDirectory() as path:
+            names = ['gauge_livesum_123.db', 'gauge_liveall_123.db', 'counter_123.db']
+            for name in names:
+                open(os.path.join(path, name), 'w').close()
+            with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': path}):
+                metrics.mark_process_dead(123)
+            assert os.listdir(path) == ['counter_123.db']
+
+        print('test_metrics is OK')
+
     def tearDown(self):
     
+        for breaker in self._redis_breakers():
+            breaker.success()
+        local_outbound_limiter.clear()
+        dispatch_buffer.take()
+        message_log.flush()
         r = RedisConnection.get_connection(TEST_REDIS_URL)
         r.flushall()
+        account_cache.clear()
+        outbound_limit_cache.clear()
@@ -6,6 +6,10 @@ from . import views
 urlpatterns = [
     url(r'^inbound/sms/$', views.InboundSMSView.as_view(), name="inbound_sms"),
     url(r'^outbound/sms/$', views.OutboundSMSView.as_view(), name="outbound_sms"),
+    url(r'^inbound/sms/batch/$', views.InboundSMSBatchView.as_view(), name="inbound_sms_batch"),
+    url(r'^outbound/sms/batch/$', views.OutboundSMSBatchView.as_view(), name="outbound_sms_batch"),
+    url(r'^outbound/quota/$', views.OutboundQuotaView.as_view(), name="outbound_quota"),
+    url(r'^metrics/$', views.metrics_view, name="metrics"),
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns)
@@ -1,20 +1,697 @@
 from __future__ import absolute_import
-from utils.caches import RedisStore
+import hashlib
+import json
+import threading
+import time
+
+from utils.caches import InvalidatedLocalCache, LocalCache, LocalRateLimiter
+from utils.caches import RATE_LIMITERS
+from utils.caches import PROD_REDIS_URL, RedisConnection, RedisStore, TEST_REDIS_URL
+from utils.sharding import ShardedRedis, group_by_node
+from utils.streams import StreamQueue
+from utils.metrics import timed_redis_call
+
+from .constants import ACCOUNT_CACHE_MAX_SIZE, ACCOUNT_CACHE_TTL, ACCOUNT_CHANNEL
+from .constants import DEGRADED_DISPATCH_BUFFER, DISPATCH_MAX_ATTEMPTS
+from .constants import DISPATCH_DEAD_MAX_LENGTH, DISPATCH_RETRY_DELAY
+from .constants import DISPATCH_STREAM_MAX_LENGTH, IDEMPOTENCY_KEY_TTL
+from .constants import IDEMPOTENCY_PENDING_TTL
+from .constants import MAX_OUTBOUND_SMS_PER_NUMBER, OUTBOUND_LIMIT_CACHE_TTL
+from .constants import OUTBOUND_LIMIT_CHANNEL
+from .constants import OUTBOUND_SMS_LIMIT_ALGORITHM, OUTBOUND_SMS_LIMIT_WINDOW
+from .constants import PHONE_NUMBER_INDEX_TTL, STOP_NEAR_CACHE_MAX_SIZE
+from .constants import STOP_NEAR_CACHE_TTL, STOP_REQUEST_CHANNEL
+from .constants import STOP_REQUEST_READ_LEGACY_KEYS
+
+
+def api_connection(integration_test=False):
+    """The redis the API is served from, integration tests get a db of
+    their own."""
+    return RedisConnection.get_connection(TEST_REDIS_URL if integration_test else PROD_REDIS_URL)
 
 
 class StopRequestStore(RedisStore):
+    """
+    STOP requests grouped per recipient, the number of ours that received
+    them. Every recipient has one hash, `stop:{number}`, tagged like the
+    OutboundSMSCounter key of that number so that both share a node when
+    redis is sharded. It has a field per number that opted out holding the
+    unix second its STOP expires at. Hashes up to
+    hash-max-listpack-entries fields, 128 by default, are stored as
+    listpacks, so a pair costs about the size of its packed number and
+    expiry instead of a whole key. Recipients getting more opt-outs than
+    that want the setting raised.
+
+    The hash expires with its latest field, expired fields left in a hash
+    that is still used are dropped when they are read.
+
+    Every new pair is published on STOP_REQUEST_CHANNEL, as the length of
+    its hash key as one byte followed by the hash key and the field, for
+    the near_cache of the workers to drop it. is_stopped answers from the
+    near_cache when given one, it only holds pairs that are not stopped.
+    """
 
     ttl = 4*60*60
     check_exists = True
-    
+    key_format = 'stop:{%s}'
+
+    _add = """
+    if redis.replicate_commands then
+        redis.replicate_commands()
+    end
+    local ttl = tonumber(ARGV[1])
+    local now = tonumber(redis.call('TIME')[1])
+    local added = 0
+    for i = 1, #KEYS do
+        local expires = tonumber(redis.call('HGET', KEYS[i], ARGV[i + 1]))
+        if not (expires and expires > now) then
+            redis.call('HSET', KEYS[i], ARGV[i + 1], now + ttl)
+            redis.call('EXPIRE', KEYS[i], ttl)
+            redis.call('PUBLISH', ARGV[#KEYS + 2], string.char(#KEYS[i]) .. KEYS[i] .. ARGV[i + 1])
+            added = added + 1
+        end
+    end
+    return added
+    """
+
+    _is_stopped = """
+    if redis.replicate_commands then
+        redis.replicate_commands()
+    end
+    local expires = tonumber(redis.call('HGET', KEYS[1], ARGV[1]))
+    if expires then
+        if expires > tonumber(redis.call('TIME')[1]) then
+            return 1
+        end
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    end
+    if KEYS[2] then
+        return redis.call('EXISTS', KEYS[2])
+    end
+    return 0
+    """
+
+    def __init__(self, connection=None, near_cache=None):
+        super().__init__(connection)
+        self.near_cache = near_cache
+
     @staticmethod
-    def generate_key(keyParams):
+    def pack_number(number):
+        """
+        Two digits per byte, an odd length padded with an f nibble. Numbers
+        with other characters are kept as they are behind a 0xff byte, which
+        can not start a packed number.
+
+        params:
+            number, type string
+        return:
+            type bytes
+        """
+        if number.isdigit() and number.isascii():
+            return bytes.fromhex(number + 'f' * (len(number) % 2))
+        return b'\xff' + number.encode()
+
+    @classmethod
+    def generate_key(cls, keyParams):
+        """
+        params:
+            keyParams, [number that sent STOP, number that received it]
+        return:
+            (hash key, field), type tuple(bytes)
+        """
+        return (cls.key_format % keyParams[1]).encode(), cls.pack_number(keyParams[0])
+
+    @staticmethod
+    def generate_legacy_key(keyParams):
         return 'stoprequest_%s' % ''.join(keyParams)
 
-class OutboundSMSCounter(RedisStore):
+    @property
+    def reads_legacy_keys(self):
+        return STOP_REQUEST_READ_LEGACY_KEYS and \
+            not isinstance(self.connection, ShardedRedis)
+
+    def blockers(self, keyParams):
+        """
+        params:
+            keyParams as in generate_key
+        return:
+            what a STOP request of keyParams is stored as, for the
+            blocked_by of a RateLimiter hit, type list
+        """
+        blockers = [self.generate_key(keyParams)]
+        if self.reads_legacy_keys:
+            blockers.append(self.generate_legacy_key(keyParams))
+        return blockers
+
+    def add(self, key):
+        return self.add_many([key])
+
+    @timed_redis_call
+    def add_many(self, keys):
+        """
+        Records STOP requests, the expiry of a pair already stopped is kept.
+        It takes one script call per redis node involved.
+
+        params:
+            keys, type list(tuple(hash key, field))
+        return:
+            count of new pairs, type int
+        """
+        script = self.registered_script(self._add)
+        added = 0
+        for node_keys in group_by_node(self.connection, keys, lambda key: key[0]):
+            added += script(
+                keys=[key for key, field in node_keys],
+                args=[self.ttl] + [field for key, field in node_keys] + [STOP_REQUEST_CHANNEL],
+            )
+        if self.near_cache is not None:
+            for key in keys:
+                self.near_cache.invalidate(key)
+        return added
+
+    @timed_redis_call
+    def is_stopped(self, keyParams):
+        """
+        params:
+            keyParams as in generate_key
+        return:
+            type bool
+        """
+        (key, field), legacy_keys = self.generate_key(keyParams), []
+        if self.near_cache is not None:
+            self.near_cache.listen(self.connection)
+            if self.near_cache.get((key, field)) is not None:
+                return False
+            generation = self.near_cache.generation
+
+        if self.reads_legacy_keys:
+            legacy_keys.append(self.generate_legacy_key(keyParams))
+        script = self.registered_script(self._is_stopped)
+        stopped = bool(script(keys=[key] + legacy_keys, args=[field]))
+
+        if self.near_cache is not None and not stopped:
+            self.near_cache.set_if_current((key, field), False, generation)
+        return stopped
+
+class StopRequestNearCache(InvalidatedLocalCache):
+    """Pairs found not stopped by the StopRequestStore of this worker, keyed
+    like the store."""
+
+    channel = STOP_REQUEST_CHANNEL
+    max_size = STOP_NEAR_CACHE_MAX_SIZE
+    ttl = STOP_NEAR_CACHE_TTL
+
+    def decode_message(self, data):
+        length = data[0] + 1
+        return data[1:length], data[length:]
+
+stop_request_near_cache = StopRequestNearCache()
+
+class OutboundSMSCounter(RATE_LIMITERS[OUTBOUND_SMS_LIMIT_ALGORITHM]):
+    """
+    Counters used to be `outboundsmscounter_<from>` fixed windows, they are
+    folded into the fixed window keys of today by migrate_legacy_keys, see
+    the migrate_outbound_counters command. They predate sharding, so they
+    are only looked for on a single redis.
+    """
+
+    ttl = OUTBOUND_SMS_LIMIT_WINDOW
+    limit = MAX_OUTBOUND_SMS_PER_NUMBER
 
-    ttl = 24*60*60
+    legacy_prefix = 'outboundsmscounter_'
+
+    _migrate = """
+    local count = redis.call('GET', KEYS[1])
+    if not count then
+        return 0
+    end
+    local pttl = redis.call('PTTL', KEYS[1])
+    redis.call('INCRBY', KEYS[2], count)
+    if pttl > 0 and redis.call('PTTL', KEYS[2]) < 0 then
+        redis.call('PEXPIRE', KEYS[2], pttl)
+    end
+    redis.call('DEL', KEYS[1])
+    return 1
+    """
+
+    @classmethod
+    def generate_key(cls, keyParams):
+        return 'outboundsmscounter_%s_{%s}' % (cls.algorithm, keyParams[0])
+
+    @classmethod
+    def legacy_number(cls, key):
+        """
+        return:
+            the from number of a legacy counter key, None for any other
+            key, type string
+        """
+        key = key.decode() if isinstance(key, bytes) else key
+        number = key[len(cls.legacy_prefix):]
+        if not key.startswith(cls.legacy_prefix) or not number or \
+                '_' in number or '{' in number:
+            return None
+        return number
+
+    def migrate_legacy_keys(self, batch=1000):
+        """
+        Adds every legacy counter to the counter of its number, which keeps
+        its own window when it was hit already, and deletes it. Counts
+        sent while the command runs are added too, it can be run again.
+
+        return:
+            count of counters migrated, type int
+        raises:
+            ValueError when the counters are not kept in fixed windows,
+            the legacy counts can not be converted then
+        """
+        if self.algorithm != 'fixed_window':
+            raise ValueError('%s counters can not take fixed window counts' % self.algorithm)
+        if isinstance(self.connection, ShardedRedis):
+            return 0
+        sha = self.connection.script_load(self._migrate)
+        migrated = 0
+        keys = []
+        for key in self.connection.scan_iter(match=self.legacy_prefix + '*', count=batch):
+            number = self.legacy_number(key)
+            if number is not None:
+                keys.append((key, self.generate_key([number])))
+            if len(keys) >= batch:
+                migrated += self._migrate_keys(sha, keys)
+                keys = []
+        return migrated + self._migrate_keys(sha, keys)
+
+    def _migrate_keys(self, sha, keys):
+        if not keys:
+            return 0
+        p = self.connection.pipeline(transaction=False)
+        for legacy_key, key in keys:
+            p.evalsha(sha, 2, legacy_key, key)
+        return sum(p.execute())
+
+local_outbound_limiter = LocalRateLimiter()
+
+class QuotaUsage(RedisStore):
+    """
+    Outbound quota left for every number of an account, one hash per
+    account, `quota:{account}`, with a `limit:remaining:reset at` field per
+    number. OutboundSMSCounter hits write it along with their counter, see
+    RateLimiter, so the quota of all the numbers of an account is read with
+    one HGETALL. Numbers without a field, or whose reset is past, have
+    their whole limit left. Remaining is as of the latest sms of a number,
+    algorithms whose window slides may have given some back since.
+
+    On a sharded redis the hash and the counters are on different nodes,
+    the fields are then written by record, a round trip of its own.
+    """
+
+    _record = """
+    local now = tonumber(redis.call('TIME')[1])
+    local expire = 1
+    for i = 1, #ARGV, 4 do
+        local reset = tonumber(ARGV[i + 3])
+        redis.call(
+            'HSET', KEYS[1], ARGV[i],
+            string.format('%d:%d:%d', tonumber(ARGV[i + 1]), tonumber(ARGV[i + 2]), now + reset)
+        )
+        expire = math.max(expire, reset)
+    end
+    if redis.call('TTL', KEYS[1]) < expire then
+        redis.call('EXPIRE', KEYS[1], expire)
+    end
+    """
 
     @staticmethod
     def generate_key(keyParams):
-        return 'outboundsmscounter_%s' % keyParams[0]
+        return 'quota:{%s}' % keyParams[0]
+
+    @classmethod
+    def usage(cls, account_id, number):
+        """The usage param of the OutboundSMSCounter hit of an sms."""
+        return cls.generate_key([account_id]), number
+
+    @timed_redis_call
+    def record(self, account_id, hits):
+        """
+        params:
+            account_id, type int
+            hits, type list(tuple(number, limit, RateLimit))
+        """
+        if not hits:
+            return
+        args = []
+        for number, limit, rate_limit in hits:
+            args += [number, limit, rate_limit.remaining, rate_limit.reset]
+        script = self.registered_script(self._record)
+        script(keys=[self.generate_key([account_id])], args=args)
+
+    @timed_redis_call
+    def read(self, account_id, now=None):
+        """
+        return:
+            (limit, remaining, seconds to reset) per number whose reset is
+            still to come, type dict
+        """
+        now = now or int(time.time())
+        usage = {}
+        for number, value in self.connection.hgetall(self.generate_key([account_id])).items():
+            limit, remaining, reset_at = [int(v) for v in value.split(b':')]
+            if reset_at > now:
+                usage[number.decode()] = (limit, remaining, reset_at - now)
+        return usage
+
+class OutboundSMSQueue(StreamQueue):
+    """Accepted outbound sms waiting for the dispatch_sms workers."""
+
+    name = 'outboundsms'
+    group = 'dispatchers'
+    max_attempts = DISPATCH_MAX_ATTEMPTS
+    retry_delay = DISPATCH_RETRY_DELAY
+    max_length = DISPATCH_STREAM_MAX_LENGTH
+    max_dead_length = DISPATCH_DEAD_MAX_LENGTH
+
+    @staticmethod
+    def message(sms, account_id):
+        return {
+            'from': sms.sms_from,
+            'to': sms.sms_to,
+            'text': sms.sms_text,
+            'account': account_id,
+        }
+
+
+class IdempotencyStore(RedisStore):
+    """
+    Responses of outbound sms requests per account and idempotency key,
+    `idempotency:{account}:key`. claim marks a key as in flight with SET
+    NX and reads it back in the same round trip, so a request learns
+    whether it is the first one with its key, a duplicate of one in
+    flight, or a replay of one already answered.
+
+    Every response saved is kept along with a fingerprint of its sms, for
+    a key reused with a different sms to be told apart from a replay.
+    """
+
+    ttl = IDEMPOTENCY_KEY_TTL
+    pending_ttl = IDEMPOTENCY_PENDING_TTL
+    in_flight = b'-'
+
+    @staticmethod
+    def generate_key(keyParams):
+        return 'idempotency:{%s}:%s' % (keyParams[0], keyParams[1])
+
+    @staticmethod
+    def fingerprint(sms):
+        return hashlib.sha1(
+            '\0'.join([sms.sms_from, sms.sms_to, sms.sms_text]).encode()
+        ).hexdigest()
+
+    @classmethod
+    def content_key(cls, sms):
+        """A key of the sms itself, for clients not sending one."""
+        return 'sms:%s' % cls.fingerprint(sms)
+
+    @timed_redis_call
+    def claim(self, key):
+        """
+        return:
+            None when the key was free and is now in flight, in_flight
+            when another request holds it, the stored response otherwise,
+            type dict
+        """
+        p = self.connection.pipeline()
+        p.set(key, self.in_flight, nx=True, ex=self.pending_ttl)
+        p.get(key)
+        claimed, stored = p.execute()
+        if claimed:
+            return None
+        if stored is None or stored == self.in_flight:
+            return self.in_flight
+        return json.loads(stored.decode())
+
+    @timed_redis_call
+    def save(self, key, sms, status, data, ttl=None):
+        return self.connection.set(key, json.dumps({
+            'sms': self.fingerprint(sms), 'status': status, 'data': data,
+        }), ex=ttl or self.ttl)
+
+    @timed_redis_call
+    def release(self, key):
+        """Frees a key whose request failed, for the client to retry."""
+        return self.connection.delete(key)
+
+
+class DispatchBuffer(object):
+    """
+    Outbound sms accepted while the OutboundSMSQueue could not be reached,
+    which only happens when failing open in degraded mode. The worker keeps
+    them and queues them along with its next outbound sms, they are lost
+    if it dies before.
+    """
+
+    max_size = DEGRADED_DISPATCH_BUFFER
+
+    def __init__(self):
+        self._messages = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, message):
+        """
+        return:
+            False when the buffer is full, type bool
+        """
+        with self._lock:
+            if len(self._messages) >= self.max_size:
+                return False
+            self._messages.append(message)
+            return True
+
+    def take(self):
+        with self._lock:
+            messages, self._messages = self._messages, []
+        return messages
+
+    def put_back(self, messages):
+        with self._lock:
+            self._messages[:0] = messages
+
+dispatch_buffer = DispatchBuffer()
+
+class PhoneNumberIndex(RedisStore):
+    """
+    The set of numbers owned by an account, loaded lazily from the DB. The
+    set always holds an empty marker member, so that a loaded set is never
+    empty and a number missing from it is a cached negative answer.
+
+    Every change made to the numbers of an account after it was read from
+    the DB bumps the version of its index, kept next to the set. A load
+    only happens when the version is still the one read along with the
+    set, so that numbers read before a change can not replace the index
+    with what they were.
+    """
+
+    ttl = PHONE_NUMBER_INDEX_TTL
+    loaded_marker = ''
+    # Numbers per SADD of a load, within the stack of lua
+    load_chunk_size = 1000
+
+    _add_if_loaded = """
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        return redis.call('SADD', KEYS[1], ARGV[1])
+    end
+    return 0
+    """
+
+    _remove = """
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return redis.call('SREM', KEYS[1], ARGV[1])
+    """
+
+    _load_if_current = """
+    if ARGV[1] ~= '' and (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+    local step = tonumber(ARGV[3])
+    for i = 4, #ARGV, step do
+        redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + step - 1, #ARGV)))
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+    """
+
+    def __init__(self, connection=None):
+        super().__init__(connection)
+        self.version = None
+
+    @staticmethod
+    def generate_key(keyParams):
+        return 'phonenumbers_%s' % keyParams[0]
+
+    @classmethod
+    def generate_version_key(cls, keyParams):
+        """Tagged with the key of the set, for both to share a node."""
+        return '{%s}:version' % cls.generate_key(keyParams)
+
+    def _keys(self, account_id):
+        return [self.generate_key([account_id]), self.generate_version_key([account_id])]
+
+    @timed_redis_call
+    def contains(self, account_id, number):
+        """
+        Keeps the version of the index in self.version, for a load after
+        an unloaded answer.
+
+        params:
+            account_id, type int
+            number, type string
+        return:
+            True or False, None when the index of the account is not loaded
+        """
+        key, version_key = self._keys(account_id)
+        p = self.connection.pipeline(transaction=False)
+        p.exists(key)
+        p.get(version_key)
+        p.sismember(key, number)
+        loaded, self.version, is_member = p.execute()
+        if not loaded:
+            return None
+        return bool(is_member)
+
+    @timed_redis_call
+    def contains_many(self, account_id, numbers):
+        """
+        Keeps the version of the index in self.version, like contains.
+
+        params:
+            account_id, type int
+            numbers, type list(string)
+        return:
+            the owned subset of numbers, type set, None when the index of
+            the account is not loaded
+        """
+        key, version_key = self._keys(account_id)
+        p = self.connection.pipeline(transaction=False)
+        p.exists(key)
+        p.get(version_key)
+        for number in numbers:
+            p.sismember(key, number)
+        loaded, self.version, *is_member = p.execute()
+        if not loaded:
+            return None
+        return {n for n, member in zip(numbers, is_member) if member}
+
+    @timed_redis_call
+    def load(self, account_id, numbers, version=None):
+        """
+        params:
+            account_id, type int
+            numbers read from the DB, type iterable(string)
+            version read before them, by contains or contains_many, None
+            to load whatever it is
+        return:
+            whether the index was loaded, type bool
+        """
+        if version is not None:
+            version = int(version or 0)
+        script = self.registered_script(self._load_if_current)
+        return bool(script(
+            keys=self._keys(account_id),
+            args=['' if version is None else version, self.ttl, self.load_chunk_size,
+                  self.loaded_marker] + list(numbers),
+        ))
+
+    @timed_redis_call
+    def add(self, account_id, number):
+        """Adds to an already loaded index only, an unloaded one gets
+        the number from the DB when it is loaded."""
+        script = self.registered_script(self._add_if_loaded)
+        return script(keys=self._keys(account_id), args=[number, self.ttl])
+
+    @timed_redis_call
+    def remove(self, account_id, number):
+        script = self.registered_script(self._remove)
+        return script(keys=self._keys(account_id), args=[number, self.ttl])
+
+    @timed_redis_call
+    def invalidate(self, account_ids, chunk_size=1000):
+        """Drops the indexes of the accounts, for numbers written without
+        the signals, they are loaded again from the DB on their next use."""
+        account_ids = list(account_ids)
+        for start in range(0, len(account_ids), chunk_size):
+            p = self.connection.pipeline(transaction=False)
+            for account_id in account_ids[start:start + chunk_size]:
+                key, version_key = self._keys(account_id)
+                p.delete(key)
+                p.incr(version_key)
+                p.expire(version_key, self.ttl)
+            p.execute()
+
+
+class AccountCache(InvalidatedLocalCache):
+    """Verified (username, auth_id) pairs mapped to their Account, so that
+    authenticated requests do not need a DB round trip. Invalidations name
+    the id of an account and drop every pair of it."""
+
+    channel = ACCOUNT_CHANNEL
+    max_size = ACCOUNT_CACHE_MAX_SIZE
+    ttl = ACCOUNT_CACHE_TTL
+
+    @staticmethod
+    def generate_key(keyParams):
+        return tuple(keyParams)
+
+    # Invalidates every account
+    ALL = '*'
+
+    def decode_message(self, data):
+        data = data.decode() if isinstance(data, bytes) else data
+        return data if data == self.ALL else int(data)
+
+    def encode_message(self, account_id):
+        return str(account_id)
+
+    def delete_where(self, predicate):
+        with self._lock:
+            self.generation += 1
+        super().delete_where(predicate)
+
+    def invalidate(self, account_id):
+        if account_id == self.ALL:
+            self.delete_where(lambda key, cached: True)
+        else:
+            self.delete_where(lambda key, cached: cached.pk == account_id)
+
+    def invalidate_account(self, account):
+        self.delete_where(
+            lambda key, cached: key[0] == account.username or cached.pk == account.pk
+        )
+
+account_cache = AccountCache()
+
+
+class OutboundLimitCache(InvalidatedLocalCache):
+    """The OutboundLimit overrides of an account, mapped from number to
+    (limit, window), None being the number of the account wide one.
+    Invalidations name the id of the account."""
+
+    channel = OUTBOUND_LIMIT_CHANNEL
+    max_size = ACCOUNT_CACHE_MAX_SIZE
+    ttl = OUTBOUND_LIMIT_CACHE_TTL
+
+    @staticmethod
+    def generate_key(keyParams):
+        return keyParams[0]
+
+    def decode_message(self, data):
+        return int(data)
+
+    def encode_message(self, account_id):
+        return str(account_id)
+
+outbound_limit_cache = OutboundLimitCache()
@@ -1,24 +1,66 @@
 # Create your views here.
 
-from copy import deepcopy
+import ipaddress
+import time
 
+from django.http import HttpResponse, HttpResponseNotFound
+from redis import RedisError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.status import HTTP_200_OK, HTTP_202_ACCEPTED
 from rest_framework.status import HTTP_400_BAD_REQUEST, HTTP_403_FORBIDDEN
-from rest_framework.status import HTTP_404_NOT_FOUND
+from rest_framework.status import HTTP_404_NOT_FOUND, HTTP_409_CONFLICT
+from rest_framework.status import HTTP_422_UNPROCESSABLE_ENTITY
 from rest_framework.status import HTTP_500_INTERNAL_SERVER_ERROR
+from rest_framework.status import HTTP_503_SERVICE_UNAVAILABLE, is_success
 
-from utils.caches import RedisConnection, PROD_REDIS_URL, TEST_REDIS_URL
+from utils.caches import RateLimitStatus
+from utils.fastjson import EncodedBody
+from utils.sharding import ShardedRedis
+from utils import metrics
+from utils.metrics import MESSAGES, Outcome, REQUEST_LATENCY, STAGE_LATENCY
 
 from .authentication import AccountBasicAuthentication
-from .constants import ErrorMessage, FIELD_REQUIRED_MESSAGE 
-from .constants import MAX_OUTBOUND_SMS_PER_NUMBER, SERIALIZER_FIELD_PREFIX
+from .constants import DEGRADED_STOP_POLICY, DEGRADED_WORKERS
+from .constants import DegradedStopPolicy, ErrorMessage, FIELD_REQUIRED_MESSAGE 
+from .constants import IDEMPOTENCY_CONTENT_WINDOW, IDEMPOTENCY_KEY_HEADER
+from .constants import IDEMPOTENCY_KEY_MAX_LENGTH
+from .constants import MAX_BATCH_SIZE, METRICS_ALLOWED_NETWORKS, SERIALIZER_FIELD_PREFIX
 from .constants import SMSParams, SMSType, STOP_MESSAGE, SuccessMessage
-from .models import PhoneNumber
-from .serializers import SMSDataSerializer
-from .utils import OutboundSMSCounter, StopRequestStore
+from .models import Message, OutboundLimit, PhoneNumber, message_log
+from .serializers import SMSDataParser, SMSDataSerializer
+from .utils import IdempotencyStore, OutboundSMSCounter, OutboundSMSQueue
+from .utils import PhoneNumberIndex, QuotaUsage
+from .utils import StopRequestStore
+from .utils import api_connection, dispatch_buffer, local_outbound_limiter
+from .utils import stop_request_near_cache
+
+"""
+Bodies of the responses that never change, encoded once, for
+FastJSONRenderer to send them without serializing anything. Errors that
+name a number are the only ones not in there.
+"""
+_FIELDS = [SMSParams.FROM, SMSParams.TO, SMSParams.TEXT]
+CONSTANT_BODIES = {
+    (error, message): EncodedBody(error=error, message=message)
+    for error, message in
+    [("", SuccessMessage.SMS_REQUEST_OK % t) for t in (SMSType.INBOUND, SMSType.OUTBOUND)] +
+    [(template % field, "") for template in (
+        ErrorMessage.PARAM_MISSING, ErrorMessage.PARAM_INVALID
+    ) for field in _FIELDS] +
+    [(ErrorMessage.PARAM_NOT_FOUND % field, "") for field in (SMSParams.FROM, SMSParams.TO)] +
+    [(error, "") for error in (
+        ErrorMessage.DATA_INVALID,
+        ErrorMessage.BATCH_INVALID,
+        ErrorMessage.BATCH_TOO_LARGE % MAX_BATCH_SIZE,
+        ErrorMessage.UNKNOWN_FAILURE,
+        ErrorMessage.UNAVAILABLE,
+        ErrorMessage.IDEMPOTENCY_KEY_INVALID,
+        ErrorMessage.IDEMPOTENCY_KEY_IN_FLIGHT,
+        ErrorMessage.IDEMPOTENCY_KEY_REUSED,
+    )]
+}
 
 
 class BaseView(APIView):
@@ -39,6 +81,34 @@ class BaseView(APIView):
     """
     permission_classes = [IsAuthenticated]
 
+    """
+    Single message views count their one message in dispatch, batch views
+    count every message of the batch.
+    """
+    counts_message = True
+
+    def dispatch(self, request, *args, **kwargs):
+        """Records the latency and the outcome of every request."""
+        match = request.resolver_match
+        self._endpoint = match.url_name if match else self.__class__.__name__
+
+        start = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        outcome = Outcome.of(response)
+        REQUEST_LATENCY.labels(endpoint=self._endpoint, outcome=outcome).observe(
+            time.perf_counter() - start
+        )
+        if self.counts_message:
+            MESSAGES.labels(endpoint=self._endpoint, outcome=outcome).inc()
+        return response
+
+    def _timed(self, stage):
+        endpoint = getattr(self, '_endpoint', self.__class__.__name__)
+        return metrics.timed(STAGE_LATENCY, endpoint=endpoint, stage=stage)
+
+    def perform_authentication(self, request):
+        with self._timed('authentication'):
+            super().perform_authentication(request)
 
     def _from_request_key(self, key):
         """
@@ -97,7 +167,10 @@ class BaseView(APIView):
         return:
             DRF Response object
         """
-        return Response({"error": error, "message": message}, status)
+        data = CONSTANT_BODIES.get((error, message))
+        if data is None:
+            data = {"error": error, "message": message}
+        return Response(data, status)
 
     def _error_response(self, error, status=HTTP_400_BAD_REQUEST):
         """
@@ -138,6 +211,20 @@ class BaseView(APIView):
             ErrorMessage.UNKNOWN_FAILURE, status=HTTP_500_INTERNAL_SERVER_ERROR
         )
 
+    def _unavailable_response(self):
+        """
+        For what can not be done while redis is unavailable, the client is
+        expected to retry.
+
+        params:
+            No params
+        return:
+            DRF Response object
+        """
+        return self._error_response(
+            ErrorMessage.UNAVAILABLE, status=HTTP_503_SERVICE_UNAVAILABLE
+        )
+
     def _process_validation_errors(self, errors):
         """
         Method for processing errors that got generated while validating the
@@ -190,65 +277,96 @@ class BaseView(APIView):
         #If the data received is not a dictionary, inform the user
         if not isinstance(request.data, dict):
             return self._error_response(ErrorMessage.DATA_INVALID)
-        
-        data = {}
-        self.integration_test = False
-        if request.data:
-            data = deepcopy(request.data)
-            if 'integration_test' in data:
-                self.integration_test = True
-                del data['integration_test']
-            data = self._format_data(data) 
-
-        cache_db_url = None
-        if self.integration_test:
-            cache_db_url = TEST_REDIS_URL
-        else:
-            cache_db_url = PROD_REDIS_URL
-        self._cache = RedisConnection.get_connection(cache_db_url)
-        
-        data = self._format_data(request.data) if request.data else {}
-        serializer = SMSDataSerializer(data=data)
-        if serializer.is_valid():
-            sms = serializer.save()
+
+        self.integration_test = 'integration_test' in request.data
+        self._cache = self._get_cache()
+
+        # The parser only reads the sms fields, extra keys are left alone
+        with self._timed('validation'):
+            sms, errors = SMSDataParser.parse(request.data)
+        if sms:
             resp = self._process_request(request, sms)
         else:
-            resp = self._process_validation_errors(serializer.errors)
-        
+            resp = self._process_validation_errors(errors)
+
         delattr(self, '_cache')
         return resp
 
+    def _log(self, request, smses):
+        """Accepted sms are written to the message table behind the
+        request, by message_log."""
+        message_log.add_many([
+            Message.row(self.sms_type, request.user.id, sms) for sms in smses
+        ])
+
+    def _get_cache(self):
+        return api_connection(self.integration_test)
+
+    def _run_chain(self, request, sms, execution_chain):
+        for func in execution_chain:
+            with self._timed(func.__name__):
+                is_valid, response = func(request, sms)
+            if is_valid:
+                continue
+            return response
+
     def _process_request(self, request, sms, execution_chain):
+        """
+        When redis fails, its circuit breaker being open included, the
+        request starts over with the degraded chain of the view.
+        """
         try:
-            for func in execution_chain:
-                is_valid, response = func(request, sms)
-                if is_valid:
-                    continue
-                return response
-        except Exception as e:
+            try:
+                return self._run_chain(request, sms, execution_chain)
+            except RedisError:
+                return self._run_chain(request, sms, self._degraded_chain())
+        except RedisError:
+            return self._unavailable_response()
+        except Exception:
             return self._unknown_failure_response()
 
+    def _degraded_chain(self):
+        return [self._unavailable]
+
+    def _unavailable(self, request, sms):
+        return False, self._unavailable_response()
+
 
 class InboundSMSView(BaseView):
 
+    sms_type = SMSType.INBOUND
+
+    def _to_not_found_response(self, sms):
+        return self._error_response(
+            ErrorMessage.PARAM_NOT_FOUND % SMSParams.TO,
+            HTTP_404_NOT_FOUND
+        )
+
     def _validate_to_number(self, request, sms):
-        is_valid = PhoneNumber.number_exists(request.user.id, sms.sms_to)
+        is_valid = PhoneNumber.number_exists(
+            request.user.id, sms.sms_to, self._cache
+        )
         if is_valid:
             return True, None
         else:
-            resp = self._error_response(
-                ErrorMessage.PARAM_NOT_FOUND % SMSParams.TO,
-                HTTP_404_NOT_FOUND
-            )
-            return False, resp
+            return False, self._to_not_found_response(sms)
 
     def _handle_stop_request(self, request, sms):
         if sms.sms_text.strip() == STOP_MESSAGE:
-            store = StopRequestStore(self._cache)
-            key = StopRequestStore.generate_key([sms.sms_from, sms.sms_to])
-            store.set(key, True)
+            store = StopRequestStore(self._cache, stop_request_near_cache)
+            store.add(StopRequestStore.generate_key([sms.sms_from, sms.sms_to]))
         return True, None
 
+    def _handle_stop_request_degraded(self, request, sms):
+        """A STOP that can not be stored is refused, for it to be retried
+        rather than lost."""
+        if sms.sms_text.strip() == STOP_MESSAGE:
+            return False, self._unavailable_response()
+        return True, None
+
+    def _degraded_chain(self):
+        return [self._validate_to_number, self._handle_stop_request_degraded]
+
     def _process_request(self, request, sms):
 
         execution_chain = [
@@ -259,63 +377,543 @@ class InboundSMSView(BaseView):
         if resp:
             return resp
         else:
+            self._log(request, [sms])
             return self._accepted_response(
-                SuccessMessage.SMS_REQUEST_OK % SMSType.INBOUND
+                SuccessMessage.SMS_REQUEST_OK % self.sms_type
             )
 
 
 class OutboundSMSView(BaseView):
 
+    """
+    With fused_chain all redis reads of the execution chain go out together
+    as a single guarded OutboundSMSCounter hit. The counter is only
+    incremented when the from number is ours and the sms is not blocked by a
+    STOP request, so blocked messages do not use up the quota. Without it
+    the checks below run one after another as separate round trips. On a
+    sharded redis the ownership check goes first, on the node of the
+    account, the rest stays a single hit on the node of the from number.
+    While redis is unavailable the degraded chain runs instead. Accepted
+    sms are queued on the OutboundSMSQueue for the dispatch_sms workers.
+
+    A request with an Idempotency-Key header, or any request when
+    IDEMPOTENCY_CONTENT_WINDOW is set, first claims its key in the
+    IdempotencyStore, and a replay gets the stored response without
+    running the chain again.
+    """
+    fused_chain = True
+
+    sms_type = SMSType.OUTBOUND
+
+    def _from_not_found_response(self, sms):
+        return self._error_response(
+            ErrorMessage.PARAM_NOT_FOUND % SMSParams.FROM,
+            HTTP_404_NOT_FOUND
+        )
+
+    def _limit_reached_response(self, sms):
+        error = ErrorMessage.LIMIT_REACHED % sms.sms_from
+        resp = self._error_response(error, HTTP_403_FORBIDDEN)
+        resp.outcome = Outcome.LIMIT
+        return resp
+
+    def _sms_blocked_response(self, sms):
+        error = ErrorMessage.SMS_BLOCKED % (sms.sms_from, sms.sms_to)
+        resp = self._error_response(error, HTTP_403_FORBIDDEN)
+        resp.outcome = Outcome.STOP
+        return resp
+
     def _validate_from_number(self, request, sms):
-        is_valid = PhoneNumber.number_exists(request.user.id, sms.sms_from)
+        is_valid = PhoneNumber.number_exists(
+            request.user.id, sms.sms_from, self._cache
+        )
         if is_valid:
             return True, None
         else:
-            resp = self._error_response(
-                ErrorMessage.PARAM_NOT_FOUND % SMSParams.FROM,
-                HTTP_404_NOT_FOUND
-            )
-            return False, resp
+            return False, self._from_not_found_response(sms)
+
+    def _usage(self, request, sms):
+        """Where the hit of the sms leaves the quota of its number, None
+        when it can not be written by the hit itself."""
+        if isinstance(self._cache, ShardedRedis):
+            return None
+        return QuotaUsage.usage(request.user.id, sms.sms_from)
+
+    def _record_usage(self, request, hits):
+        """
+        Writes the quota left after the allowed hits, on a sharded redis,
+        where the hits could not.
+
+        params:
+            hits, type list(tuple(SMSData, limit, RateLimit))
+        """
+        if not isinstance(self._cache, ShardedRedis):
+            return
+        QuotaUsage(self._cache).record(request.user.id, [
+            (sms.sms_from, limit or OutboundSMSCounter.limit, rate_limit)
+            for sms, limit, rate_limit in hits if rate_limit.allowed
+        ])
 
     def _check_request_limit(self, request, sms):
         key = OutboundSMSCounter.generate_key([sms.sms_from])
         store = OutboundSMSCounter(self._cache)
-        counter = store.get(key)
-        
-        if counter is None:
-            store.setincr(key, 1)
+        limit, window = OutboundLimit.limit_for(request.user.id, sms.sms_from)
+        rate_limit = store.hit(
+            key, limit=limit, window=window, usage=self._usage(request, sms)
+        )
+        if rate_limit.allowed:
+            self._record_usage(request, [(sms, limit, rate_limit)])
             return True, None
+        return False, self._limit_reached_response(sms)
 
-        counter = int(counter)
-        if counter >= MAX_OUTBOUND_SMS_PER_NUMBER:
-            error = ErrorMessage.LIMIT_REACHED % sms.sms_from
-            resp = self._error_response(error, HTTP_403_FORBIDDEN)
-            return False, resp
-        else:
-            store.incr(key, 1)
+    def _check_stop_request(self, request, sms):
+        store = StopRequestStore(self._cache, stop_request_near_cache)
+        if store.is_stopped([sms.sms_to, sms.sms_from]):
+            return False, self._sms_blocked_response(sms)
+        return True, None
+
+    def _check_fused_chain(self, request, sms):
+        store = OutboundSMSCounter(self._cache)
+        key = OutboundSMSCounter.generate_key([sms.sms_from])
+        member_of = (
+            PhoneNumberIndex.generate_key([request.user.id]), sms.sms_from
+        )
+        blocked_by = StopRequestStore(self._cache).blockers([sms.sms_to, sms.sms_from])
+        limit, window = OutboundLimit.limit_for(request.user.id, sms.sms_from)
+
+        if isinstance(self._cache, ShardedRedis):
+            # The index of the account is on its own node, only the keys
+            # tagged with the from number share one with the counter. Redis
+            # failing, the degraded chain decides whether to ask the DB.
+            if not PhoneNumber.number_exists(
+                request.user.id, sms.sms_from, self._cache, db_fallback=False
+            ):
+                return False, self._from_not_found_response(sms)
+            member_of = None
+
+        usage = self._usage(request, sms)
+        rate_limit = store.hit(
+            key, member_of=member_of, blocked_by=blocked_by, limit=limit,
+            window=window, usage=usage
+        )
+        if rate_limit.status == RateLimitStatus.MEMBERSHIP_UNKNOWN:
+            # Cold index, number_exists loads it from the DB. Ownership is
+            # then known, so the retry does not need the membership guard.
+            if not PhoneNumber.number_exists(
+                request.user.id, sms.sms_from, self._cache
+            ):
+                return False, self._from_not_found_response(sms)
+            rate_limit = store.hit(
+                key, blocked_by=blocked_by, limit=limit, window=window,
+                usage=usage
+            )
+
+        self._record_usage(request, [(sms, limit, rate_limit)])
+        resp = self._rate_limit_response(sms, rate_limit)
+        return resp is None, resp
+
+    def _check_stop_policy(self, request, sms):
+        if DEGRADED_STOP_POLICY == DegradedStopPolicy.FAIL_OPEN:
             return True, None
+        return False, self._unavailable_response()
 
-    def _check_stop_request(self, request, sms):
-        key = StopRequestStore.generate_key([sms.sms_to, sms.sms_from])
-        store = StopRequestStore(self._cache)
-        if store.exists(key):
-            error = ErrorMessage.SMS_BLOCKED % (sms.sms_from, sms.sms_to)
-            resp = self._error_response(error, HTTP_403_FORBIDDEN)
-            return False, resp
+    def _check_local_limit(self, request, sms):
+        """This worker's share of the limit, counted in process."""
+        limit, window = OutboundLimit.limit_for(request.user.id, sms.sms_from)
+        limit = max(1, (limit or OutboundSMSCounter.limit) // DEGRADED_WORKERS)
+        key = OutboundSMSCounter.generate_key([sms.sms_from])
+        if local_outbound_limiter.hit(key, limit, window or OutboundSMSCounter.ttl):
+            return True, None
+        return False, self._limit_reached_response(sms)
+
+    def _enqueue(self, request, sms):
+        """Hands the sms over to the dispatch_sms workers, a single XADD,
+        along with the ones buffered while redis was unavailable."""
+        queue = OutboundSMSQueue(self._cache)
+        message = OutboundSMSQueue.message(sms, request.user.id)
+        if not len(dispatch_buffer):
+            queue.add(message)
+            return True, None
+
+        buffered = dispatch_buffer.take()
+        try:
+            queue.add_many(buffered + [message])
+        except RedisError:
+            dispatch_buffer.put_back(buffered)
+            raise
         return True, None
 
-    def _process_request(self, request, sms):
+    def _buffer(self, request, sms):
+        if dispatch_buffer.put(OutboundSMSQueue.message(sms, request.user.id)):
+            return True, None
+        return False, self._unavailable_response()
 
-        execution_chain = [
+    def _degraded_chain(self):
+        # Failing closed costs no DB query
+        return [
+            self._check_stop_policy,
             self._validate_from_number,
-            self._check_request_limit,
-            self._check_stop_request
+            self._check_local_limit,
+            self._buffer,
         ]
 
+    def _rate_limit_response(self, sms, rate_limit):
+        """
+        params:
+            sms, type SMSData
+            rate_limit, type RateLimit
+        return:
+            DRF Response object, None when the hit was allowed
+        """
+        if rate_limit.status == RateLimitStatus.ALLOWED:
+            return None
+        elif rate_limit.status == RateLimitStatus.NOT_MEMBER:
+            return self._from_not_found_response(sms)
+        elif rate_limit.status == RateLimitStatus.LIMITED:
+            return self._limit_reached_response(sms)
+        else:
+            return self._sms_blocked_response(sms)
+
+    def _idempotency_key(self, request, sms):
+        """
+        return:
+            (key, ttl), (None, None) when the request is not deduplicated
+        """
+        key = request.META.get(IDEMPOTENCY_KEY_HEADER)
+        if key is not None:
+            return IdempotencyStore.generate_key([request.user.id, key]), None
+        if IDEMPOTENCY_CONTENT_WINDOW:
+            key = IdempotencyStore.content_key(sms)
+            return (
+                IdempotencyStore.generate_key([request.user.id, key]),
+                IDEMPOTENCY_CONTENT_WINDOW
+            )
+        return None, None
+
+    def _replay_response(self, sms, stored):
+        if stored == IdempotencyStore.in_flight:
+            resp = self._error_response(
+                ErrorMessage.IDEMPOTENCY_KEY_IN_FLIGHT, HTTP_409_CONFLICT
+            )
+        elif stored['sms'] != IdempotencyStore.fingerprint(sms):
+            resp = self._error_response(
+                ErrorMessage.IDEMPOTENCY_KEY_REUSED, HTTP_422_UNPROCESSABLE_ENTITY
+            )
+        else:
+            resp = Response(stored['data'], stored['status'])
+            resp['Idempotent-Replayed'] = 'true'
+            resp.outcome = Outcome.REPLAYED
+        return resp
+
+    def _process_request(self, request, sms):
+        """
+        Claiming the key costs one redis round trip, when redis fails the
+        request goes on without deduplication. Only accepted sms are kept
+        for replays, a refused one, over its limit or blocked by a STOP
+        request, may well be accepted once retried.
+        """
+        key, ttl = self._idempotency_key(request, sms)
+        if key is None:
+            return self._process_sms(request, sms)
+        header = request.META.get(IDEMPOTENCY_KEY_HEADER)
+        if header is not None and not 0 < len(header) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            return self._error_response(ErrorMessage.IDEMPOTENCY_KEY_INVALID)
+
+        store = IdempotencyStore(self._cache)
+        try:
+            with self._timed('_claim_idempotency_key'):
+                stored = store.claim(key)
+        except RedisError:
+            return self._process_sms(request, sms)
+        if stored is not None:
+            return self._replay_response(sms, stored)
+
+        resp = self._process_sms(request, sms)
+        try:
+            if is_success(resp.status_code):
+                store.save(key, sms, resp.status_code, resp.data, ttl)
+            else:
+                store.release(key)
+        except RedisError:
+            # The key is freed when its claim expires
+            pass
+        return resp
+
+    def _process_sms(self, request, sms):
+
+        if self.fused_chain:
+            execution_chain = [self._check_fused_chain, self._enqueue]
+        else:
+            execution_chain = [
+                self._validate_from_number,
+                self._check_request_limit,
+                self._check_stop_request,
+                self._enqueue,
+            ]
+
         resp = super()._process_request(request, sms, execution_chain)
         if resp:
             return resp
         else:
+            self._log(request, [sms])
             return self._accepted_response(
-                SuccessMessage.SMS_REQUEST_OK % SMSType.OUTBOUND
+                SuccessMessage.SMS_REQUEST_OK % self.sms_type
+            )
+
+
+class BatchViewMixin(object):
+    """
+    Turns an SMS view into its batch variant, which takes a JSON array of
+    messages and answers with one result per message, in the same order,
+    carrying the same error/message/status as the single message view.
+    Ownership, STOP and limit checks are resolved for the whole batch at
+    once by _process_batch.
+
+    Since the payload is a list, integration tests flag themselves with an
+    `integration_test` query param.
+    """
+
+    counts_message = False
+
+    def _item_result(self, resp):
+        MESSAGES.labels(endpoint=self._endpoint, outcome=Outcome.of(resp)).inc()
+        result = dict(resp.data)
+        result['status'] = resp.status_code
+        return result
+
+    def _validate_batch(self, items, positions, results):
+        """
+        A list serializer validates the whole batch. When some messages are
+        invalid DRF does not hand out the valid ones, so those are then
+        validated again one by one through its child serializer.
+
+        params:
+            formatted messages, type list(dict)
+            their positions in the batch, type list(int)
+            results, type list, filled in for the invalid messages
+        return:
+            type list(tuple(position, SMSData))
+        """
+        serializer = SMSDataSerializer(data=items, many=True)
+        with self._timed('validation'):
+            is_valid = serializer.is_valid()
+        if is_valid:
+            return list(zip(positions, serializer.save()))
+
+        smses = []
+        for i, item, errors in zip(positions, items, serializer.errors):
+            if errors:
+                resp = self._process_validation_errors(errors)
+                results[i] = self._item_result(resp)
+            else:
+                child = serializer.child
+                smses.append((i, child.create(child.run_validation(item))))
+        return smses
+
+    def _process_degraded_batch(self, request, smses):
+        """
+        When redis fails, its circuit breaker being open included, every
+        message goes through the degraded chain of the view, as it would
+        when sent on its own.
+        """
+        accepted = self._accepted_response(
+            SuccessMessage.SMS_REQUEST_OK % self.sms_type
+        )
+        responses = []
+        logged = []
+        for sms in smses:
+            resp = self._run_chain(request, sms, self._degraded_chain())
+            if resp is None:
+                logged.append(sms)
+            responses.append(resp or accepted)
+        self._log(request, logged)
+        return responses
+
+    def post(self, request, format=None):
+
+        if not isinstance(request.data, list):
+            return self._error_response(ErrorMessage.BATCH_INVALID)
+        if len(request.data) > MAX_BATCH_SIZE:
+            return self._error_response(
+                ErrorMessage.BATCH_TOO_LARGE % MAX_BATCH_SIZE
             )
+
+        self.integration_test = 'integration_test' in request.query_params
+        self._cache = self._get_cache()
+
+        results = [None] * len(request.data)
+        positions = []
+        items = []
+        for i, item in enumerate(request.data):
+            if isinstance(item, dict):
+                positions.append(i)
+                items.append(self._format_data(item))
+            else:
+                resp = self._error_response(ErrorMessage.DATA_INVALID)
+                results[i] = self._item_result(resp)
+
+        smses = self._validate_batch(items, positions, results)
+        try:
+            try:
+                with self._timed('_process_batch'):
+                    responses = self._process_batch(
+                        request, [sms for _, sms in smses]
+                    )
+            except RedisError:
+                responses = self._process_degraded_batch(
+                    request, [sms for _, sms in smses]
+                )
+        except RedisError:
+            return self._unavailable_response()
+        except Exception:
+            return self._unknown_failure_response()
+        finally:
+            delattr(self, '_cache')
+
+        for (i, _), resp in zip(smses, responses):
+            results[i] = self._item_result(resp)
+
+        return Response({
+            "error": "",
+            "message": SuccessMessage.SMS_BATCH_OK % self.sms_type,
+            "results": results
+        }, HTTP_202_ACCEPTED)
+
+
+class InboundSMSBatchView(BatchViewMixin, InboundSMSView):
+
+    def _process_batch(self, request, smses):
+        if not smses:
+            return []
+
+        owned = PhoneNumber.numbers_owned(
+            request.user.id, [sms.sms_to for sms in smses], self._cache
+        )
+        stop_keys = [
+            StopRequestStore.generate_key([sms.sms_from, sms.sms_to])
+            for sms in smses
+            if sms.sms_to in owned and sms.sms_text.strip() == STOP_MESSAGE
+        ]
+        if stop_keys:
+            StopRequestStore(self._cache, stop_request_near_cache).add_many(stop_keys)
+
+        self._log(request, [sms for sms in smses if sms.sms_to in owned])
+        accepted = self._accepted_response(
+            SuccessMessage.SMS_REQUEST_OK % self.sms_type
+        )
+        return [
+            accepted if sms.sms_to in owned else self._to_not_found_response(sms)
+            for sms in smses
+        ]
+
+
+class OutboundSMSBatchView(BatchViewMixin, OutboundSMSView):
+
+    def _process_batch(self, request, smses):
+        if not smses:
+            return []
+
+        owned = PhoneNumber.numbers_owned(
+            request.user.id, [sms.sms_from for sms in smses], self._cache
+        )
+        stop_store = StopRequestStore(self._cache)
+        hits = []
+        limits = []
+        for sms in smses:
+            if sms.sms_from not in owned:
+                continue
+            limit, window = OutboundLimit.limit_for(request.user.id, sms.sms_from)
+            hits.append((
+                OutboundSMSCounter.generate_key([sms.sms_from]),
+                {
+                    'blocked_by': stop_store.blockers([sms.sms_to, sms.sms_from]),
+                    'limit': limit,
+                    'window': window,
+                    'usage': self._usage(request, sms),
+                }
+            ))
+            limits.append((sms, limit))
+        rate_limits = OutboundSMSCounter(self._cache).hit_many(hits)
+        self._record_usage(request, [
+            (sms, limit, rate_limit)
+            for (sms, limit), rate_limit in zip(limits, rate_limits)
+        ])
+        rate_limits = iter(rate_limits)
+
+        accepted = self._accepted_response(
+            SuccessMessage.SMS_REQUEST_OK % self.sms_type
+        )
+        responses = []
+        queued = []
+        for sms in smses:
+            if sms.sms_from not in owned:
+                responses.append(self._from_not_found_response(sms))
+            else:
+                resp = self._rate_limit_response(sms, next(rate_limits))
+                if resp is None:
+                    queued.append(sms)
+                responses.append(resp or accepted)
+        if queued:
+            OutboundSMSQueue(self._cache).add_many([
+                OutboundSMSQueue.message(sms, request.user.id) for sms in queued
+            ])
+            self._log(request, queued)
+        return responses
+
+
+class OutboundQuotaView(BaseView):
+    """
+    The outbound quota of every number of the account, its limit and
+    window, the sms it has left and the seconds until the whole limit is
+    back. Whatever the count of numbers, this costs one redis command, the
+    QuotaUsage hash of the account, and one query for its numbers.
+    """
+
+    counts_message = False
+
+    sms_type = SMSType.OUTBOUND
+
+    def get(self, request, format=None):
+        self.integration_test = 'integration_test' in request.query_params
+        try:
+            with self._timed('quota_usage'):
+                usage = QuotaUsage(self._get_cache()).read(request.user.id)
+        except RedisError:
+            return self._unavailable_response()
+
+        quota = {}
+        for number in PhoneNumber.objects.filter(account_id=request.user.id) \
+                .values_list('number', flat=True):
+            limit, window = OutboundLimit.limit_for(request.user.id, number)
+            limit = limit or OutboundSMSCounter.limit
+            remaining, reset = limit, 0
+            if number in usage:
+                _, remaining, reset = usage[number]
+                remaining = min(remaining, limit)
+            quota[number] = {
+                "limit": limit,
+                "window": window or OutboundSMSCounter.ttl,
+                "remaining": remaining,
+                "reset": reset,
+            }
+
+        return Response({
+            "error": "",
+            "message": SuccessMessage.QUOTA_OK % self.sms_type,
+            "quota": quota,
+        }, HTTP_200_OK)
+
+
+def metrics_view(request):
+    """
+    Metrics of all the workers, in the prometheus text format, to the
+    METRICS_ALLOWED_NETWORKS only. Everyone else gets a 404, as if there
+    were no such endpoint.
+    """
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        address = None
+    if address is None or not any(address in network for network in METRICS_ALLOWED_NETWORKS):
+        return HttpResponseNotFound()
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
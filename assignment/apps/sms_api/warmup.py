@@ -0,0 +1,166 @@
+import logging
+import time
+
+from collections import OrderedDict, defaultdict
+
+import redis
+
+from django.core.urlresolvers import get_resolver
+from django.db import DatabaseError, connections
+
+from utils.caches import PROD_REDIS_URL, RedisConnection
+from utils.sharding import ShardedRedis
+
+from .constants import ACCOUNT_CACHE_MAX_SIZE, WARMUP_REDIS_CONNECTIONS
+
+logger = logging.getLogger(__name__)
+
+"""
+Startup of the uwsgi workers. The master imports the app once, with
+preload(), so that every worker forks with DRF, the serializers and the
+views already in memory. Sockets can not be shared across a fork, hence
+each worker opens its own DB and redis connections, loads the lua
+scripts and fills its local caches with warm_up(), right after the fork
+and before it accepts a request. Without it the first requests of every
+worker pay for all of that, see the startup benchmark suite.
+"""
+
+
+def preload():
+    """
+    Imports and builds everything a request needs that holds no socket, it
+    is safe to run in the uwsgi master before the fork.
+    """
+    from rest_framework.settings import api_settings
+
+    from . import views
+    from .serializers import SMSDataParser
+
+    resolver = get_resolver()
+    resolver.url_patterns
+    resolver.reverse_dict
+    for setting in ('DEFAULT_RENDERER_CLASSES', 'DEFAULT_PARSER_CLASSES',
+                    'DEFAULT_AUTHENTICATION_CLASSES', 'DEFAULT_PERMISSION_CLASSES',
+                    'DEFAULT_CONTENT_NEGOTIATION_CLASS', 'EXCEPTION_HANDLER'):
+        getattr(api_settings, setting)
+    SMSDataParser.parse({})
+    # Nothing above should have connected, a socket opened in the master
+    # would be shared by all the workers
+    connections.close_all()
+
+
+def connect_db():
+    for connection in connections.all():
+        connection.ensure_connection()
+
+
+def connect_redis(url=PROD_REDIS_URL):
+    """
+    Opens WARMUP_REDIS_CONNECTIONS pooled connections per node and loads
+    the scripts of the stores, so that the first EVALSHA of every store
+    does not fail over to loading its script.
+    """
+    from .utils import OutboundSMSCounter, PhoneNumberIndex, StopRequestStore
+
+    client = RedisConnection.get_connection(url)
+    nodes = client.nodes.values() if isinstance(client, ShardedRedis) else [client]
+    for node in nodes:
+        pool = getattr(node, 'connection_pool', None)
+        if pool is None:
+            continue
+        opened = []
+        try:
+            for i in range(WARMUP_REDIS_CONNECTIONS):
+                conn = pool.get_connection('PING')
+                opened.append(conn)
+                conn.connect()
+        finally:
+            for conn in opened:
+                pool.release(conn)
+
+    for script in (OutboundSMSCounter._hit_script, StopRequestStore._add,
+                   StopRequestStore._is_stopped, PhoneNumberIndex._add_if_loaded,
+                   PhoneNumberIndex._remove, PhoneNumberIndex._load_if_current):
+        client.script_load(script)
+
+
+def listen(url=PROD_REDIS_URL):
+    """
+    Subscribes account_cache, outbound_limit_cache, and
+    stop_request_near_cache, to their invalidations. Only the classic
+    outbound chain reads the latter, the fused one checks STOP requests in
+    its single script, so a worker of the fused chain does not listen for
+    them.
+    """
+    from .utils import account_cache, outbound_limit_cache, stop_request_near_cache
+    from .views import OutboundSMSView
+
+    connection = RedisConnection.get_connection(url)
+    account_cache.listen(connection)
+    outbound_limit_cache.listen(connection)
+    if not OutboundSMSView.fused_chain:
+        stop_request_near_cache.listen(connection)
+
+
+def prime_caches():
+    """
+    Fills account_cache with up to ACCOUNT_CACHE_MAX_SIZE accounts and
+    outbound_limit_cache with the OutboundLimit overrides of those accounts,
+    there are few overrides so all of them are read. As in authentication,
+    neither is cached when an invalidation arrived while they were read,
+    it runs after the listen step for that.
+    """
+    from .models import Account, OutboundLimit
+    from .utils import AccountCache, OutboundLimitCache
+    from .utils import account_cache, outbound_limit_cache
+
+    generation = account_cache.generation
+    limits_generation = outbound_limit_cache.generation
+    accounts = list(Account.objects.order_by('id')[:ACCOUNT_CACHE_MAX_SIZE])
+    for account in accounts:
+        account._set_authenticated(True)
+        account_cache.set_if_current(
+            AccountCache.generate_key([account.username, account.auth_id]),
+            account, generation
+        )
+
+    limits = defaultdict(dict)
+    for account_id, number, limit, window in OutboundLimit.objects.values_list(
+            'account_id', 'number', 'limit', 'window'):
+        limits[account_id][number] = (limit, window)
+    for account in accounts:
+        outbound_limit_cache.set_if_current(
+            OutboundLimitCache.generate_key([account.id]), limits.get(account.id, {}),
+            limits_generation
+        )
+
+
+def warm_up(redis_url=PROD_REDIS_URL):
+    """
+    Runs every startup step, a step failing is logged and skipped, the
+    worker then does that work on its first requests instead.
+
+    params:
+        redis_url the requests are served from, type string
+    return:
+        seconds taken by every step, None for a failed one, type OrderedDict
+    """
+    steps = OrderedDict([
+        ('preload', preload),
+        ('connect_db', connect_db),
+        ('connect_redis', lambda: connect_redis(redis_url)),
+        ('listen', lambda: listen(redis_url)),
+        ('prime_caches', prime_caches),
+    ])
+    timings = OrderedDict()
+    for name, step in steps.items():
+        start = time.perf_counter()
+        try:
+            step()
+        except (DatabaseError, redis.RedisError):
+            logger.exception('Worker warm up step %s failed', name)
+            timings[name] = None
+        else:
+            timings[name] = round(time.perf_counter() - start, 6)
+    logger.info('Worker warmed up in %s', dict(timings))
+    return timings
@@ -0,0 +1,26 @@
+"""
+Serving profile of the sms_api endpoints alone, see api_wsgi.py. No
+session, CSRF, messages, auth or clickjacking middleware runs and URLs
+resolve straight to the views, without the admin URLconf. The admin stays
+on the full stack of prod_settings, served by wsgi.py.
+"""
+
+from .prod_settings import *
+
+INSTALLED_APPS = [
+    app for app in INSTALLED_APPS if app not in (
+        'django.contrib.admin',
+        'django.contrib.sessions',
+        'django.contrib.messages',
+        'django.contrib.staticfiles',
+    )
+]
+
+MIDDLEWARE = API_MIDDLEWARE
+
+ROOT_URLCONF = API_ROOT_URLCONF
+
+# The browsable API needs the templates and static files of the full stack
+REST_FRAMEWORK = dict(
+    REST_FRAMEWORK, DEFAULT_RENDERER_CLASSES=['utils.fastjson.FastJSONRenderer']
+)
@@ -0,0 +1,10 @@
+"""
+WSGI config of the API only serving profile, see api_settings.py and
+uwsgi_api.ini.
+"""
+
+import os
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'assignment.api_settings'
+
+from .wsgi import application
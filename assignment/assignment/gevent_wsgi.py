@@ -0,0 +1,16 @@
+"""
+WSGI config of the async serving mode, see uwsgi_async.ini.
+
+Every request runs in a greenlet. The standard library is monkey patched
+by gevent and psycopg2 by psycogreen, so waiting on redis or Postgres
+yields to the other in-flight requests of the worker instead of blocking
+it. Patching has to happen before anything else gets imported.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+from .wsgi import application
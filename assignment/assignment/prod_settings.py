@@ -10,5 +10,6 @@ ALLOWED_HOSTS = [
 ]
 
 DATABASES['default'] = dj_database_url.parse(os.environ['DATABASE_URL'])
+DATABASES['default']['ENGINE'] = 'utils.db.postgresql_pool'
 REDIS_URL = os.environ['REDIS_URL']
 
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
+import dj_database_url
 import os
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -54,6 +55,12 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'assignment.urls'
 
+# The sms_api endpoints are stateless and DRF authenticates every request,
+# none of the middleware above does anything for them. api_settings serves
+# them alone with this stack, routed to directly, see api_wsgi.py
+API_MIDDLEWARE = []
+API_ROOT_URLCONF = 'apps.sms_api.urls'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -72,13 +79,27 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'assignment.wsgi.application'
 
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'utils.fastjson.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'utils.fastjson.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
 
+# Connections are pooled per worker and put back at the end of every
+# request, see utils.db.postgresql_pool
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'utils.db.postgresql_pool',
         'NAME': 'assignment',
         'USER': 'assignment',
         'PASSWORD': 'assignment',
@@ -87,6 +108,18 @@ DATABASES = {
     }
 }
 
+# Reads of these models go to the read replicas, listed in
+# DB_REPLICA_URLS, see utils.db.routers
+DATABASE_ROUTERS = ['utils.db.routers.ReplicaRouter']
+REPLICA_MODELS = ['sms_api.Account', 'sms_api.PhoneNumber']
+DATABASE_REPLICAS = []
+for url in filter(None, os.environ.get('DB_REPLICA_URLS', '').split(',')):
+    alias = 'replica%d' % (len(DATABASE_REPLICAS) + 1)
+    DATABASES[alias] = dj_database_url.parse(url)
+    DATABASES[alias]['ENGINE'] = DATABASES['default']['ENGINE']
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
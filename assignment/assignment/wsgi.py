@@ -14,3 +14,33 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "assignment.prod_settings")
 
 application = get_wsgi_application()
+
+# The master imports the app once for all the workers, each of them warms
+# up its connections and caches, or at least listens for the invalidations
+# of its caches, and starts writing its accepted sms to the DB once forked,
+# when served by uwsgi
+from apps.sms_api import warmup
+from apps.sms_api.constants import WORKER_WARMUP
+from apps.sms_api.models import message_log
+from utils import metrics
+
+try:
+    import uwsgi
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+
+def register_exit():
+    """A worker restarted or recycled by uwsgi leaves its gauges behind."""
+    uwsgi.atexit = metrics.mark_process_dead
+
+
+warmup.preload()
+if postfork is None:
+    message_log.start()
+    warmup.listen()
+else:
+    postfork(register_exit)
+    postfork(message_log.start)
+    postfork(warmup.warm_up if WORKER_WARMUP else warmup.listen)
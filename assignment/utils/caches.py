@@ -1,28 +1,299 @@
+import logging
 import os
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+from collections import OrderedDict, namedtuple
+
 import redis
 
+from utils.metrics import CIRCUIT_STATE, CIRCUIT_TRANSITIONS, timed_redis_call
+from utils.metrics import REDIS_POOL_AVAILABLE, REDIS_POOL_IN_USE
+from utils.sharding import ShardedRedis
+
+logger = logging.getLogger(__name__)
+
 
+"""A comma separated list of urls shards the keys over all of them, see
+utils.sharding. REDIS_SHARD_URLS replaces the single prod node, and
+TEST_REDIS_SHARD_URLS the test one, e.g. with several local redis-server
+processes."""
 BASE_REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
-PROD_REDIS_URL = BASE_REDIS_URL + '/0'
-TEST_REDIS_URL = BASE_REDIS_URL + '/1'
+PROD_REDIS_URL = os.environ.get('REDIS_SHARD_URLS') or BASE_REDIS_URL + '/0'
+TEST_REDIS_URL = os.environ.get('TEST_REDIS_SHARD_URLS') or BASE_REDIS_URL + '/1'
+
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 20))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 1))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 0.25))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', 0.25))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30))
+
+"""After REDIS_CIRCUIT_FAILURES connection errors or timeouts in a row the
+circuit of a node opens, calls to it then fail at once for
+REDIS_CIRCUIT_RESET_TIMEOUT seconds before a single call probes it again."""
+REDIS_CIRCUIT_FAILURES = int(os.environ.get('REDIS_CIRCUIT_FAILURES', 5))
+REDIS_CIRCUIT_RESET_TIMEOUT = float(os.environ.get('REDIS_CIRCUIT_RESET_TIMEOUT', 5))
+
+
+class CircuitOpenError(redis.ConnectionError):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Per process state of the circuit of one redis node. Only connection
+    errors and timeouts count as failures, an error reply still proves the
+    node is up.
+    """
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    names = {CLOSED: 'closed', OPEN: 'open', HALF_OPEN: 'half_open'}
+
+    failures_to_open = REDIS_CIRCUIT_FAILURES
+    reset_timeout = REDIS_CIRCUIT_RESET_TIMEOUT
+
+    def __init__(self, node, failures_to_open=None, reset_timeout=None):
+        self.node = node
+        self.failures_to_open = failures_to_open or self.failures_to_open
+        self.reset_timeout = reset_timeout or self.reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.labels(node=node).set(self.state)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        CIRCUIT_STATE.labels(node=self.node).set(state)
+        CIRCUIT_TRANSITIONS.labels(node=self.node, state=self.names[state]).inc()
+        logger.warning('Redis circuit of %s is %s', self.node, self.names[state])
+
+    def allow(self):
+        """
+        return:
+            whether a call may go to the node, type bool
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failures_to_open:
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def release(self):
+        """Ends a call that says nothing of the node, a probe among them
+        lets the next call probe again."""
+        with self._lock:
+            self._probing = False
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError('Redis circuit of %s is open' % self.node)
+        try:
+            result = func(*args, **kwargs)
+        except (redis.ConnectionError, redis.TimeoutError):
+            self.failure()
+            raise
+        except redis.RedisError:
+            self.success()
+            raise
+        except BaseException:
+            # A bug of the caller, a gevent Timeout, KeyboardInterrupt
+            self.release()
+            raise
+        self.success()
+        return result
+
+
+class GuardedRedis(redis.StrictRedis):
+    """A client whose commands and pipelines go through a CircuitBreaker."""
+
+    def __init__(self, *args, breaker=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker or CircuitBreaker('redis')
+
+    def execute_command(self, *args, **options):
+        return self.breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        return GuardedPipeline(super().pipeline(*args, **kwargs), self.breaker)
+
+
+class GuardedPipeline(object):
+
+    def __init__(self, pipeline, breaker):
+        self._pipeline = pipeline
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline, name)
+
+    def execute(self, *args, **kwargs):
+        return self._breaker.call(self._pipeline.execute, *args, **kwargs)
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """
+    Exports how many of its connections are in use and how many it can
+    still hand out, labelled with `node` once it is set, whenever one is
+    taken or put back. A fork resets the pool, and the counts, in the
+    child.
+    """
+
+    node = None
+
+    def reset(self):
+        super().reset()
+        self.export()
+
+    def get_connection(self, *args, **kwargs):
+        connection = super().get_connection(*args, **kwargs)
+        self.export()
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        self.export()
+
+    def stats(self):
+        """
+        return:
+            connections in use and available, type tuple(int, int)
+        """
+        with self.pool.mutex:
+            idle = sum(1 for connection in self.pool.queue if connection is not None)
+        in_use = len(self._connections) - idle
+        return in_use, self.max_connections - in_use
+
+    def export(self):
+        if self.node is None:
+            return
+        in_use, available = self.stats()
+        REDIS_POOL_IN_USE.labels(node=self.node).set(in_use)
+        REDIS_POOL_AVAILABLE.labels(node=self.node).set(available)
 
 class RedisConnection(object):
+    """
+    Keeps a single client, and with it a single connection pool, per redis
+    url for the whole life of the process, so requests reuse warm
+    connections. redis-py resets a pool that is used after a fork, hence
+    every uwsgi worker ends up with its own pool.
+    """
+
+    _clients = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_connection(cls, url):
+        client = cls._clients.get(url)
+        if client is None:
+            if ',' in url:
+                return cls._get_sharded_connection(url)
+            with cls._lock:
+                client = cls._clients.get(url)
+                if client is None:
+                    client = GuardedRedis(
+                        connection_pool=cls._create_pool(url),
+                        breaker=CircuitBreaker(cls._node_name(url)),
+                    )
+                    cls._clients[url] = client
+        return client
+
+    @classmethod
+    def _get_sharded_connection(cls, url):
+        nodes = [(node, cls.get_connection(node)) for node in url.split(',')]
+        with cls._lock:
+            client = cls._clients.get(url)
+            if client is None:
+                client = ShardedRedis(nodes)
+                cls._clients[url] = client
+        return client
+
+    @classmethod
+    def register(cls, url, client):
+        """Serves url from the given client, mostly for stand-ins like
+        fakeredis in benchmarks."""
+        with cls._lock:
+            cls._clients[url] = client
 
     @staticmethod
-    def get_connection(url):
-        return redis.StrictRedis.from_url(url)
+    def _node_name(url):
+        """The url without its credentials, for metrics and logs."""
+        parts = urlsplit(url)
+        return '%s:%s%s' % (parts.hostname, parts.port or 6379, parts.path)
+
+    @classmethod
+    def _create_pool(cls, url):
+        """
+        A blocking pool makes a request wait up to REDIS_POOL_TIMEOUT for a
+        free connection, rather than failing, once REDIS_MAX_CONNECTIONS are
+        in use. Its usage is on /metrics, see MeteredConnectionPool.
+        """
+        pool = MeteredConnectionPool.from_url(
+            url,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_POOL_TIMEOUT,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+            health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        )
+        pool.node = cls._node_name(url)
+        pool.export()
+        return pool
 
 class RedisStore(object):
     
     ttl = None
     check_exists = False
 
+    _scripts = {}
+
     def __init__(self, connection=None):
         self.connection = connection or RedisConnection.get_connection(PROD_REDIS_URL)
 
+    def registered_script(self, script):
+        """
+        The Script of `script` on the connection of the store. A store
+        lasts one request, the Script is kept for the connection instead,
+        as register_script hashes the whole source every time.
+        """
+        key = (self.connection, script)
+        registered = RedisStore._scripts.get(key)
+        if registered is None:
+            registered = self.connection.register_script(script)
+            RedisStore._scripts[key] = registered
+        return registered
+
+    @timed_redis_call
     def get(self, key):
         return self.connection.get(key)
 
+    @timed_redis_call
     def set(self, key, val):
         kwargs = {'nx': self.check_exists}
         if self.ttl:
@@ -30,6 +301,19 @@ class RedisStore(object):
 
         return self.connection.set(key, val, **kwargs)
 
+    @timed_redis_call
+    def set_many(self, keys, val):
+        p = self.connection.pipeline(transaction=False)
+
+        kwargs = {'nx': self.check_exists}
+        if self.ttl:
+            kwargs['ex'] = self.ttl
+
+        for key in keys:
+            p.set(key, val, **kwargs)
+        return p.execute()
+
+    @timed_redis_call
     def setincr(self, key, amount):
         p = self.connection.pipeline()
 
@@ -41,8 +325,575 @@ class RedisStore(object):
         p.incr(key, amount)
         p.execute()
 
+    @timed_redis_call
     def incr(self, key, amount):
        return self.connection.incr(key, amount)
 
+    @timed_redis_call
     def exists(self, key):
         return self.connection.exists(key)
+
+
+class RateLimitStatus(object):
+
+    LIMITED = 0
+    ALLOWED = 1
+    BLOCKED = 2
+    NOT_MEMBER = 3
+    MEMBERSHIP_UNKNOWN = 4
+
+
+class RateLimit(namedtuple('RateLimit', ['status', 'remaining', 'reset'])):
+
+    @property
+    def allowed(self):
+        return self.status == RateLimitStatus.ALLOWED
+
+
+class RateLimiter(RedisStore):
+    """
+    Allows `limit` hits per `ttl` seconds. The check and the update run as
+    one server side script, so concurrent workers can never both take the
+    last slot, and a hit costs a single round trip. Subclasses implement
+    the limiting algorithm as two Lua fragments, _check which has to set
+    `allowed`, `remaining` and `reset`, and _commit which records the hit.
+
+    A hit can also be guarded by other keys, read in the same script, in
+    this order:
+        member_of, a (set key, member) pair, the member has to be in the
+        set. A missing set is reported as MEMBERSHIP_UNKNOWN.
+        the limit itself.
+        blocked_by, keys of which none may exist, or (hash key, field)
+        pairs of which no field may hold an expiry, in unix seconds, that
+        is still to come.
+    The hit is only recorded when every guard passes.
+
+    A recorded hit can also leave `limit:remaining:reset at` in the field
+    of a usage hash, see `usage`, for the state of many keys to be read
+    back at once. It expires with the latest of its fields.
+    """
+
+    algorithm = None
+    limit = None
+
+    _check = None
+    _commit = None
+
+    _template = """
+    if redis.replicate_commands then
+        redis.replicate_commands()
+    end
+
+    local limit = tonumber(ARGV[1])
+    local window = tonumber(ARGV[2])
+    local amount = tonumber(ARGV[3])
+    local usage_field = ARGV[6]
+    local blockers_from = 2
+    local blockers_to = #KEYS
+    if usage_field ~= '' then
+        blockers_to = #KEYS - 1
+    end
+
+    if ARGV[4] == '1' then
+        if redis.call('EXISTS', KEYS[2]) == 0 then
+            return {%(membership_unknown)d, 0, 0}
+        end
+        if redis.call('SISMEMBER', KEYS[2], ARGV[5]) == 0 then
+            return {%(not_member)d, 0, 0}
+        end
+        blockers_from = 3
+    end
+
+    %(check)s
+    if not allowed then
+        return {%(limited)d, remaining, reset}
+    end
+
+    local now_s = nil
+    for i = blockers_from, blockers_to do
+        local field = ARGV[6 + i - blockers_from + 1]
+        if field == '' then
+            if redis.call('EXISTS', KEYS[i]) == 1 then
+                return {%(blocked)d, remaining, reset}
+            end
+        else
+            local expires = tonumber(redis.call('HGET', KEYS[i], field))
+            if expires then
+                now_s = now_s or tonumber(redis.call('TIME')[1])
+                if expires > now_s then
+                    return {%(blocked)d, remaining, reset}
+                end
+            end
+        end
+    end
+
+    %(commit)s
+    if usage_field ~= '' then
+        now_s = now_s or tonumber(redis.call('TIME')[1])
+        local usage = KEYS[#KEYS]
+        redis.call(
+            'HSET', usage, usage_field,
+            string.format('%%d:%%d:%%d', limit, remaining, now_s + reset)
+        )
+        if redis.call('TTL', usage) < reset then
+            redis.call('EXPIRE', usage, math.max(reset, 1))
+        end
+    end
+    return {%(allowed)d, remaining, reset}
+    """
+
+    _now_ms = """
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+    local period = window * 1000
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls._check and '_hit_script' not in cls.__dict__:
+            cls._hit_script = cls._template % {
+                'check': cls._check,
+                'commit': cls._commit,
+                'limited': RateLimitStatus.LIMITED,
+                'allowed': RateLimitStatus.ALLOWED,
+                'blocked': RateLimitStatus.BLOCKED,
+                'not_member': RateLimitStatus.NOT_MEMBER,
+                'membership_unknown': RateLimitStatus.MEMBERSHIP_UNKNOWN,
+            }
+
+    def _hit_params(self, key, amount=1, member_of=None, blocked_by=(),
+                    limit=None, window=None, usage=None):
+        keys = [key]
+        args = [limit or self.limit, window or self.ttl, amount, 0, '', '']
+        if member_of:
+            keys.append(member_of[0])
+            args[3:5] = [1, member_of[1]]
+        for blocker in blocked_by:
+            if isinstance(blocker, tuple):
+                keys.append(blocker[0])
+                args.append(blocker[1])
+            else:
+                keys.append(blocker)
+                args.append('')
+        if usage:
+            keys.append(usage[0])
+            args[5] = usage[1]
+        return keys, args
+
+    @timed_redis_call
+    def hit(self, key, amount=1, member_of=None, blocked_by=(), limit=None,
+            window=None, usage=None):
+        """
+        params:
+            key, type string
+            amount, type int
+            member_of, type tuple(set key, member)
+            blocked_by, type list(string or tuple(hash key, field))
+            limit and window overriding the ones of the class, type int
+            usage, type tuple(hash key, field)
+        return:
+            RateLimit(status, remaining, reset), reset being the seconds
+            until the whole limit is available again
+        """
+        keys, args = self._hit_params(
+            key, amount, member_of, blocked_by, limit, window, usage
+        )
+        script = self.registered_script(self._hit_script)
+        status, remaining, reset = script(keys=keys, args=args)
+        return RateLimit(status, remaining, reset)
+
+    @timed_redis_call
+    def hit_many(self, hits):
+        """
+        Pipelines several hits in one round trip, they are applied in order.
+
+        params:
+            hits, type list(tuple(key, dict of hit kwargs))
+        return:
+            type list(RateLimit)
+        """
+        script = self.registered_script(self._hit_script)
+        params = [self._hit_params(key, **kwargs) for key, kwargs in hits]
+
+        def execute():
+            p = self.connection.pipeline(transaction=False)
+            for keys, args in params:
+                p.evalsha(script.sha, len(keys), *(keys + args))
+            return p.execute()
+
+        try:
+            results = execute()
+        except redis.exceptions.NoScriptError:
+            # No hit got applied, all of them failed on the same missing sha
+            self.connection.script_load(self._hit_script)
+            results = execute()
+        return [RateLimit(*result) for result in results]
+
+
+class FixedWindowRateLimiter(RateLimiter):
+    """A counter whose window starts with its first hit. It needs a single
+    integer per key, but lets a sender spend twice the limit around the
+    end of a window."""
+
+    algorithm = 'fixed_window'
+
+    _check = """
+    local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+    local reset = math.max(redis.call('TTL', KEYS[1]), 0)
+    local allowed = current + amount <= limit
+    local remaining = math.max(limit - current, 0)
+    """
+
+    _commit = """
+    current = redis.call('INCRBY', KEYS[1], amount)
+    remaining = limit - current
+    if redis.call('TTL', KEYS[1]) < 0 then
+        redis.call('EXPIRE', KEYS[1], window)
+        reset = window
+    end
+    """
+
+
+class GCRARateLimiter(RateLimiter):
+    """
+    Generic cell rate algorithm. The only value kept per key is the
+    theoretical arrival time in ms, hits are spaced by window/limit and up
+    to `limit` of them can burst. The key expires once the limit is whole
+    again.
+    """
+
+    algorithm = 'gcra'
+
+    _check = RateLimiter._now_ms + """
+    local interval = period / limit
+    local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), now)
+    local new_tat = tat + amount * interval
+    local diff = now - (new_tat - period)
+    local allowed = diff >= 0
+    local remaining = 0
+    if allowed then
+        remaining = math.floor(diff / interval)
+    end
+    local reset = math.ceil((tat - now) / 1000)
+    """
+
+    _commit = """
+    new_tat = math.ceil(new_tat)
+    redis.call('SET', KEYS[1], string.format('%d', new_tat), 'PX', new_tat - now)
+    reset = math.ceil((new_tat - now) / 1000)
+    """
+
+
+class SlidingWindowRateLimiter(RateLimiter):
+    """
+    Sliding window counter. The count of the previous window, weighted by
+    how much of it still overlaps the sliding window, is added to the count
+    of the current one. Both are packed with the start of the current
+    window into one `start:previous:current` string per key.
+    """
+
+    algorithm = 'sliding_window'
+
+    _check = RateLimiter._now_ms + """
+    local start = math.floor(now / period) * period
+    local previous = 0
+    local current = 0
+    local stored = redis.call('GET', KEYS[1])
+    if stored then
+        local s, p, c = string.match(stored, '^(%d+):(%d+):(%d+)$')
+        if tonumber(s) == start then
+            previous = tonumber(p)
+            current = tonumber(c)
+        elseif tonumber(s) == start - period then
+            previous = tonumber(c)
+        end
+    end
+    local estimated = previous * (period - (now - start)) / period + current
+    local allowed = estimated + amount <= limit
+    local remaining = math.max(math.floor(limit - estimated), 0)
+    local reset = math.ceil((start + period - now) / 1000)
+    """
+
+    _commit = """
+    current = current + amount
+    redis.call(
+        'SET', KEYS[1], string.format('%d:%d:%d', start, previous, current),
+        'PX', start + 2 * period - now
+    )
+    remaining = math.max(math.floor(limit - estimated - amount), 0)
+    """
+
+
+class SlidingLogRateLimiter(RateLimiter):
+    """
+    Exact sliding window, keeping a sorted set with the time of every hit
+    of the last window. It costs memory per hit rather than per key, so it
+    is only meant for low limits.
+    """
+
+    algorithm = 'sliding_log'
+
+    _check = RateLimiter._now_ms + """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - period)
+    local count = redis.call('ZCARD', KEYS[1])
+    local allowed = count + amount <= limit
+    local remaining = math.max(limit - count, 0)
+    local reset = 0
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    if oldest[2] then
+        reset = math.ceil((tonumber(oldest[2]) + period - now) / 1000)
+    end
+    """
+
+    _commit = """
+    for i = 1, amount do
+        redis.call('ZADD', KEYS[1], now, string.format('%d:%d', now, count + i))
+    end
+    redis.call('PEXPIRE', KEYS[1], period)
+    remaining = limit - count - amount
+    if reset == 0 then
+        reset = window
+    end
+    """
+
+
+RATE_LIMITERS = {
+    limiter.algorithm: limiter for limiter in [
+        FixedWindowRateLimiter, GCRARateLimiter, SlidingWindowRateLimiter,
+        SlidingLogRateLimiter
+    ]
+}
+
+
+class LocalCache(object):
+    """
+    A bounded in-process cache with a ttl on every entry and LRU eviction
+    once max_size is reached. Every uwsgi worker holds its own copy, so an
+    entry is only as fresh as its ttl and the invalidations that reach the
+    worker holding it.
+    """
+
+    max_size = 1000
+    ttl = 60
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or self.max_size
+        self.ttl = ttl or self.ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                val, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return val
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, val):
+        with self._lock:
+            self._set(key, val)
+
+    def _set(self, key, val):
+        self._entries[key] = (val, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        """
+        Drops every entry for which predicate(key, val) is true. This walks
+        the whole cache and is meant for rare invalidations only.
+        """
+        with self._lock:
+            keys = [k for k, (v, _) in self._entries.items() if predicate(k, v)]
+            for k in keys:
+                del self._entries[k]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class LocalRateLimiter(LocalCache):
+    """
+    An in-process fixed window counter per key, the stand-in of a
+    RateLimiter while redis is unavailable. Every worker counts on its own,
+    so the limit a worker enforces is only its share of the real one.
+    """
+
+    max_size = 100000
+    ttl = 24*60*60
+
+    def __init__(self, max_size=None, ttl=None):
+        super().__init__(max_size, ttl)
+        self._hit_lock = threading.Lock()
+
+    def hit(self, key, limit, window):
+        """
+        params:
+            key, type string
+            limit, type int
+            window in seconds, type int
+        return:
+            whether the hit is allowed, type bool
+        """
+        now = time.monotonic()
+        with self._hit_lock:
+            count, reset_at = self.get(key) or (0, now + window)
+            if reset_at <= now:
+                count, reset_at = 0, now + window
+            if count >= limit:
+                return False
+            self.set(key, (count + 1, reset_at))
+            return True
+
+
+class InvalidatedLocalCache(LocalCache):
+    """
+    A LocalCache whose entries are also dropped as soon as a message naming
+    them is published on `channel`, so that a write made by any worker
+    reaches every worker within a round trip instead of a ttl. Each process
+    listens from a daemon thread, started by listen() on first use.
+
+    The ttl still bounds staleness when messages get lost, the listener
+    clears the whole cache whenever it (re)subscribes for that reason.
+    It tries again reconnect_delay after losing the channel, the delay
+    doubling up to max_reconnect_delay while redis stays down.
+    """
+
+    channel = None
+    reconnect_delay = 1
+    max_reconnect_delay = 30
+    subscribe_timeout = 1
+
+    def __init__(self, max_size=None, ttl=None):
+        super().__init__(max_size, ttl)
+        self.generation = 0
+        self._listening = set()
+
+    def decode_message(self, data):
+        """
+        params:
+            data of a message, type bytes
+        return:
+            the key to invalidate
+        """
+        return data
+
+    def encode_message(self, key):
+        return key
+
+    def publish(self, connection, keys):
+        """
+        Drops the keys from this cache and from the caches of every worker
+        listening. A sharded connection publishes on one node only, every
+        node has its listeners.
+
+        params:
+            connection, type StrictRedis or ShardedRedis
+            keys, type iterable
+        """
+        keys = list(keys)
+        for key in keys:
+            self.invalidate(key)
+        if isinstance(connection, ShardedRedis):
+            connection = next(iter(connection.nodes.values()))
+        p = connection.pipeline(transaction=False)
+        for key in keys:
+            p.publish(self.channel, self.encode_message(key))
+        p.execute()
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def set_if_current(self, key, val, generation):
+        """Sets unless an invalidation arrived since `generation` was read,
+        which would make val, read before it, stale already."""
+        with self._lock:
+            if generation == self.generation:
+                self._set(key, val)
+
+    def listen(self, connection):
+        """A sharded connection publishes on every node, each of them gets
+        a listener. The call that starts them returns once they are
+        subscribed, or after subscribe_timeout when redis does not answer,
+        so that nothing it caches is dropped by the subscription."""
+        listener = (os.getpid(), id(connection))
+        if listener in self._listening:
+            return
+        with self._lock:
+            if listener in self._listening:
+                return
+            self._listening.add(listener)
+        nodes = connection.nodes.values() if isinstance(connection, ShardedRedis) \
+            else [connection]
+        subscribed = []
+        for node in nodes:
+            event = threading.Event()
+            thread = threading.Thread(target=self._listen, args=(node, event))
+            thread.daemon = True
+            thread.start()
+            subscribed.append(event)
+        deadline = time.monotonic() + self.subscribe_timeout
+        for event in subscribed:
+            event.wait(max(deadline - time.monotonic(), 0))
+
+    def _listen(self, connection, subscribed):
+        # None while subscribed
+        delay = None
+        while True:
+            try:
+                pubsub = connection.pubsub()
+                pubsub.subscribe(self.channel)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message:
+                        continue
+                    if message['type'] == 'subscribe':
+                        # Entries cached while not subscribed may have missed theirs
+                        with self._lock:
+                            self.generation += 1
+                            self._entries.clear()
+                        if delay is not None:
+                            logger.warning('Back on the %s invalidation channel', self.channel)
+                        delay = None
+                        subscribed.set()
+                    elif message['type'] == 'message':
+                        self.invalidate(self.decode_message(message['data']))
+            except redis.RedisError as e:
+                if delay is None:
+                    logger.exception('Lost the %s invalidation channel', self.channel)
+                    delay = self.reconnect_delay
+                else:
+                    logger.warning(
+                        'Still no %s invalidation channel, %s, retrying in %ss',
+                        self.channel, e, delay
+                    )
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
@@ -0,0 +1,210 @@
+import logging
+import os
+import threading
+import time
+
+from collections import deque
+
+from utils.metrics import DB_POOL_WAIT
+
+logger = logging.getLogger(__name__)
+
+
+"""A pool holds up to DB_POOL_MAX_SIZE connections per process, a request
+waits up to DB_POOL_TIMEOUT for one to be put back once they are all in
+use. Connections are closed DB_POOL_MAX_LIFETIME after they were opened
+and DB_POOL_MAX_IDLE after they were last used, one unused for more than
+DB_POOL_HEALTH_CHECK_INTERVAL is pinged before it is handed out again."""
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 1))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 30*60))
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', 5*60))
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTH_CHECK_INTERVAL', 30))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of DB-API connections, opened on demand by the
+    `connect` callable. The last connection put back is handed out first,
+    so the ones left over after a burst go idle and get closed. Like
+    redis-py pools it starts over, empty, when used after a fork.
+
+    params:
+        connect, returns a new connection, type function
+        name, for metrics and logs, type string
+    """
+
+    max_size = DB_POOL_MAX_SIZE
+    timeout = DB_POOL_TIMEOUT
+    max_lifetime = DB_POOL_MAX_LIFETIME
+    max_idle = DB_POOL_MAX_IDLE
+    health_check_interval = DB_POOL_HEALTH_CHECK_INTERVAL
+
+    def __init__(self, connect, name='default', max_size=None, timeout=None,
+                 max_lifetime=None, max_idle=None, health_check_interval=None):
+        self.connect = connect
+        self.name = name
+        self.max_size = max_size or self.max_size
+        self.timeout = timeout if timeout is not None else self.timeout
+        self.max_lifetime = max_lifetime or self.max_lifetime
+        self.max_idle = max_idle or self.max_idle
+        if health_check_interval is not None:
+            self.health_check_interval = health_check_interval
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._condition = threading.Condition()
+        # (connection, last used at), the most recently used last
+        self._idle = deque()
+        # Opened at of every connection of the pool, idle or in use
+        self._opened_at = {}
+        self._size = 0
+
+    def get(self):
+        """
+        return:
+            a connection, that has to be put back once done with
+        raises:
+            PoolTimeout when none is free within timeout
+        """
+        if self.pid != os.getpid():
+            self._reset()
+        start = time.perf_counter()
+        try:
+            while True:
+                conn, last_used = self._checkout(time.monotonic() + self.timeout)
+                if conn is None:
+                    return self._open()
+                if self._is_usable(conn, last_used):
+                    return conn
+                self.discard(conn)
+        finally:
+            DB_POOL_WAIT.labels(pool=self.name).observe(time.perf_counter() - start)
+
+    def _checkout(self, deadline):
+        """A free slot, returned as (None, None), is reserved for a new
+        connection that the caller has to open."""
+        with self._condition:
+            while True:
+                self._close_idle()
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        'No connection of pool %s was free within %ss' % (self.name, self.timeout)
+                    )
+                self._condition.wait(remaining)
+
+    def _open(self):
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._opened_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _close_idle(self):
+        """Closes the connections idle for more than max_idle, the oldest
+        are at the left."""
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.max_idle:
+            conn, last_used = self._idle.popleft()
+            self._size -= 1
+            self._opened_at.pop(id(conn), None)
+            self._close(conn)
+
+    def _is_usable(self, conn, last_used):
+        now = time.monotonic()
+        if self._is_closed(conn) or self._is_expired(conn, now):
+            return False
+        if now - last_used > self.health_check_interval:
+            try:
+                self.ping(conn)
+            except Exception:
+                logger.warning('Dropping a broken connection of pool %s', self.name)
+                return False
+        return True
+
+    def _is_expired(self, conn, now):
+        return now - self._opened_at.get(id(conn), now) > self.max_lifetime
+
+    @staticmethod
+    def _is_closed(conn):
+        return bool(getattr(conn, 'closed', False))
+
+    @staticmethod
+    def ping(conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def reset(conn):
+        """Leaves no transaction open on a connection put back."""
+        conn.rollback()
+
+    def put(self, conn):
+        if self.pid != os.getpid():
+            # Opened by the parent process, which may still be using it
+            return
+        if self._is_closed(conn) or self._is_expired(conn, time.monotonic()):
+            self.discard(conn)
+            return
+        try:
+            self.reset(conn)
+        except Exception:
+            self.discard(conn)
+            return
+        with self._condition:
+            self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    def discard(self, conn):
+        """Closes a connection taken from the pool instead of putting it back."""
+        self._close(conn)
+        with self._condition:
+            self._size -= 1
+            self._opened_at.pop(id(conn), None)
+            self._condition.notify()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close_idle(self):
+        """Closes all the idle connections, e.g. on shutdown."""
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+            for conn, last_used in idle:
+                self._opened_at.pop(id(conn), None)
+        for conn, last_used in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._condition:
+            idle = len(self._idle)
+            return {
+                'max_size': self.max_size,
+                'created': self._size,
+                'idle': idle,
+                'in_use': self._size - idle,
+            }
@@ -0,0 +1,61 @@
+import threading
+
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.base import Database
+
+from utils.db.pool import ConnectionPool, PoolTimeout
+
+"""
+The postgresql backend of Django, with connections taken from a
+ConnectionPool of the process instead of opened for every request. Use it
+with CONN_MAX_AGE = 0, closing a connection at the end of a request then
+puts it back in the pool, where any thread or greenlet can reuse it.
+"""
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def get_pool(self, conn_params=None):
+        """
+        params:
+            conn_params as from get_connection_params, type dict
+        return:
+            the pool of this database, type ConnectionPool
+        """
+        pool = self._pools.get(self.alias)
+        if pool is None:
+            conn_params = conn_params or self.get_connection_params()
+            with self._pools_lock:
+                pool = self._pools.get(self.alias)
+                if pool is None:
+                    pool = ConnectionPool(lambda: Database.connect(**conn_params), name=self.alias)
+                    self._pools[self.alias] = pool
+        return pool
+
+    def get_new_connection(self, conn_params):
+        try:
+            connection = self.get_pool(conn_params).get()
+        except PoolTimeout as e:
+            raise Database.OperationalError(str(e))
+
+        # As in the postgresql backend, a pooled connection keeps the
+        # isolation level it was given when it was opened
+        options = self.settings_dict['OPTIONS']
+        self.isolation_level = options.get('isolation_level', connection.isolation_level)
+        if self.isolation_level != connection.isolation_level:
+            connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        with self.wrap_database_errors:
+            if self.in_atomic_block:
+                # The wrapper keeps pointing to the connection until the
+                # block exits, no other thread may get it before
+                self.get_pool().discard(self.connection)
+            else:
+                self.get_pool().put(self.connection)
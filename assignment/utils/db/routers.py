@@ -0,0 +1,168 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import DatabaseError, connections, router
+from django.db.models.signals import post_delete, post_save
+
+logger = logging.getLogger(__name__)
+
+
+PRIMARY_DB = 'default'
+
+"""A replica lagging behind the primary by more than REPLICA_MAX_LAG seconds
+gets no reads, its lag is measured by every process once every
+REPLICA_LAG_CHECK_INTERVAL. After a request writes a replicated model its
+reads of them stay on the primary for REPLICA_PIN_SECONDS, or until it
+ends."""
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 1))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', 5))
+REPLICA_PIN_SECONDS = float(os.environ.get('REPLICA_PIN_SECONDS', 5))
+
+# Thread local, which gevent makes greenlet local, so that a write pins
+# the reads of its own request only
+_pin = threading.local()
+
+
+def pin_to_primary(seconds=None):
+    """Reads of replicated models from this thread go to the primary for
+    the next `seconds`, so that they see what it just wrote, and a request
+    only until it ends. Saves and deletes pin on their own, bulk writes
+    have to call it."""
+    _pin.until = time.monotonic() + (REPLICA_PIN_SECONDS if seconds is None else seconds)
+
+
+def is_pinned():
+    return time.monotonic() < getattr(_pin, 'until', 0)
+
+
+def _unpin(**kwargs):
+    _pin.until = 0
+
+
+def reads_from_replica(model):
+    """
+    return:
+        whether reads of model go to a replica at the moment, type bool
+    """
+    return router.db_for_read(model) != PRIMARY_DB
+
+
+class ReplicaRouter(object):
+    """
+    Sends the reads of the models of settings.REPLICA_MODELS to one of
+    the settings.DATABASE_REPLICAS aliases, picked at random among those
+    that are not lagging, and to the primary when none is left or the
+    process is pinned to it. Everything else, writes included, goes to the
+    primary.
+
+    A replica can still be up to REPLICA_MAX_LAG behind, reads that must
+    see a write made by another process, like a lookup of a row that was
+    just created, have to fall back to the primary when they miss.
+    """
+
+    max_lag = REPLICA_MAX_LAG
+    lag_check_interval = REPLICA_LAG_CHECK_INTERVAL
+
+    _lag_query = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+
+    def __init__(self, replicas=None, models=None):
+        self.replicas = list(
+            getattr(settings, 'DATABASE_REPLICAS', []) if replicas is None else replicas
+        )
+        self.models = {
+            label.lower() for label in
+            (getattr(settings, 'REPLICA_MODELS', []) if models is None else models)
+        }
+        # alias: (checked at, healthy)
+        self._health = {}
+        self._lock = threading.Lock()
+
+    def routes(self, model):
+        return bool(self.replicas) and model._meta.label_lower in self.models
+
+    def db_for_read(self, model, **hints):
+        if not self.routes(model) or is_pinned():
+            return None
+        replicas = [alias for alias in self.replicas if not self.mirrors_primary(alias)]
+        if not replicas:
+            return None
+        healthy = [alias for alias in replicas if self.is_healthy(alias)]
+        return random.choice(healthy) if healthy else PRIMARY_DB
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY_DB if self.routes(model) else None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY_DB}.union(self.replicas)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in self.replicas:
+            return False
+        return None
+
+    @staticmethod
+    def mirrors_primary(alias):
+        """Test runs point every replica to the test DB of the primary,
+        reading it from another connection would miss what the test wrote
+        in its transaction."""
+        fields = ('HOST', 'PORT', 'NAME')
+        replica = connections.databases[alias]
+        primary = connections.databases[PRIMARY_DB]
+        return all(replica.get(field) == primary.get(field) for field in fields)
+
+    def is_healthy(self, alias):
+        now = time.monotonic()
+        checked_at, healthy = self._health.get(alias, (None, False))
+        if checked_at is not None and now - checked_at < self.lag_check_interval:
+            return healthy
+        with self._lock:
+            checked_at, healthy = self._health.get(alias, (None, False))
+            if checked_at is None or now - checked_at >= self.lag_check_interval:
+                lag = self.lag(alias)
+                healthy = lag is not None and lag <= self.max_lag
+                if not healthy:
+                    logger.warning('Replica %s is out of rotation, lag %s', alias, lag)
+                self._health[alias] = (now, healthy)
+        return healthy
+
+    def lag(self, alias):
+        """
+        return:
+            seconds the replica is behind the primary, None when it can not
+            be reached, type float
+        """
+        connection = connections[alias]
+        if connection.vendor != 'postgresql':
+            return 0
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(self._lag_query)
+                return float(cursor.fetchone()[0] or 0)
+        except DatabaseError:
+            logger.exception('Could not read the lag of replica %s', alias)
+            return None
+
+
+def _pin_on_write(sender, **kwargs):
+    labels = {label.lower() for label in getattr(settings, 'REPLICA_MODELS', [])}
+    if sender._meta.label_lower in labels:
+        pin_to_primary()
+
+
+post_save.connect(_pin_on_write, dispatch_uid='utils.db.routers.pin_on_save')
+post_delete.connect(_pin_on_write, dispatch_uid='utils.db.routers.pin_on_delete')
+request_started.connect(_unpin, dispatch_uid='utils.db.routers.unpin')
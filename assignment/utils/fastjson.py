@@ -0,0 +1,87 @@
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+JSON parser and renderer for DRF on orjson, falling back to the standard
+library when it is not installed. Output is the compact UTF-8 JSON of
+DRF's JSONRenderer either way. orjson writes datetimes its own way, UTC
+as +00:00 where DRF writes Z, so they are handed to DRF's encoder, and it
+is told to take keys that are not strings like the standard library does.
+"""
+
+_encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+if orjson is not None:
+    _options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+def dumps(data):
+    """
+    return:
+        type bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_encoder.default, option=_options)
+    return _encoder.encode(data).encode()
+
+
+def loads(data):
+    """
+    params:
+        data, type bytes or string
+    raises:
+        ValueError when it is not JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode(settings.DEFAULT_CHARSET)
+    return json.loads(data)
+
+
+class EncodedBody(dict):
+    """
+    A response body that is always the same, encoded once. It is still a
+    dict for whoever reads response.data, FastJSONRenderer writes the bytes
+    as they are. It is shared, it must not be modified.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.encoded = dumps(self)
+
+
+class FastJSONRenderer(BaseRenderer):
+
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        encoded = getattr(data, 'encoded', None)
+        if encoded is not None:
+            return encoded
+        return dumps(data)
+
+
+class FastJSONParser(BaseParser):
+
+    media_type = 'application/json'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return loads(stream.read())
+        except ValueError as e:
+            raise ParseError('JSON parse error - %s' % e)
@@ -0,0 +1,169 @@
+import functools
+import os
+import time
+
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import generate_latest, multiprocess
+
+"""
+uwsgi serves requests from several worker processes. When
+PROMETHEUS_MULTIPROC_DIR is set, which uwsgi.ini does, every worker writes
+its samples to files in that directory and render() merges them, so a
+scrape sees the whole server whichever worker answers it.
+"""
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5
+)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 250, 500, 1000, 5000)
+
+REQUEST_LATENCY = Histogram(
+    'sms_api_request_seconds', 'Time taken by a request',
+    ['endpoint', 'outcome'], buckets=LATENCY_BUCKETS
+)
+STAGE_LATENCY = Histogram(
+    'sms_api_stage_seconds', 'Time taken by a stage of a request',
+    ['endpoint', 'stage'], buckets=LATENCY_BUCKETS
+)
+REDIS_LATENCY = Histogram(
+    'sms_api_redis_seconds', 'Time taken by a RedisStore call',
+    ['store', 'call'], buckets=LATENCY_BUCKETS
+)
+DB_POOL_WAIT = Histogram(
+    'sms_api_db_pool_wait_seconds',
+    'Time taken to get a connection from a DB pool, opening it included',
+    ['pool'], buckets=LATENCY_BUCKETS
+)
+MESSAGES = Counter(
+    'sms_api_messages_total', 'Messages handled, batches count every message',
+    ['endpoint', 'outcome']
+)
+DISPATCHED = Counter(
+    'sms_api_dispatched_total', 'Outbound sms handed to carriers, by outcome',
+    ['carrier', 'outcome']
+)
+CARRIER_LATENCY = Histogram(
+    'sms_api_carrier_batch_seconds', 'Time taken by a carrier to take a batch',
+    ['carrier'], buckets=LATENCY_BUCKETS
+)
+WRITE_BEHIND_LAG = Histogram(
+    'sms_api_write_behind_lag_seconds',
+    'Time the oldest row of a write behind batch waited to be written',
+    ['buffer'], buckets=LATENCY_BUCKETS + (5, 10, 30)
+)
+WRITE_BEHIND_BATCH = Histogram(
+    'sms_api_write_behind_batch_rows', 'Rows written per write behind batch',
+    ['buffer'], buckets=SIZE_BUCKETS
+)
+WRITE_BEHIND_DROPPED = Counter(
+    'sms_api_write_behind_dropped_total',
+    'Rows dropped by a full write behind buffer', ['buffer']
+)
+REDIS_POOL_IN_USE = Gauge(
+    'sms_api_redis_pool_in_use',
+    'Redis connections handed out by the pools of the workers, per node',
+    ['node'], multiprocess_mode='livesum'
+)
+REDIS_POOL_AVAILABLE = Gauge(
+    'sms_api_redis_pool_available',
+    'Redis connections the pools of the workers can still hand out, per node',
+    ['node'], multiprocess_mode='livesum'
+)
+CIRCUIT_TRANSITIONS = Counter(
+    'sms_api_redis_circuit_transitions_total',
+    'State changes of the redis circuit breakers', ['node', 'state']
+)
+CIRCUIT_STATE = Gauge(
+    'sms_api_redis_circuit_state',
+    'State of the redis circuit breaker of every worker, 0 closed, 1 open, 2 half open',
+    ['node'], multiprocess_mode='liveall'
+)
+
+
+class Outcome(object):
+
+    ACCEPTED = 'accepted'
+    INVALID = 'invalid'
+    UNAUTHORIZED = 'unauthorized'
+    FORBIDDEN = 'forbidden'
+    NOT_FOUND = 'not_found'
+    NOT_ALLOWED = 'not_allowed'
+    LIMIT = 'limit'
+    STOP = 'stop'
+    REPLAYED = 'replayed'
+    CONFLICT = 'conflict'
+    UNAVAILABLE = 'unavailable'
+    ERROR = 'error'
+    OTHER = 'other'
+
+    by_status = {
+        200: ACCEPTED,
+        202: ACCEPTED,
+        400: INVALID,
+        401: UNAUTHORIZED,
+        403: FORBIDDEN,
+        404: NOT_FOUND,
+        405: NOT_ALLOWED,
+        409: CONFLICT,
+        422: INVALID,
+        500: ERROR,
+        503: UNAVAILABLE,
+    }
+
+    @classmethod
+    def of(cls, response):
+        """Responses can carry a more precise outcome than their status,
+        like the two kinds of 403 of the outbound endpoint."""
+        outcome = getattr(response, 'outcome', None)
+        return outcome or cls.by_status.get(response.status_code, cls.OTHER)
+
+
+@contextmanager
+def timed(histogram, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+def timed_redis_call(method):
+    """Decorates a RedisStore method to record its latency."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with timed(REDIS_LATENCY, store=self.__class__.__name__, call=method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def mark_process_dead(pid=None):
+    """
+    Drops the live gauges of a worker that exits, their files would be
+    summed in render() otherwise. uwsgi.ini empties the directory when the
+    master starts.
+
+    params:
+        pid of the worker, the current process when not given, type int
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+def render():
+    """
+    return:
+        all metrics in the prometheus text format, type bytes
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
@@ -0,0 +1,366 @@
+import bisect
+import hashlib
+
+from collections import OrderedDict
+
+import redis
+
+"""
+Client side sharding of redis over several independent nodes. Keys are
+spread with consistent hashing, so adding or removing a node only moves
+the keys of its share of the ring. Like redis cluster, only the part of a
+key between the first `{` and the next `}`, its hash tag, is hashed when
+there is one, which keeps keys sharing a tag on the same node. Commands,
+pipelines and scripts touching several keys have to stay on one node.
+"""
+
+
+class CrossShardError(redis.RedisError):
+    pass
+
+
+def hash_tag(key):
+    """
+    params:
+        key, type string or bytes
+    return:
+        the part of the key that decides its node, type bytes
+    """
+    if isinstance(key, str):
+        key = key.encode()
+    start = key.find(b'{')
+    if start != -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def group_by_node(connection, items, key=lambda item: item):
+    """
+    Splits items so that the keys of each group are on a single node.
+
+    params:
+        connection, type StrictRedis or ShardedRedis
+        items, type list
+        key returning the redis key of an item, type function
+    return:
+        type list(list)
+    """
+    if not items:
+        return []
+    if not isinstance(connection, ShardedRedis):
+        return [list(items)]
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(connection.ring.get_node(key(item)), []).append(item)
+    return list(groups.values())
+
+
+class HashRing(object):
+    """Maps keys to nodes, every node owning `replicas` points of a ring of
+    2**32 positions, placed by the hash of its name."""
+
+    replicas = 160
+
+    def __init__(self, names, replicas=None):
+        self.replicas = replicas or self.replicas
+        self._points = []
+        for name in names:
+            for i in range(self.replicas):
+                point = self._hash(('%s#%d' % (name, i)).encode())
+                self._points.append((point, name))
+        self._points.sort()
+        self._positions = [point for point, name in self._points]
+
+    @staticmethod
+    def _hash(data):
+        return int(hashlib.md5(data).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        index = bisect.bisect(self._positions, self._hash(hash_tag(key)))
+        return self._points[index % len(self._points)][1]
+
+
+class ShardedRedis(object):
+    """
+    Stands in for a StrictRedis client, routing every command on its first
+    key. Commands that are not about keys, like ping or flushdb, go to all
+    the nodes.
+
+    params:
+        nodes, type OrderedDict(name, StrictRedis)
+    """
+
+    _all_nodes = {'flushdb', 'flushall', 'ping'}
+
+    def __init__(self, nodes):
+        self.nodes = OrderedDict(nodes)
+        self.ring = HashRing(list(self.nodes))
+        self._scripts = {}
+
+    def get_node(self, key):
+        return self.nodes[self.ring.get_node(key)]
+
+    def get_node_for_keys(self, keys):
+        """
+        params:
+            keys, type list
+        return:
+            the node all the keys are on, type StrictRedis
+        """
+        return self.nodes[self.get_node_name_for_keys(keys)]
+
+    def get_node_name_for_keys(self, keys):
+        names = {self.ring.get_node(key) for key in keys}
+        if len(names) > 1:
+            raise CrossShardError('keys %r are on different nodes' % (keys,))
+        return names.pop() if names else next(iter(self.nodes))
+
+    def __getattr__(self, name):
+        if name in self._all_nodes:
+            def command(*args, **kwargs):
+                return all(
+                    getattr(node, name)(*args, **kwargs) for node in self.nodes.values()
+                )
+        else:
+            def command(key, *args, **kwargs):
+                return getattr(self.get_node(key), name)(key, *args, **kwargs)
+        return command
+
+    def delete(self, *keys):
+        return self._per_node('delete', keys)
+
+    def exists(self, *keys):
+        return self._per_node('exists', keys)
+
+    def _per_node(self, name, keys):
+        by_node = OrderedDict()
+        for key in keys:
+            by_node.setdefault(self.ring.get_node(key), []).append(key)
+        return sum(
+            getattr(self.nodes[node], name)(*node_keys)
+            for node, node_keys in by_node.items()
+        )
+
+    def eval(self, script, numkeys, *keys_and_args):
+        node = self.get_node_for_keys(keys_and_args[:numkeys])
+        return node.eval(script, numkeys, *keys_and_args)
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        node = self.get_node_for_keys(keys_and_args[:numkeys])
+        return node.evalsha(sha, numkeys, *keys_and_args)
+
+    def script_load(self, script):
+        sha = None
+        for node in self.nodes.values():
+            sha = node.script_load(script)
+        self._scripts[sha] = script
+        return sha
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+
+class ShardedScript(object):
+    """A registered script, run on the node its keys are on."""
+
+    def __init__(self, sharded, script):
+        self.sharded = sharded
+        self.script = script
+        self.sha = hashlib.sha1(script.encode()).hexdigest()
+        self._node_scripts = {}
+        sharded._scripts[self.sha] = script
+
+    def __call__(self, keys=[], args=[], client=None):
+        if isinstance(client, ShardedPipeline):
+            return client.evalsha(self.sha, len(keys), *(list(keys) + list(args)))
+        name = self.sharded.get_node_name_for_keys(keys)
+        node_script = self._node_scripts.get(name)
+        if node_script is None:
+            node_script = self.sharded.nodes[name].register_script(self.script)
+            self._node_scripts[name] = node_script
+        return node_script(keys=keys, args=args)
+
+
+class ShardedPipeline(object):
+    """
+    Queues commands per node, execute() sends one pipeline to every node
+    involved and returns the results in the order the commands were queued.
+    A node missing a script used by EVALSHA gets it loaded and its commands
+    resent, which is only done when they are all EVALSHA calls, as then
+    none of them got applied.
+    """
+
+    def __init__(self, sharded, transaction=True):
+        self.sharded = sharded
+        self.transaction = transaction
+        self.command_stack = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            if name in ('evalsha', 'eval'):
+                node = self.sharded.get_node_name_for_keys(args[2:2 + args[1]])
+            else:
+                node = self.sharded.ring.get_node(args[0])
+            self.command_stack.append((node, name, args, kwargs))
+            return self
+        return queue
+
+    def _execute_node(self, node, commands):
+        p = self.sharded.nodes[node].pipeline(transaction=self.transaction)
+        for name, args, kwargs in commands:
+            getattr(p, name)(*args, **kwargs)
+        return p.execute()
+
+    def execute(self):
+        by_node = OrderedDict()
+        for i, (node, name, args, kwargs) in enumerate(self.command_stack):
+            by_node.setdefault(node, []).append((i, (name, args, kwargs)))
+        self.command_stack = []
+
+        results = {}
+        for node, commands in by_node.items():
+            queued = [command for i, command in commands]
+            try:
+                node_results = self._execute_node(node, queued)
+            except redis.exceptions.NoScriptError:
+                if any(name != 'evalsha' for name, args, kwargs in queued):
+                    raise
+                for name, args, kwargs in queued:
+                    script = self.sharded._scripts.get(args[0])
+                    if script is None:
+                        raise
+                    self.sharded.nodes[node].script_load(script)
+                node_results = self._execute_node(node, queued)
+            results.update(zip([i for i, command in commands], node_results))
+        return [results[i] for i in range(len(results))]
+
+
+class Rebalancer(object):
+    """
+    Moves the keys of `source` that the ring of `target` puts on another
+    node, with DUMP and RESTORE so that values keep their type and ttl.
+
+    It is meant to run while the app is serving. Run it once before the
+    workers switch to the target nodes, with keep_source, to copy most keys
+    ahead, and once after the switch to move what was written in between.
+    A key that already exists on its new node was copied there by the
+    first run, or written by the app after the switch. Numbers, counters
+    among them, and the fields of hashes are merged keeping the highest
+    number, so that a counter keeps what the app added on the source
+    between the two runs and StopRequestStore keeps every STOP request
+    with its latest expiry. Other keys are kept as they are there.
+
+    params:
+        source, target, type ShardedRedis, a node is known by its url
+    """
+
+    def __init__(self, source, target, keep_source=False, match=None,
+                 dry_run=False, batch=1000):
+        self.source = source
+        self.target = target
+        self.keep_source = keep_source
+        self.match = match
+        self.dry_run = dry_run
+        self.batch = batch
+        self.stats = OrderedDict(
+            (name, 0) for name in ('scanned', 'moved', 'merged', 'kept')
+        )
+
+    def run(self):
+        """
+        return:
+            counts of keys per action, type OrderedDict
+        """
+        for name, node in self.source.nodes.items():
+            keys = []
+            for key in node.scan_iter(match=self.match, count=self.batch):
+                self.stats['scanned'] += 1
+                if self.target.ring.get_node(key) != name:
+                    keys.append(key)
+                if len(keys) >= self.batch:
+                    self._move(node, keys)
+                    keys = []
+            self._move(node, keys)
+        return self.stats
+
+    def _move(self, node, keys):
+        if not keys or self.dry_run:
+            self.stats['moved'] += len(keys)
+            return
+
+        p = node.pipeline(transaction=False)
+        for key in keys:
+            p.type(key)
+            p.dump(key)
+            p.pttl(key)
+        dumped = p.execute()
+
+        moved = []
+        for i, key in enumerate(keys):
+            key_type, value, pttl = dumped[3 * i:3 * i + 3]
+            if value is None:
+                # Expired or deleted since the scan
+                continue
+            target = self.target.get_node(key)
+            try:
+                target.restore(key, max(pttl, 0), value)
+                self.stats['moved'] += 1
+            except redis.ResponseError as e:
+                if not str(e).startswith('BUSYKEY'):
+                    raise
+                self._merge(node, target, key, key_type, pttl)
+            moved.append(key)
+
+        if moved and not self.keep_source:
+            node.delete(*moved)
+
+    _set_if_higher = """
+    local value = tonumber(ARGV[1])
+    local current = redis.call('GET', KEYS[1])
+    if not value or not tonumber(current) or value <= tonumber(current) then
+        return 0
+    end
+    local pttl = math.max(redis.call('PTTL', KEYS[1]), tonumber(ARGV[2]))
+    if pttl > 0 then
+        redis.call('SET', KEYS[1], ARGV[1], 'PX', pttl)
+    else
+        redis.call('SET', KEYS[1], ARGV[1])
+    end
+    return 1
+    """
+
+    def _merge(self, node, target, key, key_type, pttl):
+        if key_type in (b'string', 'string'):
+            value = node.get(key)
+            if value is not None and _number(value) != float('-inf'):
+                target.eval(self._set_if_higher, 1, key, value, pttl)
+                self.stats['merged'] += 1
+            else:
+                self.stats['kept'] += 1
+            return
+        if key_type not in (b'hash', 'hash'):
+            self.stats['kept'] += 1
+            return
+        fields = node.hgetall(key)
+        current = target.hgetall(key)
+        updates = {
+            field: value for field, value in fields.items()
+            if field not in current or _number(value) > _number(current[field])
+        }
+        if updates:
+            target.hset(key, mapping=updates)
+        if pttl > 0 and target.pttl(key) > 0:
+            target.pexpire(key, max(pttl, target.pttl(key)))
+        self.stats['merged'] += 1
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return float('-inf')
@@ -0,0 +1,169 @@
+import redis
+
+from utils.caches import RedisStore
+from utils.metrics import timed_redis_call
+from utils.sharding import ShardedRedis
+
+"""
+Durable work queues on redis streams. Producers append entries with XADD,
+consumers of a consumer group read them with XREADGROUP and delete them
+once handled. An entry that is read and not handled stays pending, which
+is how failures get retried: claim_due hands pending entries out again
+once they have been idle for the backoff of their delivery count, be it
+because their consumer failed them or because it died.
+"""
+
+
+def _decode(fields):
+    return {
+        (k.decode() if isinstance(k, bytes) else k):
+        (v.decode() if isinstance(v, bytes) else v)
+        for k, v in fields.items()
+    }
+
+
+class StreamEntry(object):
+
+    def __init__(self, entry_id, fields, deliveries=1):
+        self.id = entry_id
+        self.fields = fields
+        self.deliveries = deliveries
+
+
+class StreamQueue(RedisStore):
+    """
+    A stream, `{name}`, read by the consumer group `group`. Entries that
+    fail max_attempts deliveries move to the dead letter stream
+    `{name}:dead`. Both keys share a hash tag, the whole queue lives on one
+    node of a sharded redis.
+
+    The n-th retry of an entry happens retry_delay * 2 ** (n - 1) after its
+    last delivery, at most max_retry_delay. A consumer has to be done with
+    an entry within retry_delay, the entry is handed out again after that.
+
+    Handled entries are deleted, the stream only holds the backlog. Once it
+    is longer than max_length, or the dead letter stream longer than
+    max_dead_length, every XADD trims the oldest entries, approximately, in
+    whole nodes of the stream. Trimmed entries are lost even if pending,
+    which bounds the memory a stalled consumer group can take. None keeps
+    everything.
+    """
+
+    name = None
+    group = 'workers'
+    max_attempts = 5
+    retry_delay = 5
+    max_retry_delay = 5*60
+    scan_factor = 10
+    max_length = None
+    max_dead_length = None
+
+    def __init__(self, connection=None):
+        super().__init__(connection)
+        self.stream_key = '{%s}' % self.name
+        self.dead_key = '{%s}:dead' % self.name
+        if isinstance(self.connection, ShardedRedis):
+            self.connection = self.connection.get_node(self.stream_key)
+
+    @timed_redis_call
+    def add(self, fields):
+        return self.connection.xadd(self.stream_key, fields, maxlen=self.max_length)
+
+    @timed_redis_call
+    def add_many(self, entries):
+        p = self.connection.pipeline(transaction=False)
+        for fields in entries:
+            p.xadd(self.stream_key, fields, maxlen=self.max_length)
+        return p.execute()
+
+    def ensure_group(self):
+        try:
+            self.connection.xgroup_create(self.stream_key, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if not str(e).startswith('BUSYGROUP'):
+                raise
+
+    def read(self, consumer, count, block=None):
+        """
+        params:
+            consumer name, type string
+            count of entries at most, type int
+            block for that many milliseconds when there are none, type int
+        return:
+            entries never delivered before, type list(StreamEntry)
+        """
+        response = self.connection.xreadgroup(
+            self.group, consumer, {self.stream_key: '>'}, count=count, block=block
+        )
+        return [
+            StreamEntry(entry_id, _decode(fields))
+            for stream, entries in response or []
+            for entry_id, fields in entries
+        ]
+
+    def backoff(self, deliveries):
+        """Seconds an entry delivered that many times waits for its retry."""
+        return min(self.retry_delay * 2 ** (deliveries - 1), self.max_retry_delay)
+
+    def claim_due(self, consumer, count):
+        """
+        Claims up to count of the pending entries whose backoff is over,
+        looking at the oldest scan_factor * count of them. The ones deleted
+        since they were listed are skipped.
+
+        return:
+            type list(StreamEntry)
+        """
+        pending = self.connection.xpending_range(
+            self.stream_key, self.group, '-', '+', self.scan_factor * count
+        )
+        due = dict([
+            (p['message_id'], p['times_delivered']) for p in pending
+            if p['time_since_delivered'] >= 1000 * self.backoff(p['times_delivered'])
+        ][:count])
+        if not due:
+            return []
+        claimed = self.connection.xclaim(
+            self.stream_key, self.group, consumer,
+            min_idle_time=1000 * self.retry_delay, message_ids=list(due)
+        )
+        return [
+            StreamEntry(entry_id, _decode(fields), due[entry_id] + 1)
+            for entry_id, fields in claimed if fields
+        ]
+
+    @timed_redis_call
+    def done(self, ids):
+        """Acknowledges and deletes handled entries."""
+        if not ids:
+            return
+        p = self.connection.pipeline()
+        p.xack(self.stream_key, self.group, *ids)
+        p.xdel(self.stream_key, *ids)
+        p.execute()
+
+    @timed_redis_call
+    def dead_letter(self, entries):
+        """Moves entries out of the queue, to the dead letter stream."""
+        if not entries:
+            return
+        ids = [entry.id for entry in entries]
+        p = self.connection.pipeline()
+        for entry in entries:
+            p.xadd(self.dead_key, entry.fields, maxlen=self.max_dead_length)
+        p.xack(self.stream_key, self.group, *ids)
+        p.xdel(self.stream_key, *ids)
+        p.execute()
+
+    def stats(self):
+        p = self.connection.pipeline(transaction=False)
+        p.xlen(self.stream_key)
+        p.xlen(self.dead_key)
+        length, dead = p.execute()
+        pending = 0
+        try:
+            pending = self.connection.xpending(self.stream_key, self.group)['pending']
+        except redis.ResponseError:
+            # No group yet
+            pass
+        return {'length': length, 'pending': pending, 'dead': dead}
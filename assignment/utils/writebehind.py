@@ -0,0 +1,150 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+from utils.metrics import WRITE_BEHIND_BATCH, WRITE_BEHIND_DROPPED
+from utils.metrics import WRITE_BEHIND_LAG
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer(object):
+    """
+    Rows added by requests are kept in memory and written out by the
+    `write` callable, max_size rows at a time, from a thread of the
+    process. The thread writes whenever max_size rows are waiting and at
+    least every interval seconds otherwise. Rows whose write failed are
+    kept for the next one, at most max_pending rows wait, the ones added
+    beyond that are dropped.
+
+    Once started, the thread runs in every process the buffer is used in,
+    forked ones included, and what is left is written when the process
+    exits normally. Rows added since the last write are lost when it is
+    killed.
+
+    params:
+        write, takes a list of rows, type function
+        name, for metrics and logs, type string
+    """
+
+    max_size = 500
+    interval = 1
+    max_pending = 100000
+
+    def __init__(self, write, name, max_size=None, interval=None, max_pending=None):
+        self.write = write
+        self.name = name
+        self.max_size = max_size or self.max_size
+        self.interval = interval or self.interval
+        self.max_pending = max_pending or self.max_pending
+        self.started = False
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rows = []
+        self._oldest = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row):
+        self.add_many([row])
+
+    def add_many(self, rows):
+        if self.pid != os.getpid():
+            # What the parent had buffered is written by the parent
+            self._reset()
+            if self.started:
+                self._spawn()
+
+        with self._lock:
+            room = self.max_pending - len(self._rows)
+            if room < len(rows):
+                WRITE_BEHIND_DROPPED.labels(buffer=self.name).inc(len(rows) - max(room, 0))
+                rows = rows[:max(room, 0)]
+            if rows and not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.extend(rows)
+            full = len(self._rows) >= self.max_size
+        if full:
+            self._wake.set()
+
+    def _take(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+            oldest, self._oldest = self._oldest, None
+        return rows, oldest
+
+    def _put_back(self, rows, oldest):
+        with self._lock:
+            self._rows[:0] = rows
+            self._oldest = oldest
+            dropped = len(self._rows) - self.max_pending
+            if dropped > 0:
+                del self._rows[self.max_pending:]
+                WRITE_BEHIND_DROPPED.labels(buffer=self.name).inc(dropped)
+
+    def flush(self):
+        """
+        Writes what is buffered, a failed write leaves its rows and the
+        following ones buffered.
+
+        return:
+            count of rows written, type int
+        """
+        with self._flush_lock:
+            rows, oldest = self._take()
+            written = 0
+            for start in range(0, len(rows), self.max_size):
+                batch = rows[start:start + self.max_size]
+                try:
+                    self.write(batch)
+                except Exception:
+                    logger.exception(
+                        'Write behind %s failed, %d rows kept', self.name, len(rows) - start
+                    )
+                    self._put_back(rows[start:], oldest)
+                    break
+                written += len(batch)
+                WRITE_BEHIND_BATCH.labels(buffer=self.name).observe(len(batch))
+                WRITE_BEHIND_LAG.labels(buffer=self.name).observe(time.monotonic() - oldest)
+            return written
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._rows:
+                self.flush()
+
+    def _spawn(self):
+        self._thread = threading.Thread(
+            target=self._run, name='writebehind-%s' % self.name, daemon=True
+        )
+        self._thread.start()
+
+    def start(self):
+        """Writes in the background from now on, in this process and the
+        ones forked from it."""
+        if self.started:
+            return
+        self.started = True
+        self._spawn()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """Stops the thread of this process and writes what is left."""
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None and self.pid == os.getpid():
+            self._thread.join(timeout)
+        if self.pid == os.getpid():
+            self.flush()